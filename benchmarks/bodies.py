@@ -0,0 +1,142 @@
+"""Time and peak memory of body conditions on multi-megabyte bodies.
+
+    python -m benchmarks.bodies --sizes 1 8 32
+    python -m benchmarks.bodies --sizes 16 --limit 65536
+
+Each variant decodes one base64url message part and checks a few body
+conditions against it, in a forked child process so that its peak RSS can
+be measured on its own:
+
+    lowercase      decode to text, then value.lower() in body.lower() (the old path)
+    text           decode to text, case-insensitive search without copies
+    bytes          keep the decoded bytes, case-insensitive byte search
+    bytes_limited  like bytes, stopping after --limit bytes
+"""
+import argparse
+import base64
+import logging
+import multiprocessing
+import resource
+import sys
+import time
+
+from processor.body import decode_part, decode_text, text_contains
+
+# Searched for in every body; only the last one occurs (at the very end)
+VALUES = ['quarterly report', 'unsubscribe here', 'tracking number', 'final notice']
+
+PARAGRAPH = ('Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut '
+             'labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco.\n')
+
+
+def make_part(size_mb):
+    """base64url message part of about size_mb megabytes ending in 'FINAL NOTICE'"""
+    text = PARAGRAPH * (size_mb * (1 << 20) // len(PARAGRAPH)) + 'FINAL NOTICE\n'
+    return base64.urlsafe_b64encode(text.encode('ascii')).decode('ascii')
+
+
+def _lowercase(data, values, limit):
+    body = base64.urlsafe_b64decode(data).decode('utf-8')
+    return [value.lower() in body.lower() for value in values]
+
+
+def _text(data, values, limit):
+    body = decode_text(decode_part(data))
+    return [text_contains(body, value) for value in values]
+
+
+def _bytes(data, values, limit):
+    body = decode_part(data)
+    return [text_contains(body, value) for value in values]
+
+
+def _bytes_limited(data, values, limit):
+    body = decode_part(data)
+    return [text_contains(body, value, limit) for value in values]
+
+
+VARIANTS = {
+    'lowercase': _lowercase,
+    'text': _text,
+    'bytes': _bytes,
+    'bytes_limited': _bytes_limited
+}
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def measure(variant, data, values=VALUES, limit=1 << 16):
+    """Run one variant in this process
+
+    Returns:
+        Tuple of (seconds, peak RSS growth in bytes, condition results)
+    """
+    rss_before = peak_rss()
+    started = time.perf_counter()
+    matched = VARIANTS[variant](data, values, limit)
+    return time.perf_counter() - started, peak_rss() - rss_before, matched
+
+
+def _measure_child(queue, variant, data, values, limit):
+    queue.put(measure(variant, data, values, limit))
+
+
+def measure_isolated(variant, data, values=VALUES, limit=1 << 16):
+    """Run one variant in a forked child so its peak RSS is not hidden by earlier runs"""
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    process = context.Process(target=_measure_child, args=(queue, variant, data, values, limit))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def run_body_benchmark(sizes_mb=(1, 8, 32), limit=1 << 16, isolate=True):
+    """Measure every variant on bodies of each size
+
+    Returns:
+        List of dictionaries with 'size_mb', 'variant', 'seconds', 'peak_rss_mb' and 'matched'
+    """
+    rows = []
+    for size_mb in sizes_mb:
+        data = make_part(size_mb)
+        for variant in VARIANTS:
+            if isolate:
+                seconds, rss, matched = measure_isolated(variant, data, VALUES, limit)
+            else:
+                seconds, rss, matched = measure(variant, data, VALUES, limit)
+            rows.append({'size_mb': size_mb, 'variant': variant, 'seconds': seconds,
+                         'peak_rss_mb': rss / (1 << 20), 'matched': sum(matched)})
+    return rows
+
+
+def format_rows(rows):
+    lines = [f"{'size MB':>7} {'variant':<14} {'seconds':>9} {'peak RSS MB':>12} {'matched':>8}"]
+    for row in rows:
+        lines.append(f"{row['size_mb']:>7} {row['variant']:<14} {row['seconds']:>9.4f} "
+                     f"{row['peak_rss_mb']:>12.1f} {row['matched']:>8}")
+    return '\n'.join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark body conditions on large message bodies')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 8, 32], help='body sizes in MB (default: 1 8 32)')
+    parser.add_argument('--limit', type=int, default=1 << 16,
+                        help='scan limit in bytes for bytes_limited (default: 65536)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    print(format_rows(run_body_benchmark(args.sizes, args.limit)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,294 @@
+import json
+import random
+import threading
+import time
+from collections import deque
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+from benchmarks.mailbox import SyntheticMailbox
+from processor.quota import quota_cost
+
+
+def http_error(status, reason):
+    content = json.dumps({'error': {'code': status, 'message': reason, 'errors': [{'reason': reason}]}})
+    return HttpError(httplib2.Response({'status': status}), content.encode('utf-8'))
+
+
+class FakeRequest:
+    def __init__(self, service, method, handler):
+        self.service = service
+        self.method = method
+        self.handler = handler
+
+    def execute(self):
+        return self.service.call(self.method, self.handler)
+
+
+class FakeBatch:
+    """Stand-in for BatchHttpRequest: one round trip, each request charged on its own"""
+
+    # Gmail accepts at most this many requests in one batch
+    LIMIT = 100
+
+    def __init__(self, service, callback=None):
+        self.service = service
+        self.callback = callback
+        self._requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        if len(self._requests) >= self.LIMIT:
+            raise ValueError(f'A batch holds at most {self.LIMIT} requests')
+        request_id = request_id or str(len(self._requests) + 1)
+        self._requests.append((request_id, request, callback or self.callback))
+
+    def execute(self):
+        self.service.call('batch', lambda: None, charge=False)
+        for request_id, request, callback in self._requests:
+            response, error = None, None
+            try:
+                response = self.service.call(request.method, request.handler, latency=False)
+            except HttpError as e:
+                error = e
+            if callback:
+                callback(request_id, response, error)
+
+
+class _Resource:
+    def __init__(self, service, prefix, methods):
+        self._service = service
+        self._prefix = prefix
+        self._methods = methods
+
+    def __getattr__(self, name):
+        try:
+            handler = self._methods[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+        def method(**kwargs):
+            return FakeRequest(self._service, f'{self._prefix}.{name}', lambda: handler(**kwargs))
+
+        return method
+
+
+class FakeGmailService:
+    """In-process stand-in for the Gmail service built by authenticate_gmail.
+
+    Serves a SyntheticMailbox through the same call chains the processor uses
+    (``users().messages().get(...).execute()`` and so on) and keeps label
+    changes in memory. Each request can be slowed down and made to fail:
+
+    Args:
+        mailbox: SyntheticMailbox to serve
+        latency: seconds every request takes
+        jitter: extra random latency, up to this many seconds
+        error_rate: fraction of requests failing with HTTP 500
+        quota_per_second: quota units allowed per rolling second; requests over
+            it fail with HTTP 429 (None for unlimited)
+        seed: seed for jitter and errors
+    """
+
+    def __init__(self, mailbox, latency=0.0, jitter=0.0, error_rate=0.0, quota_per_second=None, seed=0):
+        self.mailbox = mailbox
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.quota_per_second = quota_per_second
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._window = deque()
+        self._window_units = 0
+        self._labels = {}
+        self._history = {}
+        self._history_id = 1000 + len(mailbox)
+        self._user_labels = {}
+        self._trashed = set()
+        self.calls = {}
+        self.units = 0
+        self.errors = 0
+
+    # Resource chain
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return _Resource(self, 'users.messages', {
+            'list': self._list, 'get': self._get, 'modify': self._modify,
+            'batchModify': self._batch_modify, 'trash': self._trash
+        })
+
+    def threads(self):
+        return _Resource(self, 'users.threads', {
+            'list': self._threads_list, 'get': self._threads_get, 'modify': self._threads_modify,
+            'trash': self._threads_trash
+        })
+
+    def labels(self):
+        return _Resource(self, 'users.labels', {'list': self._labels_list, 'create': self._labels_create})
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+    # Request execution
+
+    def _charge(self, units):
+        """Record quota use; False if the rolling one-second budget is exceeded"""
+        now = time.monotonic()
+        with self._lock:
+            while self._window and self._window[0][0] <= now - 1.0:
+                self._window_units -= self._window.popleft()[1]
+            if self.quota_per_second is not None and self._window_units + units > self.quota_per_second:
+                return False
+            self._window.append((now, units))
+            self._window_units += units
+            self.units += units
+            return True
+
+    def call(self, method, handler, latency=True, charge=True):
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            delay = self.latency + (self._random.random() * self.jitter if self.jitter else 0.0)
+            fail = self.error_rate and self._random.random() < self.error_rate
+        if delay and latency:
+            time.sleep(delay)
+        if charge and not self._charge(quota_cost(method)):
+            with self._lock:
+                self.errors += 1
+            raise http_error(429, 'rateLimitExceeded')
+        if fail:
+            with self._lock:
+                self.errors += 1
+            raise http_error(500, 'backendError')
+        return handler()
+
+    # Handlers
+
+    def _message_labels(self, index):
+        message_id = self.mailbox.message_id(index)
+        labels = self._labels.get(message_id)
+        return labels if labels is not None else self.mailbox.labels(index)
+
+    def _message_history(self, index):
+        message_id = self.mailbox.message_id(index)
+        return self._history.get(message_id, str(1000 + index))
+
+    def _message(self, index, format):
+        labels = self._message_labels(index)
+        if format == 'minimal':
+            return {'id': self.mailbox.message_id(index), 'threadId': self.mailbox.thread_id(index),
+                    'labelIds': list(labels), 'historyId': self._message_history(index)}
+        message = self.mailbox.message(index, labels)
+        message['historyId'] = self._message_history(index)
+        return message
+
+    def _index(self, message_id):
+        if message_id not in self.mailbox or message_id in self._trashed:
+            raise http_error(404, 'notFound')
+        return self.mailbox.index_of(message_id)
+
+    def _list(self, userId, q='in:all', maxResults=100, pageToken=None, **kwargs):
+        start = int(pageToken or 0)
+        end = min(start + min(maxResults, 500), len(self.mailbox))
+        messages = [{'id': self.mailbox.message_id(index), 'threadId': self.mailbox.thread_id(index)}
+                    for index in range(start, end)
+                    if self.mailbox.message_id(index) not in self._trashed]
+        result = {'messages': messages, 'resultSizeEstimate': len(self.mailbox)}
+        if end < len(self.mailbox):
+            result['nextPageToken'] = str(end)
+        return result
+
+    def _get(self, userId, id, format='full', **kwargs):
+        return self._message(self._index(id), format)
+
+    def _apply(self, message_id, add, remove):
+        labels = list(self._message_labels(self._index(message_id)))
+        labels = [label for label in labels if label not in remove]
+        labels.extend(label for label in add if label not in labels)
+        self._labels[message_id] = labels
+        # Every change moves the message to a new mailbox history ID
+        self._history_id += 1
+        self._history[message_id] = str(self._history_id)
+
+    def _modify(self, userId, id, body):
+        with self._lock:
+            self._apply(id, body.get('addLabelIds', []), body.get('removeLabelIds', []))
+            return {'id': id, 'labelIds': self._labels[id]}
+
+    def _batch_modify(self, userId, body):
+        if len(body['ids']) > 1000:
+            raise http_error(400, 'invalidArgument')
+        with self._lock:
+            for message_id in body['ids']:
+                self._apply(message_id, body.get('addLabelIds', []), body.get('removeLabelIds', []))
+        return {}
+
+    def _trash(self, userId, id):
+        with self._lock:
+            self._index(id)
+            self._trashed.add(id)
+        return {'id': id, 'labelIds': ['TRASH']}
+
+    def _thread_indexes(self, thread_id):
+        """Indexes of a thread's messages, oldest first (threads are runs of consecutive indexes)"""
+        start = self._index(thread_id[1:])
+        end = start + 1
+        while end < len(self.mailbox) and self.mailbox.thread_id(end) == thread_id:
+            end += 1
+        return [index for index in range(end - 1, start - 1, -1)
+                if self.mailbox.message_id(index) not in self._trashed]
+
+    def _threads_list(self, userId, q='in:all', maxResults=100, pageToken=None, **kwargs):
+        index = int(pageToken or 0)
+        threads = []
+        while index < len(self.mailbox) and len(threads) < min(maxResults, 500):
+            thread_id = self.mailbox.thread_id(index)
+            if thread_id == f't{self.mailbox.message_id(index)}':
+                try:
+                    history_id = max(int(self._message_history(i)) for i in self._thread_indexes(thread_id))
+                    threads.append({'id': thread_id, 'historyId': str(history_id)})
+                except HttpError:
+                    threads.append({'id': thread_id})
+            index += 1
+        result = {'threads': threads}
+        if index < len(self.mailbox):
+            result['nextPageToken'] = str(index)
+        return result
+
+    def _threads_get(self, userId, id, format='full', **kwargs):
+        messages = []
+        for index in self._thread_indexes(id):
+            messages.append(self._message(index, format))
+        return {'id': id, 'messages': messages}
+
+    def _threads_modify(self, userId, id, body):
+        with self._lock:
+            for index in self._thread_indexes(id):
+                self._apply(self.mailbox.message_id(index), body.get('addLabelIds', []),
+                            body.get('removeLabelIds', []))
+        return {'id': id}
+
+    def _threads_trash(self, userId, id):
+        with self._lock:
+            for index in self._thread_indexes(id):
+                self._trashed.add(self.mailbox.message_id(index))
+        return {'id': id}
+
+    def _labels_list(self, userId):
+        system = [{'id': label, 'name': label, 'type': 'system'}
+                  for label in ('INBOX', 'UNREAD', 'STARRED', 'IMPORTANT', 'SENT', 'DRAFT', 'SPAM', 'TRASH')]
+        user = [{'id': label_id, 'name': name, 'type': 'user'} for name, label_id in self._user_labels.items()]
+        return {'labels': system + user}
+
+    def _labels_create(self, userId, body):
+        with self._lock:
+            label_id = self._user_labels.setdefault(body['name'], f'Label_{len(self._user_labels) + 1}')
+        return {'id': label_id, 'name': body['name'], 'type': 'user'}
+
+
+def make_service(size=1000, seed=0, **options):
+    """Fake service over a fresh synthetic mailbox of the given size"""
+    return FakeGmailService(SyntheticMailbox(size, seed=seed), seed=seed, **options)
@@ -0,0 +1,160 @@
+import base64
+import random
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+# Mailbox sizes accepted by the benchmark runner
+SIZES = {'1k': 1000, '10k': 10000, '100k': 100000}
+
+# Fixed "now" so generated dates (and older_than/newer_than rules) are reproducible
+EPOCH = datetime(2024, 6, 1, 12, 0, tzinfo=timezone.utc)
+
+SENDERS = [
+    ('Google', 'no-reply@accounts.google.com'),
+    ('GitHub', 'notifications@github.com'),
+    ('LinkedIn', 'jobs-listings@linkedin.com'),
+    ('Amazon', 'shipment-tracking@amazon.com'),
+    ('Recruiting Team', 'careers@startup.io'),
+    ('Alice Smith', 'alice.smith@gmail.com'),
+    ('Bob Jones', 'bob@example.org'),
+    ('Newsletter', 'digest@substack.com'),
+    ('Bank Alerts', 'alerts@bank.example.com'),
+    ('Calendar', 'calendar-notification@google.com'),
+]
+
+SUBJECTS = [
+    'Interview invitation for {word}', 'Your {word} order has shipped', 'Security alert: new sign-in',
+    'Weekly digest: {word} and more', 'Re: {word} meeting notes', '[{word}] Pull request review requested',
+    'Invoice #{number}', 'Urgent: {word} needs your attention', 'Lunch on {word}?', 'Your statement is ready',
+]
+
+WORDS = ('project quarterly roadmap python release budget design hiring offer travel report status '
+         'analytics contract launch migration database customer feedback schedule review').split()
+
+CATEGORY_LABELS = ['CATEGORY_PERSONAL', 'CATEGORY_SOCIAL', 'CATEGORY_PROMOTIONS', 'CATEGORY_UPDATES',
+                   'CATEGORY_FORUMS']
+
+
+def _encode(text):
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii')
+
+
+def _paragraphs(rng, min_chars, max_chars):
+    target = rng.randint(min_chars, max_chars)
+    words = []
+    length = 0
+    while length < target:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    text = ' '.join(words)
+    return '\n\n'.join(text[i:i + 400] for i in range(0, len(text), 400))
+
+
+def _payload(rng, headers, body):
+    """Message payload in one of the MIME shapes seen in real mailboxes"""
+    shape = rng.random()
+    if shape < 0.5:
+        return {'mimeType': 'text/plain', 'headers': headers, 'body': {'size': len(body), 'data': _encode(body)}}
+
+    html = '<html><body>' + ''.join(f'<p>{p}</p>' for p in body.split('\n\n')) + '</body></html>'
+    if shape < 0.85:
+        return {'mimeType': 'multipart/alternative', 'headers': headers, 'body': {'size': 0}, 'parts': [
+            {'mimeType': 'text/plain', 'body': {'size': len(body), 'data': _encode(body)}},
+            {'mimeType': 'text/html', 'body': {'size': len(html), 'data': _encode(html)}},
+        ]}
+    if shape < 0.95:
+        return {'mimeType': 'multipart/alternative', 'headers': headers, 'body': {'size': 0}, 'parts': [
+            {'mimeType': 'text/html', 'body': {'size': len(html), 'data': _encode(html)}},
+        ]}
+    # Mixed with an attachment: the body sits in a nested alternative part
+    return {'mimeType': 'multipart/mixed', 'headers': headers, 'body': {'size': 0}, 'parts': [
+        {'mimeType': 'multipart/alternative', 'body': {'size': 0}, 'parts': [
+            {'mimeType': 'text/plain', 'body': {'size': len(body), 'data': _encode(body)}},
+        ]},
+        {'mimeType': 'application/pdf', 'filename': 'report.pdf',
+         'body': {'size': rng.randint(20000, 500000), 'attachmentId': f'att{rng.randint(0, 10 ** 9)}'}},
+    ]}
+
+
+class SyntheticMailbox:
+    """Deterministic mailbox of ``size`` messages in Gmail API format.
+
+    Messages are generated on demand from their index and the seed, so a
+    100k mailbox costs no memory until it is read, and every run sees exactly
+    the same messages. Newer messages have lower indexes, like Gmail's
+    newest-first listing. About one in four messages shares a thread with
+    the message before it.
+    """
+
+    def __init__(self, size, seed=0):
+        self.size = size
+        self.seed = seed
+
+    def message_id(self, index):
+        return f'{self.seed:x}{index:08x}'
+
+    def index_of(self, message_id):
+        return int(message_id[-8:], 16)
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, message_id):
+        try:
+            index = self.index_of(message_id)
+        except ValueError:
+            return False
+        return 0 <= index < self.size and message_id == self.message_id(index)
+
+    def message_ids(self):
+        return (self.message_id(index) for index in range(self.size))
+
+    def thread_id(self, index):
+        rng = random.Random(self.seed * 1000003 + index)
+        if index > 0 and rng.random() < 0.25:
+            return self.thread_id(index - 1)
+        return f't{self.message_id(index)}'
+
+    def labels(self, index):
+        rng = random.Random(self.seed * 7919 + index)
+        labels = []
+        if rng.random() < 0.7:
+            labels.append('INBOX')
+        if rng.random() < 0.4:
+            labels.append('UNREAD')
+        if rng.random() < 0.05:
+            labels.append('STARRED')
+        labels.append(rng.choice(CATEGORY_LABELS))
+        return labels
+
+    def message(self, index, labels=None):
+        """Full message resource (format='full')"""
+        rng = random.Random(self.seed * 104729 + index)
+        name, address = rng.choice(SENDERS)
+        subject = rng.choice(SUBJECTS).format(word=rng.choice(WORDS).title(), number=rng.randint(1000, 99999))
+        date = EPOCH - timedelta(minutes=index * 37 + rng.randint(0, 30))
+        body = _paragraphs(rng, 200, 6000)
+
+        headers = [
+            {'name': 'Delivered-To', 'value': 'me@gmail.com'},
+            {'name': 'Received', 'value': f'from mail.example.com by mx.google.com; {format_datetime(date)}'},
+            {'name': 'From', 'value': f'{name} <{address}>'},
+            {'name': 'To', 'value': 'Me <me@gmail.com>'},
+            {'name': 'Subject', 'value': subject},
+            {'name': 'Date', 'value': format_datetime(date)},
+            {'name': 'Message-ID', 'value': f'<{self.message_id(index)}@mail.example.com>'},
+            {'name': 'MIME-Version', 'value': '1.0'},
+        ]
+        if labels is None:
+            labels = self.labels(index)
+        return {
+            'id': self.message_id(index),
+            'threadId': self.thread_id(index),
+            'labelIds': list(labels),
+            'snippet': body[:100],
+            'historyId': str(1000 + index),
+            'internalDate': str(int(date.timestamp() * 1000)),
+            'sizeEstimate': len(body) * 2,
+            'payload': _payload(rng, headers, body)
+        }
@@ -0,0 +1,210 @@
+"""Throughput benchmarks for the processing stages.
+
+    python -m benchmarks.run --size 10k
+    python -m benchmarks.run --size 10k --save-baseline
+    python -m benchmarks.run --size 1k --latency 0.02 --error-rate 0.01 --quota 250
+
+Every stage runs the current code paths against a synthetic mailbox served
+by FakeGmailService. Results are compared with the stored baseline for the
+same size and the run exits with status 1 if a stage got slower than the
+tolerance allows.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from benchmarks.fake_gmail import FakeGmailService
+from benchmarks.mailbox import SIZES, SyntheticMailbox
+from processor.actions import EmailActions
+from processor.database import EmailDatabase
+from processor.parse import list_message_ids, parse_email_content
+from processor.rules import RuleEngine
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_RULES = os.path.join(BENCHMARK_DIR, 'rules.json')
+DEFAULT_BASELINES = os.path.join(BENCHMARK_DIR, 'baselines.json')
+
+STAGES = ['fetch', 'db_insert', 'evaluate', 'actions', 'actions_batched']
+
+
+def parse_size(size):
+    if size in SIZES:
+        return SIZES[size]
+    return int(size)
+
+
+def _timed(results, stage, items, func):
+    started = time.perf_counter()
+    value = func()
+    seconds = time.perf_counter() - started
+    results[stage] = {'items': items if isinstance(items, int) else items(value), 'seconds': seconds}
+    results[stage]['per_second'] = results[stage]['items'] / seconds if seconds else float('inf')
+    return value
+
+
+def run_benchmarks(size=1000, seed=0, rules_file=DEFAULT_RULES, workdir=None, **service_options):
+    """Run every stage once against a synthetic mailbox
+
+    Args:
+        size: number of messages
+        seed: mailbox seed
+        rules_file: rules to evaluate
+        workdir: directory for the SQLite databases (a temporary one by default)
+        service_options: FakeGmailService options (latency, jitter, error_rate, quota_per_second)
+
+    Returns:
+        Dictionary of stage name to {'items', 'seconds', 'per_second'}
+    """
+    mailbox = SyntheticMailbox(size, seed=seed)
+    own_workdir = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix='gmail-bench-')
+    results = {}
+
+    try:
+        service = FakeGmailService(mailbox, seed=seed, **service_options)
+
+        def fetch():
+            records = []
+            page_token = None
+            while True:
+                email_ids, page_token = list_message_ids(service, max_results=500, page_token=page_token)
+                for email_id in email_ids:
+                    record = parse_email_content(service, email_id)
+                    if record:
+                        records.append(record)
+                if not page_token:
+                    return records
+
+        records = _timed(results, 'fetch', len, fetch)
+
+        db = EmailDatabase(os.path.join(workdir, 'bench.db'), keep_alive=True)
+        _timed(results, 'db_insert', len(records),
+               lambda: [db.insert_emails(records[i:i + 500]) for i in range(0, len(records), 500)])
+
+        rule_engine = RuleEngine(rules_file, label_registry=db.labels)
+        actions = _timed(results, 'evaluate', len(records), lambda: rule_engine.get_actions_for_emails(records))
+
+        # Each action stage starts from the untouched mailbox and an empty action log
+        executor = EmailActions(FakeGmailService(mailbox, seed=seed, **service_options), db=db)
+        _timed(results, 'actions', len(actions), lambda: executor.execute_actions(actions))
+        executor.audit.close()
+
+        batch_db = EmailDatabase(os.path.join(workdir, 'bench_batch.db'), keep_alive=True)
+        batch_db.insert_emails(records)
+        executor = EmailActions(FakeGmailService(mailbox, seed=seed, **service_options), db=batch_db)
+        _timed(results, 'actions_batched', len(actions), lambda: executor.execute_actions(actions, batch=True))
+        executor.audit.close()
+
+        db.close()
+        batch_db.close()
+    finally:
+        if own_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return results
+
+
+def load_baselines(path=DEFAULT_BASELINES):
+    try:
+        with open(path, 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def save_baseline(results, key, path=DEFAULT_BASELINES):
+    """Store the per-stage throughput of a run as the baseline for key"""
+    baselines = load_baselines(path)
+    baselines[key] = {
+        'recorded_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'per_second': {stage: round(result['per_second'], 1) for stage, result in results.items()}
+    }
+    with open(path, 'w') as file:
+        json.dump(baselines, file, indent=2, sort_keys=True)
+        file.write('\n')
+
+
+def compare(results, baseline, tolerance=0.25):
+    """Compare a run with a baseline
+
+    Returns:
+        List of (stage, per_second, baseline per_second or None, regressed)
+    """
+    rows = []
+    for stage, result in results.items():
+        expected = (baseline or {}).get('per_second', {}).get(stage)
+        regressed = expected is not None and result['per_second'] < expected * (1 - tolerance)
+        rows.append((stage, result['per_second'], expected, regressed))
+    return rows
+
+
+def format_results(results, rows):
+    lines = [f"{'stage':<18} {'items':>8} {'seconds':>9} {'per sec':>11} {'baseline':>11} {'change':>8}"]
+    for stage, per_second, expected, regressed in rows:
+        result = results[stage]
+        change = f"{per_second / expected - 1:+.0%}" if expected else ''
+        lines.append(
+            f"{stage:<18} {result['items']:>8} {result['seconds']:>9.3f} {per_second:>11.1f} "
+            f"{expected if expected is not None else '-':>11} {change:>8}{'  REGRESSION' if regressed else ''}"
+        )
+    return '\n'.join(lines)
+
+
+def baseline_key(size, options):
+    """Baselines are kept per mailbox size and fake service settings"""
+    settings = ','.join(f'{name}={value}' for name, value in sorted(options.items()) if value)
+    return f'{size}' + (f'[{settings}]' if settings else '')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the processing stages on a synthetic mailbox')
+    parser.add_argument('--size', default='1k', help=f"messages: {', '.join(SIZES)} or a number (default: 1k)")
+    parser.add_argument('--seed', type=int, default=0, help='mailbox seed (default: 0)')
+    parser.add_argument('--rules', default=DEFAULT_RULES, help='rules file to evaluate')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per fake API request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='extra random seconds per request, up to this')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests failing with HTTP 500')
+    parser.add_argument('--quota', type=float, help='quota units per second before requests fail with HTTP 429')
+    parser.add_argument('--baselines', default=DEFAULT_BASELINES, help='baselines file')
+    parser.add_argument('--save-baseline', action='store_true', help='store this run as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown against the baseline before failing (default: 0.25)')
+    parser.add_argument('--json', metavar='PATH', help='also write the results as JSON')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    size = parse_size(args.size)
+    options = {'latency': args.latency, 'jitter': args.jitter, 'error_rate': args.error_rate,
+               'quota_per_second': args.quota}
+    key = baseline_key(size, options)
+
+    results = run_benchmarks(size, seed=args.seed, rules_file=args.rules, **options)
+    rows = compare(results, load_baselines(args.baselines).get(key), args.tolerance)
+    print(f"Mailbox {key}, seed {args.seed}")
+    print(format_results(results, rows))
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.save_baseline:
+        save_baseline(results, key, args.baselines)
+        print(f"Saved baseline {key} to {args.baselines}")
+        return 0
+    return 1 if any(row[3] for row in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
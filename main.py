@@ -1,9 +1,21 @@
+import argparse
 import logging
+import signal
+import threading
+import time
 
 from processor.actions import EmailActions
-from processor.authenticate import authenticate_gmail
+from processor.audit import install_signal_handlers
+from processor.authenticate import authenticate_gmail, build_service
+from processor.credentials import CredentialManager
 from processor.database import EmailDatabase
+from processor.metrics import metrics
+from processor.parse import fetch_history, list_message_ids, load_emails
+from processor.priority import Deadline, order_actions
+from processor.query import rules_query
+from processor.quota import QuotaAccountant
 from processor.rules import RuleEngine
+from processor.service import ServiceProxy
 
 logging.basicConfig(
     level=logging.INFO,
@@ -11,24 +23,165 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Seconds a one-shot run may spend getting ready (imports, auth, service, DB, rules) before we warn
+STARTUP_BUDGET = 1.0
+
 
 class GmailProcessor:
-    def __init__(self, rules_file='rules.json'):
+    def __init__(self, rules_file='rules.json', keep_alive=False, db_path='emails.db',
+                 token_path='token.json', credentials_path='credentials.json', batch_actions=False,
+                 pipeline_options=None, durable_queue=False, thread_mode=None,
+                 query_pushdown=False, refresh_labels=False, body_scan_limit=None, quota_options=None,
+                 deadline=None):
+        if pipeline_options is not None and not thread_mode and (durable_queue or batch_actions or refresh_labels):
+            raise ValueError("The pipeline can't be combined with a durable queue, batched actions or label refresh")
+        started = time.perf_counter()
         self.service = None
         self.actions = None
-        self.db = EmailDatabase()
-        self.rule_engine = RuleEngine(rules_file)
+        self.credential_manager = None
+        # QuotaAccountant settings (per_second, per_day, reserve); the accountant is installed on the service
+        self.quota_options = quota_options or {}
+        self.quota = None
+        self.token_path = token_path
+        self.credentials_path = credentials_path
+        self.batch_actions = batch_actions
+        # 'any' or 'latest' to evaluate and act on whole threads; None works message by message
+        self.thread_mode = thread_mode
+        # Pipeline settings (fetch_workers, action_workers, queue_size); None processes page by page
+        self.pipeline_options = pipeline_options
+        # List only the messages some rule could match instead of the whole mailbox
+        self.query_pushdown = query_pushdown
+        # Refresh stored emails' labels in one batched request per page and trust them for state checks
+        self.refresh_labels = refresh_labels
+        # Seconds a batch may take; work not started by then is left for the next run, most valuable first
+        self.deadline = deadline
+        self.db = EmailDatabase(db_path, keep_alive=keep_alive)
+        # With a durable queue, generated actions survive a crash and are resumed by the next run
+        self.action_queue = None
+        if durable_queue:
+            from processor.action_queue import ActionQueue
+            self.action_queue = ActionQueue(self.db)
+        self.rule_engine = RuleEngine(rules_file, label_registry=self.db.labels, body_scan_limit=body_scan_limit)
         self.authenticate()
+        self.startup_time = time.perf_counter() - started
+
+        if self.startup_time > STARTUP_BUDGET:
+            logger.warning(f"Startup took {self.startup_time:.2f}s (budget {STARTUP_BUDGET:.2f}s)")
+        else:
+            logger.info(f"Startup took {self.startup_time:.2f}s")
 
     def authenticate(self):
         """Authenticate with Gmail API"""
         try:
-            self.service = authenticate_gmail()
-            self.actions = EmailActions(self.service)
+            self.credential_manager = CredentialManager(self.token_path, self.credentials_path)
+            self.service = authenticate_gmail(self.credential_manager)
+            if isinstance(self.service, ServiceProxy):
+                self.quota = QuotaAccountant(**self.quota_options)
+                self.quota.load(self.db)
+                self.service.add_hook(self.quota)
+            self.actions = EmailActions(self.service, db=self.db)
+            if self.db.keep_alive:
+                # Long-running processes flush action records on the time threshold even when idle
+                self.actions.audit.start()
             logger.info("Authentication successful!")
         except Exception as e:
             logger.error(f"Authentication failed: {e}")
 
+    def new_service(self):
+        """Build another Gmail service for use on a separate thread.
+
+        It shares the credentials and the hooks of the main service.
+        """
+        service = build_service(self.credential_manager.get_credentials())
+        return ServiceProxy(service, hooks=self.service.hooks)
+
+    @classmethod
+    def for_account(cls, account):
+        """Build a processor for one entry of the accounts manifest"""
+        return cls(account['rules'], keep_alive=True, db_path=account['db'],
+                   token_path=account['token'], credentials_path=account['credentials'],
+                   batch_actions=account.get('batch_actions', False), deadline=account.get('deadline'))
+
+    def reload(self):
+        """Reload rules and drop cached label IDs, keeping the service and database"""
+        changes = self.rule_engine.reload()
+        if self.actions:
+            self.actions.clear_label_cache()
+        self._backfill_changes(changes)
+
+    def reload_if_changed(self):
+        """Reload rules if the rules file changed on disk"""
+        self._backfill_changes(self.rule_engine.reload_if_changed())
+
+    def _backfill_changes(self, changes):
+        if changes and (changes['added'] or changes['changed']):
+            self.backfill_rules(changes['added'] + changes['changed'])
+
+    def backfill_rules(self, rule_names=None):
+        """Apply rules to every stored email, leaving other rules alone.
+
+        Args:
+            rule_names (list): rules to apply; defaults to the rules whose
+                current version has not been applied to the archive yet
+
+        Returns:
+            Number of actions generated
+        """
+        if rule_names is None:
+            rule_names = self.rule_engine.pending_backfill(self.db)
+        if not rule_names:
+            logger.info("No rules need a backfill")
+            return 0
+
+        logger.info(f"Backfilling rules: {', '.join(rule_names)}")
+        actions_to_apply = self.rule_engine.backfill(self.db, rule_names)
+        self.execute_actions(actions_to_apply)
+
+        versions = self.rule_engine.rule_versions
+        self.db.set_rule_versions({name: versions[name] for name in rule_names if name in versions})
+        return len(actions_to_apply)
+
+    def search_query(self):
+        """Gmail search query used to list messages
+
+        With query pushdown this is derived from the rules (see
+        processor.query.rules_query); the rules are still evaluated locally.
+        """
+        if not self.query_pushdown:
+            return 'in:all'
+        query = rules_query(self.rule_engine.rules)
+        logger.debug(f"Search query: {query}")
+        return query
+
+    def execute_actions(self, actions_to_apply, ranks=None, deadline=None):
+        """Execute actions directly, or queue them and work through the durable queue
+
+        With the durable queue, actions left over from an interrupted run are
+        executed as well, highest ranked first.
+
+        Args:
+            actions_to_apply: actions, most valuable first
+            ranks: optional rank of each action (see processor.priority.order_actions)
+            deadline: optional Deadline; actions not started by then are skipped (or stay queued)
+
+        Returns:
+            Tuple of (successful, failed) actions
+        """
+        if self.action_queue is not None:
+            self.action_queue.enqueue(actions_to_apply, ranks=ranks)
+            return self.action_queue.drain(self.actions, batch=self.batch_actions, deadline=deadline)
+        return self.actions.execute_actions(actions_to_apply, batch=self.batch_actions, deadline=deadline)
+
+    def close(self):
+        """Flush pending action records, hand back leased actions and close the database"""
+        if self.actions:
+            self.actions.audit.close()
+        if self.action_queue is not None:
+            self.action_queue.release()
+        if self.quota is not None:
+            self.quota.save(self.db)
+        self.db.close()
+
     def process_emails(self, limit=10):
         """Process the email fetch and apply rules for those.
 
@@ -36,26 +189,422 @@ class GmailProcessor:
             limit (int):
 
         Returns:
-            True or False
+            Number of actions generated
         """
         if not self.service:
             exit(1)
         try:
             logger.info(f"Starting email processing (limit: {limit})")
+            deadline = Deadline(self.deadline)
+            if self.pipeline_options is not None and not self.thread_mode:
+                return self.process_pipelined(limit, deadline)['actions']
+            return self.process_batch(limit, deadline=deadline)['actions']
+
+        except Exception as e:
+            logger.error(f"Error in process_emails: {e}")
+            return 0
+        finally:
+            self.log_quota()
+
+    def quota_spent(self):
+        """Quota units spent by this processor so far (0 without an accountant)"""
+        return self.quota.spent if self.quota is not None else 0
+
+    def log_quota(self):
+        if self.quota is None:
+            return
+        summary = self.quota.summary()
+        budget = f" of {summary['per_day']}" if summary['per_day'] else ''
+        logger.info(f"Quota: {summary['units']} units this run, {summary['today']}{budget} today, "
+                    f"waited {summary['waited_seconds']:.1f}s, {summary['refused']} requests refused")
 
-            actions_to_apply = self.rule_engine.fetch_actions(self.service, limit)
+    def process_batch(self, limit=10, page_token=None, deadline=None):
+        """Fetch one page of emails, apply the rules and execute the actions.
 
-            if not actions_to_apply:
-                logger.info("No actions needed - all emails are already processed correctly")
-                return
+        Args:
+            limit (int): page size
+            page_token (str): page to process, from a previous batch
+            deadline: Deadline of the whole run (default: one of self.deadline seconds from now)
 
+        Returns:
+            Dictionary with 'emails', 'actions', 'succeeded', 'failed' counts
+            and the 'next_page_token' (None on the last page)
+        """
+        spent = self.quota_spent()
+        if deadline is None:
+            deadline = Deadline(self.deadline)
+        if self.thread_mode:
+            from processor.threads import ThreadProcessor
+            threads = ThreadProcessor(self.service, self.db, self.rule_engine, self.actions, mode=self.thread_mode)
+            result = threads.process_page(limit, page_token, query=self.search_query(), deadline=deadline)
+            result['quota_units'] = self.quota_spent() - spent
+            return result
+
+        with metrics.timed('stage_seconds', stage='fetch'):
+            email_ids, next_page_token = list_message_ids(self.service, self.search_query(), max_results=limit,
+                                                          page_token=page_token)
+            fresh = set()
+            emails = load_emails(self.service, email_ids, self.db, refresh=self.refresh_labels,
+                                 deadline=deadline, fresh=fresh) if email_ids else []
+            if self.refresh_labels:
+                # Emails whose refresh failed keep their stored labels; their state is checked live
+                self.actions.prime_labels([email for email in emails if email.id in fresh])
+        with metrics.timed('stage_seconds', stage='evaluate'):
+            actions_to_apply = self.rule_engine.get_actions_for_emails(emails)
+            actions_to_apply, ranks = order_actions(actions_to_apply, emails, self.rule_engine.rules)
+
+        if not actions_to_apply:
+            logger.info("No actions needed - all emails are already processed correctly")
+        else:
             logger.info(f"Executing {len(actions_to_apply)} actions...")
-            self.actions.execute_actions(actions_to_apply)
+        with metrics.timed('stage_seconds', stage='act'):
+            succeeded, failed = self.execute_actions(actions_to_apply, ranks, deadline)
+
+        return {
+            'emails': len(emails),
+            'actions': len(actions_to_apply),
+            'succeeded': succeeded,
+            'failed': failed,
+            'quota_units': self.quota_spent() - spent,
+            'next_page_token': next_page_token
+        }
+
+    def process_pipelined(self, limit=100, deadline=None):
+        """Fetch, evaluate and act on emails in overlapping stages.
+
+        Args:
+            limit (int): emails to process
+            deadline: Deadline of the run (default: one of self.deadline seconds from now)
+
+        Returns:
+            Pipeline counters (see Pipeline.run)
+        """
+        from processor.pipeline import Pipeline
+        pipeline = Pipeline(self.service, self.db, self.rule_engine, actions=self.actions,
+                            service_factory=self.new_service if self.credential_manager else None,
+                            **(self.pipeline_options or {}))
+        return pipeline.run(limit, query=self.search_query(),
+                            deadline=deadline if deadline is not None else Deadline(self.deadline))
+
+    def plan(self, limit=10, from_db=False):
+        """Work out what a run would do and what it would cost, without changing the mailbox.
+
+        Args:
+            limit (int): emails to fetch
+            from_db (bool): evaluate every stored email instead of fetching
+
+        Returns:
+            Plan dictionary (see processor.planner.build_plan)
+        """
+        from processor.planner import build_plan
+        if from_db:
+            emails = list(self.db.iter_emails())
+        else:
+            email_ids, _ = list_message_ids(self.service, self.search_query(), max_results=limit)
+            emails = load_emails(self.service, email_ids, self.db) if email_ids else []
+        actions_to_apply = self.rule_engine.get_actions_for_emails(emails)
+        return build_plan(actions_to_apply, self.actions, emails=len(emails))
+
+    def apply_plan(self, plan):
+        """Execute a saved plan
+
+        Returns:
+            Tuple of (successful, failed) action counts
+        """
+        from processor.planner import apply_plan
+        return apply_plan(plan, self.actions)
+
+    def start_watch(self, topic_name, label_ids=None):
+        """Register a Gmail push watch and remember its history ID as the sync point"""
+        from processor.push import register_watch
+        response = register_watch(self.service, topic_name, label_ids)
+        if self.db.get_state('history_id') is None:
+            self.db.set_state('history_id', response['historyId'])
+        return response
+
+    def process_history(self, history_id):
+        """Process only the messages that changed since the last sync point.
+
+        Args:
+            history_id (int): history ID carried by the push notification
 
+        Returns:
+            Number of actions generated
+        """
+        start_history_id = self.db.get_state('history_id')
+        if start_history_id is None:
+            logger.info(f"No sync point yet - starting from history {history_id}")
+            self.db.set_state('history_id', history_id)
+            return 0
+        if int(start_history_id) >= int(history_id):
+            return 0
+
+        try:
+            message_ids, latest_history_id = fetch_history(self.service, start_history_id)
         except Exception as e:
-            logger.error(f"Error in process_emails: {e}")
+            # History IDs expire after about a week; fall back to a regular poll
+            logger.error(f"Error reading history from {start_history_id}: {e}")
+            self.db.set_state('history_id', history_id)
+            return self.process_emails()
+
+        logger.info(f"History {start_history_id} -> {latest_history_id}: {len(message_ids)} changed messages")
+
+        actions_to_apply = []
+        if message_ids:
+            # Stored messages in the history were relabelled; pick up their new labels
+            fresh = set()
+            emails = load_emails(self.service, message_ids, self.db, refresh=True, fresh=fresh)
+            self.actions.prime_labels([email for email in emails if email.id in fresh])
+            actions_to_apply = self.rule_engine.get_actions_for_emails(emails)
+            self.execute_actions(actions_to_apply)
+
+        self.db.set_state('history_id', max(int(latest_history_id), int(history_id)))
+        return len(actions_to_apply)
+
+
+def parse_args(argv=None):
+    from processor.columnar import EXPORT_FORMATS
+    from processor.threads import THREAD_MODES
+    parser = argparse.ArgumentParser(description='Process Gmail messages against JSON rules')
+    parser.add_argument('--rules', default='rules.json', help='rules file (default: rules.json)')
+    parser.add_argument('--limit', type=int, default=10, help='emails to fetch per run (default: 10)')
+    parser.add_argument('--batch-actions', action='store_true',
+                        help='apply label changes with batchModify instead of one request per email')
+    parser.add_argument('--threads', choices=THREAD_MODES,
+                        help='evaluate rules once per thread (against any message or the latest one) '
+                             'and act on whole threads; --limit then counts threads')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='fetch, evaluate and act in concurrent stages instead of page by page')
+    parser.add_argument('--fetch-workers', type=int, default=4,
+                        help='threads fetching messages with --pipeline (default: 4)')
+    parser.add_argument('--action-workers', type=int, default=1,
+                        help='threads executing actions with --pipeline (default: 1)')
+    parser.add_argument('--queue-size', type=int, default=100,
+                        help='items each --pipeline stage may buffer (default: 100)')
+    parser.add_argument('--pushdown', action='store_true',
+                        help='list only messages the rules could match, using a Gmail search query')
+    parser.add_argument('--refresh-labels', action='store_true',
+                        help='refresh labels of stored emails with batched minimal requests each page')
+    parser.add_argument('--body-scan-limit', type=int, metavar='CHARS',
+                        help='body conditions only look at the first CHARS characters (default: whole body)')
+    parser.add_argument('--quota-per-second', type=float, default=250,
+                        help='Gmail quota units per second to stay under (default: 250)')
+    parser.add_argument('--quota-per-day', type=int, help='quota units this mailbox may use per day (default: no limit)')
+    parser.add_argument('--quota-reserve', type=float, default=0.2,
+                        help='share of the quota budget kept for actions over fetches (default: 0.2)')
+    parser.add_argument('--deadline', type=float, metavar='SECONDS',
+                        help='stop fetching and acting after SECONDS per batch; newest and unread mail '
+                             'and higher priority rules go first, the rest waits for the next run')
+    parser.add_argument('--daemon', action='store_true', help='keep running and poll the mailbox')
+    parser.add_argument('--interval', type=float, default=60,
+                        help='seconds between polls in daemon mode (default: 60)')
+    parser.add_argument('--max-interval', type=float, default=900,
+                        help='longest backoff between idle polls in daemon mode (default: 900)')
+    parser.add_argument('--backfill', action='store_true',
+                        help='apply new or changed rules to every stored email, then exit')
+    parser.add_argument('--profile-rules', action='store_true',
+                        help='replay the rules against stored emails (no Gmail access) and print a profile')
+    parser.add_argument('--export', metavar='DIR',
+                        help='write the stored emails and actions to DIR as Parquet or Arrow files and exit')
+    parser.add_argument('--export-format', choices=sorted(EXPORT_FORMATS), default='parquet',
+                        help='file format for --export (default: parquet)')
+    parser.add_argument('--export-check', action='store_true',
+                        help='with --export, count rule matches on the exported emails and check them '
+                             'against the rule engine')
+    parser.add_argument('--durable-queue', action='store_true',
+                        help='queue actions in emails.db and resume unfinished ones after a crash')
+    parser.add_argument('--queue-status', action='store_true', help='print the durable queue counts and exit')
+    parser.add_argument('--plan', metavar='PATH',
+                        help='write what a run would do, with its API calls and quota cost, to PATH and exit')
+    parser.add_argument('--plan-from-db', action='store_true',
+                        help='with --plan, evaluate the stored emails instead of fetching')
+    parser.add_argument('--apply-plan', metavar='PATH', help='execute a plan written by --plan and exit')
+    parser.add_argument('--accounts', help='accounts manifest (JSON); process every account in it')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='worker processes for --accounts (default: 4)')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve Prometheus metrics on this port in daemon and push modes')
+    parser.add_argument('--metrics-host', default='127.0.0.1', help='metrics bind address (default: 127.0.0.1)')
+    parser.add_argument('--metrics-json', metavar='PATH',
+                        help="write a JSON metrics summary at the end of a one-shot run ('-' for stdout)")
+    parser.add_argument('--push-topic', help='Pub/Sub topic to watch; enables push notification mode')
+    parser.add_argument('--push-host', default='127.0.0.1', help='push receiver bind address (default: 127.0.0.1)')
+    parser.add_argument('--push-port', type=int, default=8080, help='push receiver port (default: 8080)')
+    parser.add_argument('--push-token', help='shared secret expected as ?token= on push requests')
+    parser.add_argument('--debounce', type=float, default=2.0,
+                        help='seconds of quiet before a burst of notifications is processed (default: 2)')
+    args = parser.parse_args(argv)
+
+    # The pipeline executes actions one by one as they are generated; it can't queue or batch them
+    if args.pipeline and not args.threads:
+        unsupported = [flag for flag, value in (('--durable-queue', args.durable_queue),
+                                                ('--batch-actions', args.batch_actions),
+                                                ('--refresh-labels', args.refresh_labels)) if value]
+        if unsupported:
+            parser.error(f"--pipeline cannot be combined with {', '.join(unsupported)}")
+    return args
+
+
+def run_push(processor, args, renew_interval=24 * 3600):
+    """Serve push notifications until interrupted, renewing the watch daily"""
+    from processor.push import Debouncer, PushReceiver
+    debouncer = Debouncer(processor.process_history, delay=args.debounce)
+    receiver = PushReceiver(lambda notification: debouncer.submit(notification['historyId']),
+                            host=args.push_host, port=args.push_port, token=args.push_token)
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *a: stop.set())
+    signal.signal(signal.SIGINT, lambda *a: stop.set())
+
+    receiver.start()
+    try:
+        while not stop.is_set():
+            # Watches expire after 7 days
+            processor.start_watch(args.push_topic)
+            stop.wait(renew_interval)
+    finally:
+        receiver.stop()
+        debouncer.flush()
+
+
+def quota_options(args):
+    return {'per_second': args.quota_per_second, 'per_day': args.quota_per_day, 'reserve': args.quota_reserve}
+
+
+def pipeline_options(args):
+    if not args.pipeline:
+        return None
+    return {'fetch_workers': args.fetch_workers, 'action_workers': args.action_workers,
+            'queue_size': args.queue_size}
+
+
+def run_profile(args, db_path='emails.db'):
+    """Profile the rules against the stored emails and print the report"""
+    from processor.profiling import RuleProfiler, format_report, profile_rules
+    db = EmailDatabase(db_path)
+    rule_engine = RuleEngine(args.rules, label_registry=db.labels, profiler=RuleProfiler())
+    # One log line per match would drown the report
+    rules_logger = logging.getLogger('processor.rules')
+    level = rules_logger.level
+    rules_logger.setLevel(logging.WARNING)
+    try:
+        report, count, elapsed = profile_rules(rule_engine, db)
+    finally:
+        rules_logger.setLevel(level)
+    print(f"{len(rule_engine.rules)} rules against {count} stored emails in {elapsed:.2f}s")
+    print(format_report(report))
+    return report
+
+
+def run_export(args, db_path='emails.db'):
+    """Export the database for offline analysis and optionally check the vectorized rule evaluation"""
+    from processor.columnar import VectorizedEvaluator, compare_with_engine, export_database, read_table
+    db = EmailDatabase(db_path)
+    exported = export_database(db, args.export, args.export_format)
+    for table, (path, rows) in exported.items():
+        print(f"{table}: {rows} rows -> {path}")
+    if not args.export_check:
+        return exported
+
+    rule_engine = RuleEngine(args.rules, label_registry=db.labels)
+    table = read_table(exported['emails'][0])
+    masks = VectorizedEvaluator(rule_engine.rules).evaluate(table)
+    rules_logger = logging.getLogger('processor.rules')
+    level = rules_logger.level
+    rules_logger.setLevel(logging.WARNING)
+    try:
+        mismatches = compare_with_engine(rule_engine, table, masks)
+    finally:
+        rules_logger.setLevel(level)
+    for name, mask in masks.items():
+        matched = sum(1 for flag in mask.to_pylist() if flag)
+        print(f"{name}: {matched} of {table.num_rows} emails match, {len(mismatches[name])} disagree with the engine")
+    return exported
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.profile_rules:
+        run_profile(args)
+        return
+
+    if args.export:
+        run_export(args)
+        return
+
+    if args.queue_status:
+        from processor.action_queue import ActionQueue
+        counts = ActionQueue(EmailDatabase()).counts()
+        print(' '.join(f"{state}={count}" for state, count in counts.items()))
+        return
+
+    if args.accounts:
+        from processor.accounts import format_summary, load_accounts, process_accounts
+        summaries = process_accounts(load_accounts(args.accounts), GmailProcessor.for_account,
+                                     max_workers=args.workers)
+        print(format_summary(summaries))
+        return
+
+    metrics_server = None
+    if args.metrics_port and (args.push_topic or args.daemon):
+        from processor.metrics import MetricsServer
+        metrics_server = MetricsServer(host=args.metrics_host, port=args.metrics_port)
+        metrics_server.start()
+
+    if args.push_topic:
+        processor = GmailProcessor(args.rules, keep_alive=True, batch_actions=args.batch_actions,
+                                   durable_queue=args.durable_queue, quota_options=quota_options(args))
+        try:
+            run_push(processor, args)
+        finally:
+            processor.close()
+            if metrics_server:
+                metrics_server.stop()
+        return
+
+    if args.daemon:
+        from processor.daemon import PollingScheduler
+        processor = GmailProcessor(args.rules, keep_alive=True, batch_actions=args.batch_actions,
+                                   pipeline_options=pipeline_options(args), durable_queue=args.durable_queue,
+                                   thread_mode=args.threads, query_pushdown=args.pushdown,
+                                   refresh_labels=args.refresh_labels, body_scan_limit=args.body_scan_limit,
+                                   quota_options=quota_options(args), deadline=args.deadline)
+        scheduler = PollingScheduler(processor, interval=args.interval,
+                                     max_interval=args.max_interval, limit=args.limit)
+        scheduler.install_signal_handlers()
+        try:
+            scheduler.run()
+        finally:
+            processor.close()
+            if metrics_server:
+                metrics_server.stop()
+        return
+
+    install_signal_handlers()
+    processor = GmailProcessor(args.rules, batch_actions=args.batch_actions,
+                               pipeline_options=pipeline_options(args), durable_queue=args.durable_queue,
+                               thread_mode=args.threads, query_pushdown=args.pushdown,
+                               refresh_labels=args.refresh_labels, body_scan_limit=args.body_scan_limit,
+                               quota_options=quota_options(args), deadline=args.deadline)
+    try:
+        if args.plan:
+            from processor.planner import format_plan, save_plan
+            plan = processor.plan(limit=args.limit, from_db=args.plan_from_db)
+            save_plan(plan, args.plan)
+            print(format_plan(plan))
+        elif args.apply_plan:
+            from processor.planner import load_plan
+            processor.apply_plan(load_plan(args.apply_plan))
+        elif args.backfill:
+            processor.backfill_rules()
+        else:
+            processor.process_emails(limit=args.limit)
+    finally:
+        processor.close()
+        if args.metrics_json:
+            from processor.metrics import write_summary
+            write_summary(args.metrics_json)
 
 
 if __name__ == "__main__":
-    processor = GmailProcessor()
-    processor.process_emails()
+    main()
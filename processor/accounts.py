@@ -0,0 +1,184 @@
+import json
+import logging
+import multiprocessing.util
+import os
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from processor.priority import Deadline
+
+logger = logging.getLogger(__name__)
+
+ACCOUNT_DEFAULTS = {
+    'rules': 'rules.json',
+    'credentials': 'credentials.json',
+    'limit': 100,
+    'batch_size': 25
+}
+
+# Processors built in this worker process, reused across rounds of the same account
+_processors = {}
+
+
+def load_accounts(manifest_path):
+    """Load the accounts manifest
+
+    The manifest looks like::
+
+        {
+          "defaults": {"rules": "rules.json", "limit": 200},
+          "accounts": [
+            {"name": "support"},
+            {"name": "sales", "rules": "sales_rules.json", "limit": 50}
+          ]
+        }
+
+    Each account gets its own token and database shard, by default
+    ``accounts/<name>/token.json`` and ``accounts/<name>/emails.db``.
+
+    Returns:
+        List of account dictionaries with every setting filled in
+    """
+    with open(manifest_path, 'r') as file:
+        data = json.load(file)
+
+    defaults = {**ACCOUNT_DEFAULTS, **data.get('defaults', {})}
+    accounts = []
+    names = set()
+    for entry in data.get('accounts', []):
+        if 'name' not in entry:
+            raise ValueError(f"Account without a name in {manifest_path}: {entry}")
+        if entry['name'] in names:
+            raise ValueError(f"Duplicate account name in {manifest_path}: {entry['name']}")
+        names.add(entry['name'])
+
+        account = {**defaults, **entry}
+        account_dir = os.path.join('accounts', account['name'])
+        account.setdefault('token', os.path.join(account_dir, 'token.json'))
+        account.setdefault('db', os.path.join(account_dir, 'emails.db'))
+        os.makedirs(os.path.dirname(account['db']) or '.', exist_ok=True)
+        accounts.append(account)
+
+    logger.info(f"Loaded {len(accounts)} accounts from {manifest_path}")
+    return accounts
+
+
+def run_account_batch(processor_factory, account, limit, page_token=None, last=False, deadline=None):
+    """Process one batch of an account (runs in a worker process)
+
+    The processor is kept for the account's next batch, and closed once
+    the batch fails or is the account's last one.
+    """
+    processor = _processors.get(account['name'])
+    if processor is None:
+        processor = _processors[account['name']] = processor_factory(account)
+    done = True
+    try:
+        result = processor.process_batch(limit=limit, page_token=page_token, deadline=deadline)
+        done = last or not result['next_page_token'] or not result['emails']
+        return result
+    finally:
+        if done:
+            del _processors[account['name']]
+            processor.close()
+
+
+def close_processors():
+    """Close the processors kept in this process, e.g. of accounts that moved to another worker"""
+    while _processors:
+        name, processor = _processors.popitem()
+        try:
+            processor.close()
+        except Exception as e:
+            logger.error(f"Failed to close processor of account {name}: {e}")
+
+
+def _init_worker():
+    # Pool workers leave through os._exit, skipping atexit; multiprocessing finalizers still run
+    multiprocessing.util.Finalize(None, close_processors, exitpriority=0)
+
+
+def process_accounts(accounts, processor_factory, max_workers=4, executor_class=ProcessPoolExecutor):
+    """Work through every account in parallel, one batch at a time.
+
+    Accounts take turns: after each batch an account goes to the back of the
+    queue, so a large mailbox cannot hold every worker while small ones wait.
+    An account is done when its mailbox has no more pages, its ``limit`` is
+    reached, its ``deadline`` (seconds for all of its batches) expires or a
+    batch fails.
+
+    Args:
+        accounts: account dictionaries from load_accounts()
+        processor_factory: picklable callable building a processor from an account
+        max_workers: number of worker processes
+        executor_class: executor to use (a thread pool in tests)
+
+    Returns:
+        Dictionary of account name to summary
+    """
+    summaries = {account['name']: {
+        'emails': 0, 'actions': 0, 'succeeded': 0, 'failed': 0, 'quota_units': 0,
+        'batches': 0, 'error': None, 'elapsed': 0.0
+    } for account in accounts}
+
+    queue = deque({'account': account, 'page_token': None, 'remaining': account['limit'],
+                   'deadline': Deadline(account.get('deadline'))} for account in accounts)
+    running = {}
+
+    with executor_class(max_workers=max_workers, initializer=_init_worker) as executor:
+        while queue or running:
+            while queue and len(running) < max_workers:
+                state = queue.popleft()
+                account = state['account']
+                limit = min(account['batch_size'], state['remaining'])
+                state['started'] = time.perf_counter()
+                future = executor.submit(run_account_batch, processor_factory, account, limit, state['page_token'],
+                                         limit >= state['remaining'], state['deadline'])
+                running[future] = state
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                state = running.pop(future)
+                name = state['account']['name']
+                summary = summaries[name]
+                summary['batches'] += 1
+                summary['elapsed'] += time.perf_counter() - state['started']
+
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error(f"Account {name} failed: {e}")
+                    summary['error'] = str(e)
+                    continue
+
+                for key in ('emails', 'actions', 'succeeded', 'failed'):
+                    summary[key] += result[key]
+                summary['quota_units'] += result.get('quota_units', 0)
+
+                # In thread mode the limit counts threads
+                listed = result.get('threads', result['emails'])
+                state['remaining'] -= listed
+                state['page_token'] = result['next_page_token']
+                if state['page_token'] and state['remaining'] > 0 and listed:
+                    if state['deadline'].expired():
+                        logger.info(f"Account {name} reached its deadline - the rest is left for the next run")
+                    else:
+                        queue.append(state)
+
+    # With a thread pool the processors live in this process
+    close_processors()
+    return summaries
+
+
+def format_summary(summaries):
+    """Render account summaries as a text table"""
+    lines = [f"{'account':<24} {'emails':>7} {'actions':>8} {'ok':>6} {'failed':>7} {'units':>8} {'batches':>8} "
+             f"{'secs':>8}  error"]
+    for name, summary in sorted(summaries.items()):
+        lines.append(
+            f"{name:<24} {summary['emails']:>7} {summary['actions']:>8} {summary['succeeded']:>6} "
+            f"{summary['failed']:>7} {summary.get('quota_units', 0):>8} {summary['batches']:>8} "
+            f"{summary['elapsed']:>8.1f}  {summary['error'] or ''}"
+        )
+    return '\n'.join(lines)
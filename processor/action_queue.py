@@ -0,0 +1,242 @@
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+
+from processor.actions import EmailActions
+from processor.models import ActionItem
+from processor.quota import QuotaExceeded
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+IN_FLIGHT = 'in_flight'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def default_owner():
+    """A new lease owner name: host, process and a random suffix"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class ActionQueue:
+    """Durable queue of generated actions, kept in the action_queue table.
+
+    Rule evaluation enqueues actions; workers lease a batch, execute it and
+    mark each action done or failed. A lease that is not completed in
+    ``lease_seconds`` (the worker died) expires and the actions are handed
+    out again, so a crash costs only the actions that were in flight.
+    Failed actions are retried until they have been attempted
+    ``max_attempts`` times. Actions are leased highest rank first (see
+    processor.priority.action_rank), oldest first among equals.
+
+    The same action (email, rule, action type) is only ever queued once.
+    Leases are taken as ``owner``, one per queue instance, so actions leased
+    from any thread (e.g. push notification timers) are released on close.
+    """
+
+    def __init__(self, db, lease_seconds=300, max_attempts=3):
+        self.db = db
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.owner = default_owner()
+
+    def enqueue(self, actions_list, ranks=None):
+        """Add actions to the queue, ignoring ones queued before
+
+        Args:
+            actions_list: actions to queue
+            ranks: optional (rule priority, unread, received time) of each action
+
+        Returns:
+            Number of actions added
+        """
+        rows = []
+        for index, item in enumerate(actions_list):
+            item = ActionItem.coerce(item)
+            priority, unread, received_at = ranks[index] if ranks else (0, 0, 0.0)
+            rows.append((item.email_id, item.rule_name, EmailActions.action_type_for(item.action),
+                         json.dumps(item.action, sort_keys=True), priority, unread, received_at))
+        if not rows:
+            return 0
+
+        with self.db.connect() as conn:
+            with conn:
+                before = conn.total_changes
+                conn.executemany('''
+                    INSERT OR IGNORE INTO action_queue
+                    (email_id, rule_name, action_type, action, priority, unread, received_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', rows)
+                added = conn.total_changes - before
+        logger.info(f"Queued {added} actions ({len(rows) - added} already queued)")
+        return added
+
+    def lease(self, limit=100, owner=None):
+        """Claim up to limit pending actions, or in-flight ones whose lease expired
+
+        Returns:
+            List of (queue ID, ActionItem)
+        """
+        owner = owner or self.owner
+        now = time.time()
+        with self.db.connect() as conn:
+            if conn.in_transaction:
+                conn.commit()
+            # Take the write lock before reading so two workers never claim the same rows
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = conn.execute('''
+                    SELECT id, email_id, rule_name, action FROM action_queue
+                    WHERE state = ? OR (state = ? AND lease_expires < ?)
+                    ORDER BY priority DESC, unread DESC, received_at DESC, id LIMIT ?
+                ''', (PENDING, IN_FLIGHT, now, limit)).fetchall()
+                conn.executemany('''
+                    UPDATE action_queue
+                    SET state = ?, lease_owner = ?, lease_expires = ?, attempts = attempts + 1,
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                ''', [(IN_FLIGHT, owner, now + self.lease_seconds, row[0]) for row in rows])
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+        return [(row[0], ActionItem(row[2], json.loads(row[3]), row[1])) for row in rows]
+
+    def complete(self, queue_ids):
+        """Mark leased actions as done"""
+        if not queue_ids:
+            return
+        with self.db.connect() as conn:
+            with conn:
+                conn.executemany('''
+                    UPDATE action_queue SET state = ?, error = NULL, lease_owner = NULL,
+                        lease_expires = NULL, updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                ''', [(DONE, queue_id) for queue_id in queue_ids])
+
+    def fail(self, queue_ids, error=''):
+        """Return leased actions to the queue, or mark them failed after max_attempts
+
+        Returns:
+            Number of actions that ran out of attempts
+        """
+        if not queue_ids:
+            return 0
+        with self.db.connect() as conn:
+            with conn:
+                conn.executemany('''
+                    UPDATE action_queue
+                    SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END,
+                        error = ?, lease_owner = NULL, lease_expires = NULL, updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                ''', [(self.max_attempts, FAILED, PENDING, error, queue_id) for queue_id in queue_ids])
+                placeholders = ','.join('?' for _ in queue_ids)
+                return conn.execute(f'SELECT COUNT(*) FROM action_queue WHERE state = ? AND id IN ({placeholders})',
+                                    [FAILED, *queue_ids]).fetchone()[0]
+
+    def release(self, owner=None, queue_ids=None):
+        """Hand back actions leased by owner without counting an attempt (clean shutdown)
+
+        Args:
+            owner: lease owner (default: this queue's owner)
+            queue_ids: only these leased actions (default: every one)
+        """
+        owner = owner or self.owner
+        query = '''
+            UPDATE action_queue
+            SET state = ?, attempts = attempts - 1, lease_owner = NULL, lease_expires = NULL,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE state = ? AND lease_owner = ?
+        '''
+        params = [PENDING, IN_FLIGHT, owner]
+        if queue_ids is not None:
+            if not queue_ids:
+                return 0
+            query += f" AND id IN ({','.join('?' for _ in queue_ids)})"
+            params.extend(queue_ids)
+        with self.db.connect() as conn:
+            with conn:
+                cursor = conn.execute(query, params)
+        return cursor.rowcount
+
+    def counts(self):
+        """Number of queued actions in each state"""
+        with self.db.connect() as conn:
+            rows = conn.execute('SELECT state, COUNT(*) FROM action_queue GROUP BY state').fetchall()
+        counts = {PENDING: 0, IN_FLIGHT: 0, DONE: 0, FAILED: 0}
+        counts.update(dict(rows))
+        return counts
+
+    def drain(self, email_actions, batch=False, lease_size=100, owner=None, stop=None, deadline=None):
+        """Execute queued actions until none are left to lease
+
+        Args:
+            email_actions: EmailActions to execute with
+            batch: apply label changes with batchModify
+            lease_size: actions leased at a time
+            owner: lease owner (default: this queue's owner)
+            stop: optional threading.Event; when set the current lease is finished and the rest left queued
+            deadline: optional Deadline; once expired no more actions are started, and the
+                rest of the lease is handed back (a batched lease is finished)
+
+        Returns:
+            Tuple of (successful, failed) actions; actions that will be retried
+            are not counted as failed
+        """
+        owner = owner or self.owner
+        succeeded = failed = 0
+
+        while not (stop and stop.is_set()):
+            if deadline is not None and deadline.expired():
+                logger.info(f"Run deadline reached - leaving {self.counts()[PENDING]} actions queued")
+                break
+            leased = self.lease(lease_size, owner)
+            if not leased:
+                break
+
+            items = [item for _, item in leased]
+            try:
+                if batch:
+                    email_actions.execute_actions(items, batch=True)
+                    outcomes = [email_actions.action_already_performed(
+                        item.email_id, item.rule_name, email_actions.action_type_for(item.action)) for item in items]
+                else:
+                    outcomes = []
+                    for item in items:
+                        if deadline is not None and deadline.expired():
+                            break
+                        try:
+                            outcomes.append(email_actions.execute_action(item))
+                        except QuotaExceeded:
+                            raise
+                        except Exception as e:
+                            logger.error(f"Unexpected error executing action: {e}")
+                            outcomes.append(False)
+            except QuotaExceeded as e:
+                # Out of quota: keep what was done, hand the rest back for a later run
+                email_actions.audit.flush()
+                done = [queue_id for queue_id, item in leased if email_actions.action_already_performed(
+                    item.email_id, item.rule_name, email_actions.action_type_for(item.action))]
+                self.complete(done)
+                succeeded += len(done)
+                self.release(owner)
+                logger.warning(f"Stopping queue drain: {e}")
+                break
+            # Outcomes are in email_actions before the queue moves on
+            email_actions.audit.flush()
+
+            done = [queue_id for (queue_id, _), ok in zip(leased, outcomes) if ok]
+            not_done = [queue_id for (queue_id, _), ok in zip(leased, outcomes) if not ok]
+            self.complete(done)
+            succeeded += len(done)
+            failed += self.fail(not_done, 'Action failed')
+            if len(outcomes) < len(leased):
+                self.release(owner, [queue_id for queue_id, _ in leased[len(outcomes):]])
+                logger.info(f"Run deadline reached - leaving {self.counts()[PENDING]} actions queued")
+                break
+
+        return succeeded, failed
@@ -1,21 +1,64 @@
 import logging
 from googleapiclient.errors import HttpError
+from processor.audit import AuditWriter
 from processor.database import EmailDatabase
+from processor.labels import label_change_groups
+from processor.metrics import metrics
+from processor.models import ActionItem
+from processor.quota import QuotaExceeded
+
+# messages.batchModify accepts at most this many IDs per call
+BATCH_MODIFY_LIMIT = 1000
 
 logger = logging.getLogger(__name__)
 
 
 class EmailActions:
-    def __init__(self, gmail_service):
+    def __init__(self, gmail_service, db=None):
         self.service = gmail_service
-        self.db = EmailDatabase()
+        self.audit = None
+        self.db = db or EmailDatabase()
+        self.audit = AuditWriter(self.db)
+        self._label_ids = None
+        # Label state known to be current, used once instead of a live lookup
+        self._known_labels = {}
+
+    @property
+    def db(self):
+        return self._db
+
+    @db.setter
+    def db(self, db):
+        """Switch database, flushing buffered action records to the previous one first"""
+        if self.audit:
+            self.audit.flush()
+            self.audit.db = db
+        self._db = db
 
     def action_already_performed(self, email_id, rule_name, action_type):
-        """Check if action was already performed (database check first)"""
+        """Check if action was already performed (buffered records, then database)"""
+        if self.audit.is_recorded(email_id, rule_name, action_type):
+            return True
         return self.db.action_exists(email_id, rule_name, action_type)
 
+    def record_action(self, email_id, rule_name, action_type, action_details='', status='success'):
+        """Buffer an action record; it is written to the database in batches"""
+        metrics.inc('actions_total', type=metric_action_type(action_type), status=status)
+        return self.audit.record(email_id, rule_name, action_type, action_details, status)
+
+    def prime_labels(self, emails):
+        """Trust the labels of freshly fetched or refreshed emails for their next state check
+
+        Each email's labels are used once; later checks (after an action may
+        have changed them) ask Gmail again. Replaces previously primed labels.
+        """
+        self._known_labels = {email.id: list(email.labels) for email in emails}
+
     def get_email_labels(self, email_id):
         """Get current labels for an email"""
+        labels = self._known_labels.pop(email_id, None)
+        if labels is not None:
+            return labels
         try:
             message = self.service.users().messages().get(
                 userId='me',
@@ -29,33 +72,38 @@ class EmailActions:
             logger.error(f"Error getting labels for email {email_id}: {error}")
             return []
 
+    def get_email_label_mask(self, email_id):
+        """Get current labels for an email as a label bitmask"""
+        return self.db.labels.mask(self.get_email_labels(email_id))
+
     def is_email_read(self, email_id):
         """Check if email is already read"""
-        labels = self.get_email_labels(email_id)
-        return 'UNREAD' not in labels
+        return not self.db.labels.has(self.get_email_label_mask(email_id), 'UNREAD')
 
     def is_email_unread(self, email_id):
         """Check if email is already unread"""
-        labels = self.get_email_labels(email_id)
-        return 'UNREAD' in labels
+        return self.db.labels.has(self.get_email_label_mask(email_id), 'UNREAD')
+
+    def get_label_id(self, label_name):
+        """Look up a label ID by name, listing the mailbox labels once and caching them"""
+        if self._label_ids is None:
+            labels_result = self.service.users().labels().list(userId='me').execute()
+            self._label_ids = {label['name']: label['id'] for label in labels_result.get('labels', [])}
+        return self._label_ids.get(label_name)
+
+    def clear_label_cache(self):
+        """Forget cached label IDs so the next lookup lists labels again"""
+        self._label_ids = None
 
     def has_label(self, email_id, label_name):
         """Check if email already has a specific label"""
         try:
-            labels_result = self.service.users().labels().list(userId='me').execute()
-            all_labels = labels_result.get('labels', [])
-
-            target_label_id = None
-            for label in all_labels:
-                if label['name'] == label_name:
-                    target_label_id = label['id']
-                    break
+            target_label_id = self.get_label_id(label_name)
 
             if not target_label_id:
                 return False
 
-            email_labels = self.get_email_labels(email_id)
-            return target_label_id in email_labels
+            return self.db.labels.has(self.get_email_label_mask(email_id), target_label_id)
 
         except HttpError as error:
             logger.error(f"Error checking label for email {email_id}: {error}")
@@ -71,7 +119,7 @@ class EmailActions:
 
         if self.is_email_read(email_id):
             logger.info(f"Email {email_id} is already read - recording and skipping")
-            self.db.record_action(email_id, rule_name, action_type, 'Already read')
+            self.record_action(email_id, rule_name, action_type, 'Already read')
             return True
 
         try:
@@ -81,13 +129,13 @@ class EmailActions:
                 body={'removeLabelIds': ['UNREAD']}
             ).execute()
 
-            self.db.record_action(email_id, rule_name, action_type, 'Marked as read')
+            self.record_action(email_id, rule_name, action_type, 'Marked as read')
             logger.info(f"Marked email {email_id} as read and recorded in database")
             return True
 
         except HttpError as error:
             logger.error(f"Error marking email {email_id} as read: {error}")
-            self.db.record_action(email_id, rule_name, action_type, f'Error: {error}', 'failed')
+            self.record_action(email_id, rule_name, action_type, f'Error: {error}', 'failed')
             return False
 
     def mark_as_unread(self, email_id, rule_name):
@@ -100,7 +148,7 @@ class EmailActions:
 
         if self.is_email_unread(email_id):
             logger.info(f"Email {email_id} is already unread - recording and skipping")
-            self.db.record_action(email_id, rule_name, action_type, 'Already unread')
+            self.record_action(email_id, rule_name, action_type, 'Already unread')
             return True
 
         try:
@@ -110,13 +158,13 @@ class EmailActions:
                 body={'addLabelIds': ['UNREAD']}
             ).execute()
 
-            self.db.record_action(email_id, rule_name, action_type, 'Marked as unread')
+            self.record_action(email_id, rule_name, action_type, 'Marked as unread')
             logger.info(f"Marked email {email_id} as unread and recorded in database")
             return True
 
         except HttpError as error:
             logger.error(f"Error marking email {email_id} as unread: {error}")
-            self.db.record_action(email_id, rule_name, action_type, f'Error: {error}', 'failed')
+            self.record_action(email_id, rule_name, action_type, f'Error: {error}', 'failed')
             return False
 
     def move_to_inbox(self, email_id, rule_name):
@@ -127,10 +175,9 @@ class EmailActions:
             logger.info(f"Action '{action_type}' already recorded in database for email {email_id} - skipping")
             return True
 
-        email_labels = self.get_email_labels(email_id)
-        if 'INBOX' in email_labels:
+        if self.db.labels.has(self.get_email_label_mask(email_id), 'INBOX'):
             logger.info(f"Email {email_id} is already in inbox - recording and skipping")
-            self.db.record_action(email_id, rule_name, action_type, 'Already in inbox')
+            self.record_action(email_id, rule_name, action_type, 'Already in inbox')
             return True
 
         try:
@@ -140,13 +187,13 @@ class EmailActions:
                 body={'addLabelIds': ['INBOX']}
             ).execute()
 
-            self.db.record_action(email_id, rule_name, action_type, 'Moved to inbox')
+            self.record_action(email_id, rule_name, action_type, 'Moved to inbox')
             logger.info(f"Moved email {email_id} to inbox and recorded in database")
             return True
 
         except HttpError as error:
             logger.error(f"Error moving email {email_id} to inbox: {error}")
-            self.db.record_action(email_id, rule_name, action_type, f'Error: {error}', 'failed')
+            self.record_action(email_id, rule_name, action_type, f'Error: {error}', 'failed')
             return False
 
     def move_to_label(self, email_id, rule_name, label_name):
@@ -159,13 +206,13 @@ class EmailActions:
 
         if self.has_label(email_id, label_name):
             logger.info(f"Email {email_id} already has label '{label_name}' - recording and skipping")
-            self.db.record_action(email_id, rule_name, action_type, f'Already has label {label_name}')
+            self.record_action(email_id, rule_name, action_type, f'Already has label {label_name}')
             return True
 
         try:
             label_id = self.get_or_create_label(label_name)
             if not label_id:
-                self.db.record_action(email_id, rule_name, action_type, f'Failed to create label {label_name}', 'failed')
+                self.record_action(email_id, rule_name, action_type, f'Failed to create label {label_name}', 'failed')
                 return False
 
             self.service.users().messages().modify(
@@ -174,24 +221,21 @@ class EmailActions:
                 body={'addLabelIds': [label_id]}
             ).execute()
 
-            self.db.record_action(email_id, rule_name, action_type, f'Added label {label_name}')
+            self.record_action(email_id, rule_name, action_type, f'Added label {label_name}')
             logger.info(f"Added label '{label_name}' to email {email_id} and recorded in database")
             return True
 
         except HttpError as error:
             logger.error(f"Error adding label {label_name} to email {email_id}: {error}")
-            self.db.record_action(email_id, rule_name, action_type, f'Error: {error}', 'failed')
+            self.record_action(email_id, rule_name, action_type, f'Error: {error}', 'failed')
             return False
 
     def get_or_create_label(self, label_name):
         """Get label ID by name, or create if it doesn't exist"""
         try:
-            results = self.service.users().labels().list(userId='me').execute()
-            labels = results.get('labels', [])
-
-            for label in labels:
-                if label['name'] == label_name:
-                    return label['id']
+            label_id = self.get_label_id(label_name)
+            if label_id:
+                return label_id
 
             label_object = {
                 'name': label_name,
@@ -205,6 +249,7 @@ class EmailActions:
             ).execute()
 
             logger.info(f"Created new label: {label_name}")
+            self._label_ids[label_name] = created_label['id']
             return created_label['id']
 
         except HttpError as error:
@@ -213,9 +258,10 @@ class EmailActions:
 
     def execute_action(self, action_item):
         """Execute a single action on an email"""
-        email_id = action_item['email_id']
-        rule_name = action_item['rule_name']
-        action = action_item['action']
+        action_item = ActionItem.coerce(action_item)
+        email_id = action_item.email_id
+        rule_name = action_item.rule_name
+        action = action_item.action
         action_type = action['type']
 
         logger.info(f"Executing action '{action_type}' on email {email_id}")
@@ -237,30 +283,151 @@ class EmailActions:
 
         else:
             logger.warning(f"Unknown action type: {action_type}")
-            self.db.record_action(email_id, rule_name, action_type, f'Unknown action type', 'failed')
+            self.record_action(email_id, rule_name, action_type, f'Unknown action type', 'failed')
             return False
 
-    def execute_actions(self, actions_list):
-        """Execute multiple actions with database tracking"""
+    @staticmethod
+    def action_type_for(action):
+        """Name under which an action is recorded in the database"""
+        action_type = action['type']
+        if action_type == 'move_message':
+            folder = action.get('folder', 'INBOX')
+            if folder.upper() in ('INBOX', 'TRASH'):
+                return f'move_to_{folder.lower()}'
+            return f'move_to_{folder}'
+        return action_type
+
+    def label_change(self, action):
+        """Labels an action adds and removes, or None if it is not a pure label change
+
+        Returns:
+            Tuple of (label IDs to add, label IDs to remove)
+        """
+        action_type = action['type']
+        if action_type == 'mark_as_read':
+            return [], ['UNREAD']
+        if action_type == 'mark_as_unread':
+            return ['UNREAD'], []
+        if action_type == 'move_message':
+            folder = action.get('folder', 'INBOX')
+            if folder.upper() == 'INBOX':
+                return ['INBOX'], []
+            if folder.upper() == 'TRASH':
+                return None
+            label_id = self.get_or_create_label(folder)
+            return ([label_id], []) if label_id else None
+        return None
+
+    def execute_batched(self, actions_list, deadline=None):
+        """Apply label-changing actions with as few batchModify calls as possible.
+
+        Actions are grouped by the label bitmasks they add and remove; each
+        group is sent in chunks of up to 1000 messages. Gmail state is not
+        checked first: adding a label an email already has is a no-op.
+        Groups go in the order of their first action, and once the deadline
+        expires no more chunks are sent.
+
+        Returns:
+            Tuple of (successful, failed, actions that are not label changes)
+        """
+        registry = self.db.labels
+        success_count = 0
+        failed_count = 0
+        other_actions = []
+        changes = []
+        items_by_change = {}
+
+        for action_item in actions_list:
+            action_item = ActionItem.coerce(action_item)
+            action_type = self.action_type_for(action_item.action)
+            if self.action_already_performed(action_item.email_id, action_item.rule_name, action_type):
+                success_count += 1
+                continue
+
+            change = self.label_change(action_item.action)
+            if change is None:
+                other_actions.append(action_item)
+                continue
+
+            key = (action_item.email_id, registry.mask(change[0]), registry.mask(change[1]))
+            changes.append(key)
+            items_by_change.setdefault(key, []).append((action_item, action_type))
+
+        chunks = [(add_mask, remove_mask, email_ids[start:start + BATCH_MODIFY_LIMIT])
+                  for (add_mask, remove_mask), email_ids in label_change_groups(changes).items()
+                  for start in range(0, len(email_ids), BATCH_MODIFY_LIMIT)]
+        for index, (add_mask, remove_mask, chunk) in enumerate(chunks):
+            if deadline is not None and deadline.expired():
+                left = sum(len(ids) for _, _, ids in chunks[index:])
+                logger.info(f"Run deadline reached - label changes of {left} emails left for the next run")
+                break
+            try:
+                self.service.users().messages().batchModify(
+                    userId='me',
+                    body={
+                        'ids': chunk,
+                        'addLabelIds': registry.labels(add_mask),
+                        'removeLabelIds': registry.labels(remove_mask)
+                    }
+                ).execute()
+                status, details = 'success', 'Applied in batch'
+            except HttpError as error:
+                logger.error(f"Error applying batch of {len(chunk)} label changes: {error}")
+                status, details = 'failed', f'Error: {error}'
+
+            for email_id in chunk:
+                for action_item, action_type in items_by_change[(email_id, add_mask, remove_mask)]:
+                    self.record_action(email_id, action_item.rule_name, action_type, details, status)
+                    if status == 'success':
+                        success_count += 1
+                    else:
+                        failed_count += 1
+
+        logger.info(f"Batched label changes: {success_count} successful, {failed_count} failed, "
+                    f"{len(other_actions)} left for individual execution")
+        return success_count, failed_count, other_actions
+
+    def execute_actions(self, actions_list, batch=False, deadline=None):
+        """Execute multiple actions with database tracking
+
+        Args:
+            actions_list: actions to execute, most important first
+            batch: apply label changes with batchModify instead of one call per action
+            deadline: optional Deadline; actions not started before it expires are skipped
+
+        Returns:
+            Tuple of (successful, failed) actions
+        """
         if not actions_list:
             logger.info("No actions to execute")
-            return
+            return 0, 0
 
         logger.info(f"Executing {len(actions_list)} actions")
 
         success_count = 0
         failed_count = 0
 
-        for action_item in actions_list:
-            try:
-                result = self.execute_action(action_item)
-                if result:
-                    success_count += 1
-                else:
+        try:
+            if batch:
+                success_count, failed_count, actions_list = self.execute_batched(actions_list, deadline)
+
+            for index, action_item in enumerate(actions_list):
+                if deadline is not None and deadline.expired():
+                    logger.info(f"Run deadline reached - {len(actions_list) - index} actions left for the next run")
+                    break
+                try:
+                    result = self.execute_action(action_item)
+                    if result:
+                        success_count += 1
+                    else:
+                        failed_count += 1
+                except QuotaExceeded:
+                    raise
+                except Exception as e:
+                    logger.error(f"Unexpected error executing action: {e}")
                     failed_count += 1
-            except Exception as e:
-                logger.error(f"Unexpected error executing action: {e}")
-                failed_count += 1
+        finally:
+            self.audit.flush()
 
         logger.info(f"Actions completed: {success_count} successful, {failed_count} failed")
 
@@ -280,11 +447,18 @@ class EmailActions:
                 id=email_id
             ).execute()
 
-            self.db.record_action(email_id, rule_name, action_type, 'Moved to trash')
+            self.record_action(email_id, rule_name, action_type, 'Moved to trash')
             logger.info(f"Moved email {email_id} to trash and recorded in database")
             return True
 
         except HttpError as error:
             logger.error(f"Error moving email {email_id} to trash: {error}")
-            self.db.record_action(email_id, rule_name, action_type, f'Error: {error}', 'failed')
+            self.record_action(email_id, rule_name, action_type, f'Error: {error}', 'failed')
             return False
+
+
+def metric_action_type(action_type):
+    """Action type for metric labels, folding user label names into one value"""
+    if action_type.startswith('move_to_') and action_type not in ('move_to_inbox', 'move_to_trash'):
+        return 'move_to_label'
+    return action_type
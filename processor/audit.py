@@ -0,0 +1,134 @@
+import atexit
+import logging
+import signal
+import threading
+import time
+import weakref
+
+logger = logging.getLogger(__name__)
+
+_writers = weakref.WeakSet()
+
+
+class AuditWriter:
+    """Buffer action records in memory and write them to the database in batches.
+
+    Records are flushed when the buffer reaches ``batch_size``, when
+    ``flush_interval`` seconds have passed since the last flush, on an explicit
+    ``flush()`` and at interpreter exit. All methods are safe to call from
+    several threads.
+    """
+
+    def __init__(self, db, batch_size=100, flush_interval=5.0):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._stop = threading.Event()
+        self._thread = None
+        _writers.add(self)
+
+    def record(self, email_id, rule_name, action_type, action_details='', status='success'):
+        """Buffer an action record, flushing if a threshold was reached"""
+        key = (email_id, rule_name, action_type)
+        with self._lock:
+            # Later records replace earlier ones, same as INSERT OR REPLACE on the table
+            self._pending.pop(key, None)
+            self._pending[key] = (email_id, rule_name, action_type, action_details, status)
+            due = (len(self._pending) >= self.batch_size
+                   or time.monotonic() - self._last_flush >= self.flush_interval)
+
+        if due:
+            self.flush()
+        return True
+
+    def is_recorded(self, email_id, rule_name, action_type):
+        """Check if a successful action is waiting in the buffer"""
+        with self._lock:
+            record = self._pending.get((email_id, rule_name, action_type))
+        return record is not None and record[4] == 'success'
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        """Write all buffered records to the database
+
+        Returns:
+            Number of records written
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch = self._pending
+                self._pending = {}
+                self._last_flush = time.monotonic()
+
+            if not batch:
+                return 0
+
+            try:
+                return self.db.record_actions(batch.values())
+            except BaseException as e:
+                with self._lock:
+                    # Keep records that were not superseded while we were writing
+                    for key, record in batch.items():
+                        self._pending.setdefault(key, record)
+                if not isinstance(e, Exception):
+                    # Interrupted (SystemExit, KeyboardInterrupt): the records are flushed while unwinding
+                    raise
+                logger.error(f"Error flushing {len(batch)} action records: {e}")
+                return 0
+
+    def start(self):
+        """Start a background thread that flushes on the time threshold"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='audit-writer', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        """Stop the background thread and flush what is left"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+
+def flush_all():
+    """Flush every live audit writer"""
+    for writer in list(_writers):
+        writer.flush()
+
+
+def install_signal_handlers(signals=(signal.SIGTERM, signal.SIGINT)):
+    """Make termination signals unwind the process so audit records get flushed.
+
+    The handler takes no locks (the signal may arrive while the main thread
+    holds a writer's lock): it only runs the previous handler. A default
+    SIGTERM raises SystemExit instead of killing the process, so ``finally``
+    blocks close the processor and the atexit hook flushes what is left. Must be called from the main thread.
+    """
+    for signum in signals:
+        previous = signal.getsignal(signum)
+
+        def handler(received, frame, previous=previous):
+            if callable(previous):
+                previous(received, frame)
+            elif previous == signal.SIG_DFL:
+                signal.signal(received, signal.SIG_DFL)
+                raise SystemExit(128 + received)
+
+        signal.signal(signum, handler)
+
+
+atexit.register(flush_all)
@@ -1,28 +1,108 @@
+import json
+import logging
 import os
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
 
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
 
+API_NAME = 'gmail'
+API_VERSION = 'v1'
+DISCOVERY_URL = 'https://gmail.googleapis.com/$discovery/rest?version=v1'
+DISCOVERY_CACHE = os.path.join('.cache', 'gmail.v1.discovery.json')
+DISCOVERY_MAX_AGE = 7 * 24 * 3600
+
+
+def _client_version():
+    from googleapiclient.version import __version__
+    return __version__
+
+
+def _retrieve_discovery_document():
+    """Get the discovery document from the client library, or over HTTP if it isn't bundled"""
+    from googleapiclient.discovery_cache import get_static_doc
+
+    content = get_static_doc(API_NAME, API_VERSION)
+    if content is None:
+        import httplib2
+        response, content = httplib2.Http(timeout=30).request(DISCOVERY_URL)
+        if response.status != 200:
+            raise RuntimeError(f"Could not fetch discovery document: HTTP {response.status}")
+    return json.loads(content)
+
+
+def write_atomic(path, content):
+    """Write a file by replacing it, so readers never see a partial file"""
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as file:
+            file.write(content)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def load_discovery_document(cache_path=DISCOVERY_CACHE, max_age=DISCOVERY_MAX_AGE):
+    """Load the Gmail discovery document, caching it on disk.
+
+    The cache is used while it was written by the installed client library
+    version and is younger than max_age seconds.
+
+    Returns:
+        Discovery document as a dictionary
+    """
+    client_version = _client_version()
+
+    try:
+        with open(cache_path, 'r') as file:
+            cached = json.load(file)
+        if (cached.get('client_version') == client_version
+                and cached.get('api_version') == API_VERSION
+                and time.time() - cached.get('cached_at', 0) < max_age):
+            return cached['document']
+        logger.info("Discovery document cache is stale - refreshing")
+    except (OSError, ValueError, KeyError):
+        pass
+
+    document = _retrieve_discovery_document()
+    try:
+        write_atomic(cache_path, json.dumps({
+            'client_version': client_version,
+            'api_version': API_VERSION,
+            'revision': document.get('revision'),
+            'cached_at': time.time(),
+            'document': document
+        }))
+    except OSError as e:
+        logger.warning(f"Could not cache discovery document: {e}")
+    return document
+
+
+def build_service(creds, cache_path=DISCOVERY_CACHE):
+    """Build the Gmail service from the cached discovery document"""
+    from googleapiclient.discovery import build_from_document
+
+    return build_from_document(load_discovery_document(cache_path), credentials=creds)
+
+
+def authenticate_gmail(credential_manager=None):
+    """Authenticate with Gmail API and return service object
+
+    Every request made through the returned service first makes sure the
+    shared access token is fresh, and is counted and timed in the metrics.
+
+    Args:
+        credential_manager: CredentialManager to use (default: token.json / credentials.json)
+    """
+    from processor.credentials import CredentialManager
+    from processor.metrics import ApiMetrics
+    from processor.service import ServiceProxy
 
-def authenticate_gmail():
-    """Authenticate with Gmail API and return service object"""
-    creds = None
-    
-    if os.path.exists('token.json'):
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-    
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
-        
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
-    
-    service = build('gmail', 'v1', credentials=creds)
-    return service
+    manager = credential_manager or CredentialManager()
+    service = build_service(manager.get_credentials())
+    return ServiceProxy(service, hooks=[manager, ApiMetrics()])
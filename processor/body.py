@@ -0,0 +1,83 @@
+import base64
+
+# Body conditions look at no more than this many characters (bytes for undecoded bodies); None scans everything
+DEFAULT_SCAN_LIMIT = None
+
+# Bodies are lowercased and searched this much at a time, so no full-size copy is ever made
+SCAN_CHUNK = 1 << 16
+
+# base64 characters decoded at a time (a multiple of 4)
+DECODE_CHUNK = 1 << 18
+
+
+def decode_part(data):
+    """Decode a base64url message part into bytes, without decoding the text
+
+    Large parts are decoded a slice at a time into a bytearray, so apart from
+    the result no full-size intermediate copies are made.
+    """
+    if len(data) <= DECODE_CHUNK:
+        return base64.urlsafe_b64decode(data)
+    decoded = bytearray()
+    for start in range(0, len(data), DECODE_CHUNK):
+        decoded += base64.urlsafe_b64decode(data[start:start + DECODE_CHUNK])
+    return decoded
+
+
+def decode_text(data):
+    """Body text from decoded part bytes; invalid UTF-8 is replaced rather than failing the email"""
+    if isinstance(data, str):
+        return data
+    return str(data, 'utf-8', 'replace')
+
+
+def _haystack(text, value):
+    """The text to search, decoding bytes only when the value is not ASCII"""
+    if isinstance(text, str) or value.isascii():
+        return text
+    return decode_text(text)
+
+
+def text_contains(text, value, limit=DEFAULT_SCAN_LIMIT):
+    """Case-insensitive substring test without lowercasing the whole text
+
+    Bytes are matched directly for ASCII values (only ASCII letters are
+    folded); other values make the bytes be decoded first.
+
+    Args:
+        text: str, bytes or memoryview
+        value: substring to look for
+        limit: only look at the first limit characters (bytes for bytes input)
+    """
+    text = _haystack(text, value)
+    needle = value.lower()
+    if not isinstance(text, str):
+        needle = needle.encode('ascii')
+
+    end = len(text) if limit is None else min(limit, len(text))
+    if end <= SCAN_CHUNK:
+        return needle in _lower(text[:end])
+
+    # Consecutive chunks overlap by len(needle) - 1 so matches across a boundary are found
+    overlap = max(len(needle) - 1, 0)
+    for start in range(0, end, SCAN_CHUNK):
+        chunk = text[start:min(start + SCAN_CHUNK + overlap, end)]
+        if needle in _lower(chunk):
+            return True
+    return False
+
+
+def text_equals(text, value):
+    """Case-insensitive equality test without lowercasing a text that is too long to match"""
+    text = _haystack(text, value)
+    needle = value.lower()
+    if not isinstance(text, str):
+        needle = needle.encode('ascii')
+    # Lowercasing never makes a text shorter
+    if len(text) > len(needle):
+        return False
+    return _lower(text) == needle
+
+
+def _lower(chunk):
+    return bytes(chunk).lower() if isinstance(chunk, memoryview) else chunk.lower()
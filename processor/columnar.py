@@ -0,0 +1,352 @@
+import email.utils
+import logging
+import os
+import re
+import time
+from contextlib import contextmanager
+
+from processor.body import decode_text
+from processor.models import EmailRecord
+from processor.query import DATE_UNITS
+
+logger = logging.getLogger(__name__)
+
+# Rows read from SQLite and written as one record batch
+EXPORT_CHUNK = 10000
+
+EXPORT_FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+# Columns of the exported tables, in order; received_at is the parsed Date
+# header in epoch seconds (null when it can't be parsed) and labels a list
+EMAIL_COLUMNS = ('id', 'thread_id', 'from_email', 'to_email', 'subject', 'body', 'date_received',
+                 'received_at', 'is_read', 'labels', 'snippet', 'history_id')
+ACTION_COLUMNS = ('id', 'email_id', 'rule_name', 'action_type', 'action_details', 'executed_at', 'status')
+
+# Rule field -> (exported column, compared case-insensitively), as in processor.rules.FIELD_ATTRS
+FIELD_COLUMNS = {
+    'from': ('from_email', True),
+    'to': ('to_email', True),
+    'subject': ('subject', True),
+    'body': ('body', True),
+    'date_received': ('date_received', False)
+}
+
+
+def _pyarrow():
+    """Import pyarrow on first use; only the export and the vectorized evaluator need it"""
+    try:
+        import pyarrow
+        import pyarrow.compute  # noqa: F401 (loads the compute kernels)
+    except ImportError as e:
+        raise ImportError("Columnar export needs pyarrow: pip install pyarrow") from e
+    return pyarrow
+
+
+def email_schema():
+    pa = _pyarrow()
+    return pa.schema([
+        ('id', pa.string()), ('thread_id', pa.string()), ('from_email', pa.string()),
+        ('to_email', pa.string()), ('subject', pa.string()), ('body', pa.string()),
+        ('date_received', pa.string()), ('received_at', pa.float64()), ('is_read', pa.bool_()),
+        ('labels', pa.list_(pa.string())), ('snippet', pa.string()), ('history_id', pa.string())
+    ])
+
+
+def action_schema():
+    pa = _pyarrow()
+    return pa.schema([
+        ('id', pa.int64()), ('email_id', pa.string()), ('rule_name', pa.string()), ('action_type', pa.string()),
+        ('action_details', pa.string()), ('executed_at', pa.string()), ('status', pa.string())
+    ])
+
+
+def received_at(date_str):
+    """Epoch seconds of a Date header, or None if it can't be parsed"""
+    try:
+        return email.utils.parsedate_to_datetime(date_str).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def _email_columns(rows):
+    columns = {name: [] for name in EMAIL_COLUMNS}
+    for email_id, thread_id, from_email, to_email, subject, body, date, is_read, labels, snippet, history_id in rows:
+        columns['id'].append(email_id)
+        columns['thread_id'].append(thread_id)
+        columns['from_email'].append(from_email)
+        columns['to_email'].append(to_email)
+        columns['subject'].append(subject)
+        columns['body'].append(body if body is None or isinstance(body, str) else decode_text(body))
+        columns['date_received'].append(date)
+        columns['received_at'].append(received_at(date))
+        columns['is_read'].append(bool(is_read))
+        columns['labels'].append(labels.split(',') if labels else [])
+        columns['snippet'].append(snippet)
+        columns['history_id'].append(history_id)
+    return columns
+
+
+def _action_columns(rows):
+    return {name: [row[index] for row in rows] for index, name in enumerate(ACTION_COLUMNS)}
+
+
+# Exported table -> (SELECT statement for the chunk after a rowid, schema, row converter).
+# The rowid comes first and is not passed to the converter.
+TABLES = {
+    'emails': ('''
+        SELECT rowid, id, thread_id, from_email, to_email, subject, body,
+               date_received, is_read, labels, snippet, history_id
+        FROM emails WHERE rowid > ? ORDER BY rowid LIMIT ?
+    ''', email_schema, _email_columns),
+    'email_actions': (f'''
+        SELECT rowid, {', '.join(ACTION_COLUMNS)} FROM email_actions WHERE rowid > ? ORDER BY rowid LIMIT ?
+    ''', action_schema, _action_columns)
+}
+
+
+def iter_record_batches(db, table='emails', chunk_size=EXPORT_CHUNK):
+    """Yield a table of the database as Arrow record batches of up to chunk_size rows
+
+    Each chunk is read with its own short connect(), continuing after the
+    last rowid read, so a shared connection is not held while the caller
+    writes the batch.
+    """
+    pa = _pyarrow()
+    query, schema, convert = TABLES[table]
+    schema = schema()
+    last_rowid = 0
+    while True:
+        with db.connect() as conn:
+            rows = conn.execute(query, (last_rowid, chunk_size)).fetchall()
+        if not rows:
+            break
+        last_rowid = rows[-1][0]
+        yield pa.RecordBatch.from_pydict(convert([row[1:] for row in rows]), schema=schema)
+
+
+@contextmanager
+def _batch_writer(path, schema, export_format):
+    """Yield a function writing one record batch to a Parquet or Arrow IPC file"""
+    pa = _pyarrow()
+    if export_format == 'parquet':
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(path, schema)
+        try:
+            yield lambda batch: writer.write_table(pa.Table.from_batches([batch], schema=schema))
+        finally:
+            writer.close()
+        return
+
+    with pa.OSFile(path, 'wb') as sink:
+        writer = pa.ipc.new_file(sink, schema)
+        try:
+            yield writer.write_batch
+        finally:
+            writer.close()
+
+
+def export_table(db, table, path, export_format='parquet', chunk_size=EXPORT_CHUNK):
+    """Stream one table of the database to a Parquet or Arrow file, chunk_size rows at a time
+
+    Returns:
+        Number of rows written
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {export_format}")
+    schema = TABLES[table][1]()
+    rows = 0
+    with _batch_writer(path, schema, export_format) as write:
+        for batch in iter_record_batches(db, table, chunk_size):
+            write(batch)
+            rows += batch.num_rows
+    logger.info(f"Exported {rows} rows of {table} to {path}")
+    return rows
+
+
+def export_database(db, directory, export_format='parquet', chunk_size=EXPORT_CHUNK):
+    """Export the emails and email_actions tables to <directory>/<table>.<format>
+
+    Returns:
+        Dictionary of table name to (path, rows written)
+    """
+    os.makedirs(directory, exist_ok=True)
+    exported = {}
+    for table in TABLES:
+        path = os.path.join(directory, table + EXPORT_FORMATS[export_format])
+        exported[table] = (path, export_table(db, table, path, export_format, chunk_size))
+    return exported
+
+
+def read_table(path):
+    """Read an exported Parquet or Arrow file (Arrow files are memory-mapped)"""
+    pa = _pyarrow()
+    if path.endswith(EXPORT_FORMATS['parquet']):
+        import pyarrow.parquet as pq
+        return pq.read_table(path)
+    # The table's buffers point into the mapping, which stays open as long as they are referenced
+    return pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+
+
+class VectorizedEvaluator:
+    """Evaluate rule conditions over whole Arrow columns with compute kernels.
+
+    Mirrors RuleEngine.check_condition for the string operators (contains,
+    not_contains, equals, not_equals, case-insensitive), date conditions
+    (older_than, newer_than) and label conditions (has, has_any, has_all,
+    not_has). Unknown fields and operators match nothing, as they do in the
+    rule engine.
+    """
+
+    def __init__(self, rules, body_scan_limit=None, now=None):
+        self.rules = rules
+        self.body_scan_limit = body_scan_limit
+        self.now = now
+
+    def evaluate(self, table):
+        """Match mask of every rule
+
+        Returns:
+            Dictionary of rule name to a boolean array with one entry per row
+        """
+        return {rule.get('name', 'Unknown Rule'): self.rule_mask(table, rule) for rule in self.rules}
+
+    def match_counts(self, table):
+        """Number of rows each rule matches"""
+        pc = _pyarrow().compute
+        return {name: pc.sum(mask).as_py() or 0 for name, mask in self.evaluate(table).items()}
+
+    def rule_mask(self, table, rule):
+        pc = _pyarrow().compute
+        conditions = rule.get('conditions', [])
+        predicate = rule.get('predicate', 'all')
+        if not conditions or predicate not in ('all', 'any'):
+            if conditions:
+                logger.warning(f"Unknown predicate: {predicate}")
+            return self._constant(table, False)
+
+        combine = pc.and_ if predicate == 'all' else pc.or_
+        mask = None
+        for condition in conditions:
+            condition_mask = self.condition_mask(table, condition)
+            mask = condition_mask if mask is None else combine(mask, condition_mask)
+        return mask
+
+    def condition_mask(self, table, condition):
+        """Boolean array of the rows matching one condition (never null)"""
+        pc = _pyarrow().compute
+        field = condition['field']
+        operator = condition['operator']
+        value = condition['value']
+
+        if field == 'labels':
+            mask = self._label_mask(table, operator, value)
+        elif field == 'date_received' and operator in ('older_than', 'newer_than'):
+            mask = self._date_mask(table, operator, value, condition.get('unit', 'days'))
+        elif field in FIELD_COLUMNS and operator in ('contains', 'not_contains', 'equals', 'not_equals'):
+            mask = self._text_mask(table, field, operator, value)
+        else:
+            logger.warning(f"Unsupported condition for vectorized evaluation: {field} {operator}")
+            mask = None
+        if mask is None:
+            return self._constant(table, False)
+        return pc.fill_null(mask, False)
+
+    def _text_mask(self, table, field, operator, value):
+        pc = _pyarrow().compute
+        name, fold_case = FIELD_COLUMNS[field]
+        column = pc.fill_null(table.column(name), '')
+        if operator in ('contains', 'not_contains'):
+            if field == 'body' and self.body_scan_limit is not None:
+                # Exported bodies are stored text, so the limit counts characters, as RuleEngine does for
+                # records read from the database (it counts bytes only for undecoded, freshly fetched bodies)
+                column = pc.utf8_slice_codeunits(column, 0, self.body_scan_limit)
+            mask = pc.match_substring(column, value if fold_case else value.lower(), ignore_case=fold_case)
+        else:
+            mask = pc.equal(pc.utf8_lower(column) if fold_case else column, value.lower())
+        return pc.invert(mask) if operator.startswith('not_') else mask
+
+    def _date_mask(self, table, operator, value, unit):
+        pc = _pyarrow().compute
+        if unit not in DATE_UNITS:
+            logger.warning(f"Unknown date unit: {unit}")
+            return None
+        try:
+            threshold = (self.now or time.time()) - int(value) * DATE_UNITS[unit] * 86400
+        except (TypeError, ValueError):
+            return None
+        # Emails without a parseable date have a null received_at and match neither way
+        column = table.column('received_at')
+        return pc.less(column, threshold) if operator == 'older_than' else pc.greater(column, threshold)
+
+    def _label_mask(self, table, operator, value):
+        pc = _pyarrow().compute
+        labels = (value,) if isinstance(value, str) else tuple(value)
+        if operator not in ('has', 'has_all', 'has_any', 'not_has'):
+            logger.warning(f"Unknown operator: {operator}")
+            return None
+        if not labels:
+            # An empty label set is contained in every email and shares nothing with any
+            return self._constant(table, operator != 'has_any')
+
+        # Labels joined with commas, one string per row, so each label is one regex search
+        joined = pc.fill_null(pc.binary_join(table.column('labels'), ','), '')
+        masks = [pc.match_substring_regex(joined, f'(^|,){re.escape(label)}(,|$)') for label in labels]
+        combine = pc.and_ if operator in ('has', 'has_all') else pc.or_
+        mask = masks[0]
+        for other in masks[1:]:
+            mask = combine(mask, other)
+        return pc.invert(mask) if operator == 'not_has' else mask
+
+    @staticmethod
+    def _constant(table, value):
+        pa = _pyarrow()
+        return pa.repeat(pa.scalar(value), table.num_rows)
+
+
+def row_to_email(row):
+    """EmailRecord from a row of an exported emails table (as a dictionary)"""
+    return EmailRecord(
+        id=row['id'],
+        thread_id=row['thread_id'],
+        from_email=row['from_email'] or '',
+        to_email=row['to_email'] or '',
+        subject=row['subject'] or '',
+        date=row['date_received'] or '',
+        is_read=bool(row['is_read']),
+        labels=tuple(row['labels'] or ()),
+        snippet=row['snippet'] or '',
+        history_id=row.get('history_id'),
+        _body=row['body'] or ''
+    )
+
+
+def compare_with_engine(rule_engine, table, masks=None, chunk_size=EXPORT_CHUNK):
+    """Check vectorized match masks against RuleEngine.evaluate_rule, row by row
+
+    Args:
+        rule_engine: RuleEngine with the rules the masks were computed for
+        table: exported emails table
+        masks: result of VectorizedEvaluator.evaluate (computed if None)
+
+    Returns:
+        Dictionary of rule name to the IDs of emails where the two disagree
+    """
+    if masks is None:
+        masks = VectorizedEvaluator(rule_engine.rules, body_scan_limit=rule_engine.body_scan_limit).evaluate(table)
+    flags = {name: mask.to_pylist() for name, mask in masks.items()}
+    mismatches = {name: [] for name in masks}
+
+    offset = 0
+    for batch in table.to_batches(max_chunksize=chunk_size):
+        for index, row in enumerate(batch.to_pylist(), start=offset):
+            email_data = row_to_email(row)
+            for rule in rule_engine.rules:
+                name = rule.get('name', 'Unknown Rule')
+                if name in flags and rule_engine.evaluate_rule(email_data, rule) != flags[name][index]:
+                    mismatches[name].append(email_data.id)
+        offset += batch.num_rows
+
+    disagreeing = sum(1 for ids in mismatches.values() if ids)
+    if disagreeing:
+        logger.warning(f"Vectorized evaluation disagrees with the rule engine on {disagreeing} rules")
+    return mismatches
@@ -0,0 +1,121 @@
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+from processor.authenticate import SCOPES, write_atomic
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking, threads are still serialised
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class CredentialManager:
+    """Hand out OAuth credentials shared by every thread of a process.
+
+    The access token is refreshed under a single lock ``refresh_margin``
+    seconds before it expires, so in-flight requests never race to refresh it.
+    A lock file next to the token serialises refreshes across processes; a
+    process that finds ``token.json`` was refreshed by another one adopts that
+    token instead of refreshing again. ``token.json`` is always replaced
+    atomically.
+
+    It can be registered as a ServiceProxy hook, checking the token before
+    every Gmail request.
+    """
+
+    def __init__(self, token_path='token.json', client_secrets='credentials.json', scopes=SCOPES,
+                 refresh_margin=300):
+        self.token_path = token_path
+        self.client_secrets = client_secrets
+        self.scopes = scopes
+        self.refresh_margin = timedelta(seconds=refresh_margin)
+        self.credentials = None
+        self._token_mtime = None
+        self._lock = threading.Lock()
+
+    def get_credentials(self):
+        """Return valid credentials, refreshing them first if they are about to expire"""
+        with self._lock:
+            if self.credentials is None:
+                self._load()
+
+            if self._needs_refresh():
+                with self._file_lock():
+                    self._adopt_newer_token()
+                    if self._needs_refresh():
+                        self._refresh()
+
+            return self.credentials
+
+    def before_execute(self, method):
+        self.get_credentials()
+
+    def _needs_refresh(self):
+        creds = self.credentials
+        if not creds.token:
+            return True
+        if not creds.expiry:
+            return False
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        return creds.expiry - now < self.refresh_margin
+
+    def _read_token_file(self):
+        from google.oauth2.credentials import Credentials
+
+        if not os.path.exists(self.token_path):
+            return None, None
+        mtime = os.path.getmtime(self.token_path)
+        return Credentials.from_authorized_user_file(self.token_path, self.scopes), mtime
+
+    def _load(self):
+        creds, mtime = self._read_token_file()
+        if creds is None or (not creds.valid and not creds.refresh_token):
+            from google_auth_oauthlib.flow import InstalledAppFlow
+
+            flow = InstalledAppFlow.from_client_secrets_file(self.client_secrets, self.scopes)
+            self.credentials = flow.run_local_server(port=0)
+            self._save()
+            return
+
+        self.credentials = creds
+        self._token_mtime = mtime
+
+    def _adopt_newer_token(self):
+        """Pick up a token another process refreshed, updating our credentials in place"""
+        if not os.path.exists(self.token_path) or os.path.getmtime(self.token_path) == self._token_mtime:
+            return
+        creds, mtime = self._read_token_file()
+        # Services hold a reference to our credentials object, so copy the token into it
+        self.credentials.token = creds.token
+        self.credentials.expiry = creds.expiry
+        self._token_mtime = mtime
+        logger.info("Using access token refreshed by another process")
+
+    def _refresh(self):
+        from google.auth.transport.requests import Request
+
+        self.credentials.refresh(Request())
+        self._save()
+        logger.info(f"Refreshed access token (expires {self.credentials.expiry})")
+
+    def _save(self):
+        write_atomic(self.token_path, self.credentials.to_json())
+        self._token_mtime = os.path.getmtime(self.token_path)
+
+    @contextmanager
+    def _file_lock(self):
+        if fcntl is None:
+            yield
+            return
+
+        with open(self.token_path + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,93 @@
+import logging
+import signal
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class PollingScheduler:
+    """Run a processor repeatedly, backing off while the mailbox is idle.
+
+    The processor must provide ``process_emails(limit)`` returning the number
+    of actions it generated, ``reload()`` and ``reload_if_changed()``. The interval doubles (by
+    ``backoff_factor``) after every idle poll up to ``max_interval`` and drops
+    back to ``interval`` as soon as a poll finds work.
+    """
+
+    def __init__(self, processor, interval=60, max_interval=900, backoff_factor=2.0, limit=10):
+        self.processor = processor
+        self.interval = interval
+        self.max_interval = max_interval
+        self.backoff_factor = backoff_factor
+        self.limit = limit
+        self.current_interval = interval
+        self._stop = threading.Event()
+        self._reload = threading.Event()
+        self._wake = threading.Event()
+
+    def next_interval(self, had_work):
+        """Work out how long to sleep after a poll"""
+        if had_work:
+            self.current_interval = self.interval
+        else:
+            self.current_interval = min(self.current_interval * self.backoff_factor, self.max_interval)
+        return self.current_interval
+
+    def stop(self, *args):
+        """Ask the loop to finish after the current poll"""
+        logger.info("Shutdown requested")
+        self._stop.set()
+        self._wake.set()
+
+    def request_reload(self, *args):
+        """Ask the loop to reload rules and caches before the next poll"""
+        logger.info("Reload requested")
+        self._reload.set()
+        self._wake.set()
+
+    def install_signal_handlers(self):
+        """Stop on SIGTERM/SIGINT and reload on SIGHUP (main thread only)"""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self.request_reload)
+
+    def poll(self):
+        """Run a single poll and return the number of actions generated"""
+        try:
+            if self._reload.is_set():
+                self._reload.clear()
+                self.processor.reload()
+            else:
+                self.processor.reload_if_changed()
+
+            return self.processor.process_emails(limit=self.limit) or 0
+        except Exception as e:
+            logger.error(f"Poll failed: {e}")
+            return 0
+
+    def run(self, max_polls=None):
+        """Poll until stopped
+
+        Args:
+            max_polls: stop after this many polls (mainly for tests)
+
+        Returns:
+            Number of polls performed
+        """
+        polls = 0
+        logger.info(f"Daemon started (interval: {self.interval}s, max interval: {self.max_interval}s)")
+
+        while not self._stop.is_set():
+            had_work = self.poll() > 0
+            polls += 1
+            if max_polls is not None and polls >= max_polls:
+                break
+
+            delay = self.next_interval(had_work)
+            logger.info(f"Next poll in {delay:.0f}s")
+            self._wake.wait(delay)
+            self._wake.clear()
+
+        logger.info(f"Daemon stopped after {polls} polls")
+        return polls
@@ -1,187 +1,616 @@
+import hashlib
 import logging
 import sqlite3
+import threading
+from contextlib import contextmanager
+
+from processor.body import decode_text
+from processor.labels import LabelRegistry
+from processor.metrics import metrics
+from processor.models import EmailRecord
 
 logger = logging.getLogger(__name__)
 
 
 class EmailDatabase:
-    def __init__(self, db_path='emails.db'):
+    def __init__(self, db_path='emails.db', keep_alive=False):
+        """
+        Args:
+            db_path: SQLite database file
+            keep_alive: reuse one connection for every operation instead of
+                opening a new one per call (used by long-running processes)
+        """
         self.db_path = db_path
+        self.keep_alive = keep_alive
+        self._conn = None
+        self._lock = threading.RLock()
         self.init_database()
+        self.labels = LabelRegistry(self)
+        self._fill_label_masks()
+
+    @contextmanager
+    def connect(self):
+        """Yield a connection, either the shared one or a fresh one closed afterwards"""
+        if not self.keep_alive:
+            conn = sqlite3.connect(self.db_path)
+            try:
+                yield conn
+            finally:
+                conn.close()
+            return
+
+        with self._lock:
+            if self._conn is None:
+                self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            yield self._conn
+
+    def close(self):
+        """Close the shared connection, if one is open"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
 
     def init_database(self):
         """Create tables in db if not exists to store emails and actions for those
         Returns:
 
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS emails (
-                id TEXT PRIMARY KEY,
-                thread_id TEXT,
-                from_email TEXT,
-                to_email TEXT,
-                subject TEXT,
-                body TEXT,
-                date_received TEXT,
-                is_read BOOLEAN,
-                labels TEXT,
-                snippet TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS email_actions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                email_id TEXT,
-                rule_name TEXT,
-                action_type TEXT,
-                action_details TEXT,
-                executed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                status TEXT DEFAULT 'success',
-                FOREIGN KEY (email_id) REFERENCES emails (id),
-                UNIQUE(email_id, rule_name, action_type)
-            )
-        ''')
-
-        conn.commit()
-        conn.close()
+        with self.connect() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS emails (
+                    id TEXT PRIMARY KEY,
+                    thread_id TEXT,
+                    from_email TEXT,
+                    to_email TEXT,
+                    subject TEXT,
+                    body TEXT,
+                    date_received TEXT,
+                    is_read BOOLEAN,
+                    labels TEXT,
+                    snippet TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # Untyped on purpose: masks wider than 63 bits don't fit an SQLite
+            # integer and are stored as decimal text instead
+            columns = [row[1] for row in cursor.execute('PRAGMA table_info(emails)')]
+            if 'label_mask' not in columns:
+                cursor.execute('ALTER TABLE emails ADD COLUMN label_mask')
+            # Fingerprint of the stored row: Gmail history ID and a hash of the body
+            if 'history_id' not in columns:
+                cursor.execute('ALTER TABLE emails ADD COLUMN history_id TEXT')
+            if 'body_hash' not in columns:
+                cursor.execute('ALTER TABLE emails ADD COLUMN body_hash TEXT')
+            # When labels and read state were last checked against Gmail (epoch seconds)
+            if 'refreshed_at' not in columns:
+                cursor.execute('ALTER TABLE emails ADD COLUMN refreshed_at REAL')
+
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_emails_thread ON emails (thread_id)')
+
+            # History ID at which thread mode last fetched each whole thread
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS threads (
+                    id TEXT PRIMARY KEY,
+                    history_id TEXT
+                )
+            ''')
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS label_ids (
+                    bit INTEGER PRIMARY KEY,
+                    label TEXT UNIQUE
+                )
+            ''')
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS email_actions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    email_id TEXT,
+                    rule_name TEXT,
+                    action_type TEXT,
+                    action_details TEXT,
+                    executed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    status TEXT DEFAULT 'success',
+                    FOREIGN KEY (email_id) REFERENCES emails (id),
+                    UNIQUE(email_id, rule_name, action_type)
+                )
+            ''')
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS rule_versions (
+                    rule_name TEXT PRIMARY KEY,
+                    version TEXT,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS action_queue (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    email_id TEXT NOT NULL,
+                    rule_name TEXT NOT NULL,
+                    action_type TEXT NOT NULL,
+                    action TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    lease_owner TEXT,
+                    lease_expires REAL,
+                    error TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    UNIQUE(email_id, rule_name, action_type)
+                )
+            ''')
+            # Ranking of queued actions: rule priority, unread email, received time (higher first)
+            queue_columns = [row[1] for row in cursor.execute('PRAGMA table_info(action_queue)')]
+            for column, definition in (('priority', 'INTEGER NOT NULL DEFAULT 0'),
+                                       ('unread', 'INTEGER NOT NULL DEFAULT 0'),
+                                       ('received_at', 'REAL NOT NULL DEFAULT 0')):
+                if column not in queue_columns:
+                    cursor.execute(f'ALTER TABLE action_queue ADD COLUMN {column} {definition}')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_action_queue_state ON action_queue (state, id)')
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    key TEXT PRIMARY KEY,
+                    value TEXT,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            conn.commit()
         logging.info("Database initialized successfully")
 
+    @metrics.timed('db_operation_seconds', operation='email_exists')
     def email_exists(self, email_id):
         """Check if email exists in database"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self.connect() as conn:
+            cursor = conn.cursor()
 
-        cursor.execute('SELECT COUNT(*) FROM emails WHERE id = ?', (email_id,))
-        count = cursor.fetchone()[0]
+            cursor.execute('SELECT COUNT(*) FROM emails WHERE id = ?', (email_id,))
+            count = cursor.fetchone()[0]
 
-        conn.close()
         return count > 0
 
+    @metrics.timed('db_operation_seconds', operation='action_exists')
     def action_exists(self, email_id, rule_name, action_type):
         """Check if action has already been performed on an email"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self.connect() as conn:
+            cursor = conn.cursor()
 
-        cursor.execute('''
-            SELECT COUNT(*) FROM email_actions 
-            WHERE email_id = ? AND rule_name = ? AND action_type = ? AND status = 'success'
-        ''', (email_id, rule_name, action_type))
+            cursor.execute('''
+                SELECT COUNT(*) FROM email_actions 
+                WHERE email_id = ? AND rule_name = ? AND action_type = ? AND status = 'success'
+            ''', (email_id, rule_name, action_type))
 
-        count = cursor.fetchone()[0]
-        conn.close()
+            count = cursor.fetchone()[0]
         return count > 0
 
+    def get_label_bits(self):
+        """Get the bit assigned to every known label ID"""
+        with self.connect() as conn:
+            rows = conn.execute('SELECT label, bit FROM label_ids').fetchall()
+        return dict(rows)
+
+    def add_label_bit(self, label):
+        """Assign a label ID the next free bit, unless it has one already
+
+        The bit is chosen by SQLite within the insert, so processes sharing the
+        database never hand out the same bit twice.
+
+        Returns:
+            The bit stored for the label
+        """
+        with self.connect() as conn:
+            with conn:
+                conn.execute('''
+                    INSERT OR IGNORE INTO label_ids (bit, label)
+                    VALUES ((SELECT COALESCE(MAX(bit) + 1, 0) FROM label_ids), ?)
+                ''', (label,))
+                return conn.execute('SELECT bit FROM label_ids WHERE label = ?', (label,)).fetchone()[0]
+
+    def _fill_label_masks(self):
+        """Compute label masks for rows stored before the label_mask column existed"""
+        with self.connect() as conn:
+            rows = conn.execute('SELECT id, labels FROM emails WHERE label_mask IS NULL').fetchall()
+            if not rows:
+                return
+            with conn:
+                conn.executemany('UPDATE emails SET label_mask = ? WHERE id = ?', [
+                    (encode_mask(self.labels.mask(labels.split(',') if labels else ())), email_id)
+                    for email_id, labels in rows
+                ])
+        logger.info(f"Computed label masks for {len(rows)} stored emails")
+
+    @metrics.timed('db_operation_seconds', operation='get_label_masks')
+    def get_label_masks(self, email_ids):
+        """Get the stored label mask of each email
+
+        Returns:
+            Dictionary of email ID to mask
+        """
+        if not email_ids:
+            return {}
+        placeholders = ','.join(['?' for _ in email_ids])
+        with self.connect() as conn:
+            rows = conn.execute(f'SELECT id, label_mask FROM emails WHERE id IN ({placeholders})',
+                                list(email_ids)).fetchall()
+        return {email_id: decode_mask(mask) for email_id, mask in rows}
+
+    def get_state(self, key, default=None):
+        """Read a value from the sync state table (e.g. the last processed history ID)"""
+        with self.connect() as conn:
+            row = conn.execute('SELECT value FROM sync_state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_state(self, key, value):
+        """Store a value in the sync state table"""
+        with self.connect() as conn:
+            with conn:
+                conn.execute('''
+                    INSERT OR REPLACE INTO sync_state (key, value, updated_at)
+                    VALUES (?, ?, CURRENT_TIMESTAMP)
+                ''', (key, str(value)))
+
+    def add_daily_state(self, key, day, amount):
+        """Add amount to a 'day:count' sync state value, restarting the count on a new day
+
+        One statement, so processes adding to the same key do not overwrite each other.
+        """
+        with self.connect() as conn:
+            with conn:
+                conn.execute('''
+                    INSERT INTO sync_state (key, value, updated_at)
+                    VALUES (?, ? || ':' || ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT(key) DO UPDATE SET
+                        value = CASE WHEN substr(value, 1, length(?) + 1) = ? || ':'
+                                     THEN ? || ':' || (CAST(substr(value, length(?) + 2) AS INTEGER) + ?)
+                                     ELSE excluded.value END,
+                        updated_at = CURRENT_TIMESTAMP
+                ''', (key, day, amount, day, day, day, day, amount))
+
+    def get_rule_versions(self):
+        """Get the rule versions that have been applied to the stored emails"""
+        with self.connect() as conn:
+            rows = conn.execute('SELECT rule_name, version FROM rule_versions').fetchall()
+        return dict(rows)
+
+    def set_rule_versions(self, versions):
+        """Mark rule versions as applied to the stored emails
+
+        Args:
+            versions: dictionary of rule name to version hash
+        """
+        with self.connect() as conn:
+            with conn:
+                conn.executemany('''
+                    INSERT OR REPLACE INTO rule_versions (rule_name, version, applied_at)
+                    VALUES (?, ?, CURRENT_TIMESTAMP)
+                ''', list(versions.items()))
+
     def record_action(self, email_id, rule_name, action_type, action_details='', status='success'):
         """Record an action performed on an email"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self.connect() as conn:
+            cursor = conn.cursor()
 
-        try:
-            cursor.execute('''
-                INSERT OR REPLACE INTO email_actions 
-                (email_id, rule_name, action_type, action_details, status)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (email_id, rule_name, action_type, action_details, status))
+            try:
+                cursor.execute('''
+                    INSERT OR REPLACE INTO email_actions 
+                    (email_id, rule_name, action_type, action_details, status)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (email_id, rule_name, action_type, action_details, status))
 
-            conn.commit()
-            logger.debug(f"Recorded action: {action_type} on email {email_id}")
-            return True
+                conn.commit()
+                logger.debug(f"Recorded action: {action_type} on email {email_id}")
+                return True
 
-        except Exception as e:
-            logger.error(f"Error recording action: {e}")
-            return False
-        finally:
-            conn.close()
+            except Exception as e:
+                logger.error(f"Error recording action: {e}")
+                return False
 
+    @metrics.timed('db_operation_seconds', operation='record_actions')
+    def record_actions(self, records):
+        """Record a batch of actions in a single transaction
+
+        Args:
+            records: iterable of (email_id, rule_name, action_type, action_details, status) tuples
+
+        Returns:
+            Number of records written
+        """
+        records = list(records)
+        if not records:
+            return 0
+
+        with self.connect() as conn:
+            with conn:
+                conn.executemany('''
+                    INSERT OR REPLACE INTO email_actions
+                    (email_id, rule_name, action_type, action_details, status)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', records)
+        logger.debug(f"Recorded {len(records)} actions")
+        return len(records)
+
+    @metrics.timed('db_operation_seconds', operation='get_emails_by_ids')
     def get_emails_by_ids(self, email_ids):
-        """Get multiple emails by IDs from database"""
+        """Get multiple emails by IDs from database
+
+        The bodies are not read here; each record loads its body on first access.
+        """
         if not email_ids:
             return []
 
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
         placeholders = ','.join(['?' for _ in email_ids])
 
-        cursor.execute(f'''
-            SELECT id, thread_id, from_email, to_email, subject, body, 
-                   date_received, is_read, labels, snippet
-            FROM emails 
-            WHERE id IN ({placeholders})
-        ''', email_ids)
-
-        results = cursor.fetchall()
-        conn.close()
-
-        emails = []
-        for result in results:
-            emails.append({
-                'id': result[0],
-                'thread_id': result[1],
-                'from': result[2],
-                'to': result[3],
-                'subject': result[4],
-                'body': result[5],
-                'date': result[6],
-                'is_read': result[7],
-                'labels': result[8].split(',') if result[8] else [],
-                'snippet': result[9]
-            })
-
-        return emails
-
+        with self.connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT id, thread_id, from_email, to_email, subject,
+                       date_received, is_read, labels, snippet
+                FROM emails 
+                WHERE id IN ({placeholders})
+            ''', email_ids)
+
+            results = cursor.fetchall()
+
+        return [self._row_to_email(result, body_loader=self.get_email_body) for result in results]
+
+    def get_emails_by_thread(self, thread_id):
+        """Get the stored emails of a thread (bodies load on first access, as in get_emails_by_ids)"""
+        with self.connect() as conn:
+            results = conn.execute('''
+                SELECT id, thread_id, from_email, to_email, subject,
+                       date_received, is_read, labels, snippet
+                FROM emails
+                WHERE thread_id = ?
+            ''', (thread_id,)).fetchall()
+        return [self._row_to_email(result, body_loader=self.get_email_body) for result in results]
+
+    def get_thread_history_id(self, thread_id):
+        """History ID at which a whole thread was last stored, or None"""
+        with self.connect() as conn:
+            row = conn.execute('SELECT history_id FROM threads WHERE id = ?', (thread_id,)).fetchone()
+        return row[0] if row else None
+
+    def set_thread_history_id(self, thread_id, history_id):
+        """Record that every message of a thread is stored as of a history ID"""
+        with self.connect() as conn:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO threads (id, history_id) VALUES (?, ?)',
+                             (thread_id, str(history_id)))
+
+    @metrics.timed('db_operation_seconds', operation='get_email_body')
+    def get_email_body(self, email_id):
+        """Get the body of a stored email"""
+        with self.connect() as conn:
+            row = conn.execute('SELECT body FROM emails WHERE id = ?', (email_id,)).fetchone()
+        return row[0] if row and row[0] is not None else ''
+
+    def iter_emails(self, batch_size=500):
+        """Yield every stored email (with its body), reading the table in batches"""
+        with self.connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, thread_id, from_email, to_email, subject,
+                       date_received, is_read, labels, snippet, body
+                FROM emails
+            ''')
+            while True:
+                results = cursor.fetchmany(batch_size)
+                if not results:
+                    break
+                for result in results:
+                    yield self._row_to_email(result)
+
+    @staticmethod
+    def _row_to_email(result, body_loader=None):
+        return EmailRecord(
+            id=result[0],
+            thread_id=result[1],
+            from_email=result[2] or '',
+            to_email=result[3] or '',
+            subject=result[4] or '',
+            date=result[5] or '',
+            is_read=bool(result[6]),
+            labels=result[7].split(',') if result[7] else (),
+            snippet=result[8] or '',
+            _body=result[9] if len(result) > 9 else None,
+            _body_loader=body_loader
+        )
+
+    @metrics.timed('db_operation_seconds', operation='insert_email')
     def insert_email(self, email_data):
-        """Insert a single email into the database"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        """Insert or update a single email (EmailRecord or dict)"""
+        return self.upsert_emails([email_data])['failed'] == 0
 
-        try:
-            cursor.execute('''
-                INSERT OR REPLACE INTO emails 
-                (id, thread_id, from_email, to_email, subject, body, 
-                 date_received, is_read, labels, snippet)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                email_data['id'],
-                email_data['thread_id'],
-                email_data['from'],
-                email_data['to'],
-                email_data['subject'],
-                email_data['body'],
-                email_data['date'],
-                email_data['is_read'],
-                ','.join(email_data['labels']),
-                email_data['snippet']
-            ))
+    @metrics.timed('db_operation_seconds', operation='insert_emails')
+    def insert_emails(self, emails):
+        """Insert or update multiple emails
 
-            conn.commit()
-            return True
+        Returns:
+            Tuple of (stored, failed) counts
+        """
+        counts = self.upsert_emails(emails)
+        logger.info(f"Stored emails: {counts['inserted']} new, {counts['updated']} updated, "
+                    f"{counts['unchanged']} unchanged")
+        if counts['failed'] > 0:
+            logger.error(f"Failed to insert {counts['failed']} emails")
 
-        except Exception as e:
-            logger.error(f"Error inserting email: {e}")
+        return counts['inserted'] + counts['updated'] + counts['unchanged'], counts['failed']
+
+    @metrics.timed('db_operation_seconds', operation='upsert_emails')
+    def upsert_emails(self, emails):
+        """Store emails, writing only the columns that changed
+
+        A known email whose history ID has not advanced is not written at all.
+        Otherwise labels, read state and history ID are updated when they
+        differ, and the content columns only when the body hash changed.
+
+        Returns:
+            Dictionary with 'inserted', 'updated', 'unchanged' and 'failed' counts
+        """
+        emails = [EmailRecord.coerce(email_data) for email_data in emails]
+        counts = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'failed': 0}
+        if not emails:
+            return counts
+
+        stored = self.get_fingerprints([email_data.id for email_data in emails])
+        with self.connect() as conn:
+            with conn:
+                for email_data in emails:
+                    try:
+                        if email_data.id in stored:
+                            changed = self._update_email(conn, email_data, stored[email_data.id])
+                            counts['updated' if changed else 'unchanged'] += 1
+                        else:
+                            self._insert_email(conn, email_data)
+                            stored[email_data.id] = None
+                            counts['inserted'] += 1
+                    except sqlite3.Error as e:
+                        logger.error(f"Error inserting email {email_data.id}: {e}")
+                        counts['failed'] += 1
+        return counts
+
+    def _insert_email(self, conn, email_data):
+        conn.execute('''
+            INSERT INTO emails
+            (id, thread_id, from_email, to_email, subject, body,
+             date_received, is_read, labels, snippet, label_mask, history_id, body_hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            email_data.id,
+            email_data.thread_id,
+            email_data.from_email,
+            email_data.to_email,
+            email_data.subject,
+            # Decoded for the TEXT column only; the record keeps its undecoded bytes for the rules
+            decode_text(email_data.body_raw),
+            email_data.date,
+            email_data.is_read,
+            ','.join(email_data.labels),
+            email_data.snippet,
+            encode_mask(self.labels.mask(email_data.labels)),
+            email_data.history_id,
+            body_hash(email_data.body_raw)
+        ))
+
+    def _update_email(self, conn, email_data, stored):
+        """Write the columns of a stored email that differ from email_data
+
+        Returns:
+            True if anything was written
+        """
+        if stored is None:
+            # Inserted earlier in the same batch
+            stored = {}
+        elif email_data.history_id is not None and email_data.history_id == stored['history_id']:
             return False
-        finally:
-            conn.close()
 
-    def insert_emails(self, emails):
-        """Insert multiple emails into the database"""
-        successful = 0
-        failed = 0
+        changes = {}
+        labels = ','.join(email_data.labels)
+        if labels != stored.get('labels') or email_data.is_read != stored.get('is_read'):
+            changes.update(labels=labels, is_read=email_data.is_read,
+                           label_mask=encode_mask(self.labels.mask(email_data.labels)))
+        if email_data.history_id is not None and email_data.history_id != stored.get('history_id'):
+            changes['history_id'] = email_data.history_id
+
+        digest = body_hash(email_data.body_raw)
+        if digest != stored.get('body_hash'):
+            changes.update(thread_id=email_data.thread_id, from_email=email_data.from_email,
+                           to_email=email_data.to_email, subject=email_data.subject,
+                           body=decode_text(email_data.body_raw),
+                           date_received=email_data.date, snippet=email_data.snippet, body_hash=digest)
+
+        if not changes:
+            return False
+        assignments = ', '.join(f'{column} = ?' for column in changes)
+        conn.execute(f'UPDATE emails SET {assignments} WHERE id = ?', [*changes.values(), email_data.id])
+        return True
+
+    @metrics.timed('db_operation_seconds', operation='get_fingerprints')
+    def get_fingerprints(self, email_ids):
+        """Get the stored fingerprint and label state of each email
+
+        Returns:
+            Dictionary of email ID to a dictionary with 'history_id',
+            'body_hash', 'labels' and 'is_read'
+        """
+        if not email_ids:
+            return {}
+        fingerprints = {}
+        email_ids = list(email_ids)
+        # Stay under SQLite's limit on query parameters
+        for start in range(0, len(email_ids), 500):
+            chunk = email_ids[start:start + 500]
+            placeholders = ','.join('?' for _ in chunk)
+            with self.connect() as conn:
+                rows = conn.execute(f'''
+                    SELECT id, history_id, body_hash, labels, is_read FROM emails WHERE id IN ({placeholders})
+                ''', chunk).fetchall()
+            for email_id, history_id, digest, labels, is_read in rows:
+                fingerprints[email_id] = {'history_id': history_id, 'body_hash': digest,
+                                          'labels': labels or '', 'is_read': bool(is_read)}
+        return fingerprints
+
+    @metrics.timed('db_operation_seconds', operation='update_labels')
+    def update_labels(self, updates, refreshed_at=None):
+        """Update labels and read state of stored emails without touching their content
+
+        Args:
+            updates: iterable of (email_id, label IDs, history ID) tuples
+            refreshed_at: when the label state was read from Gmail; stored on
+                every updated email, changed or not
+
+        Returns:
+            Number of emails whose labels changed
+        """
+        rows = []
+        for email_id, labels, history_id in updates:
+            labels_text = ','.join(labels)
+            rows.append((labels_text, 'UNREAD' not in labels, encode_mask(self.labels.mask(labels)),
+                         history_id, email_id, history_id, labels_text))
+        if not rows:
+            return 0
+        with self.connect() as conn:
+            with conn:
+                before = conn.total_changes
+                conn.executemany('''
+                    UPDATE emails SET labels = ?, is_read = ?, label_mask = ?, history_id = ?
+                    WHERE id = ? AND (history_id IS NOT ? OR labels IS NOT ?)
+                ''', rows)
+                changed = conn.total_changes - before
+                if refreshed_at is not None:
+                    conn.executemany('UPDATE emails SET refreshed_at = ? WHERE id = ?',
+                                     [(refreshed_at, row[4]) for row in rows])
+        return changed
+
+    def get_refreshed_at(self, email_ids):
+        """Get when each stored email's labels were last refreshed (None if never)"""
+        if not email_ids:
+            return {}
+        placeholders = ','.join('?' for _ in email_ids)
+        with self.connect() as conn:
+            rows = conn.execute(f'SELECT id, refreshed_at FROM emails WHERE id IN ({placeholders})',
+                                list(email_ids)).fetchall()
+        return dict(rows)
+
+
+def body_hash(body):
+    """Short hash of an email body (text or undecoded UTF-8 bytes), part of the stored fingerprint"""
+    if isinstance(body, str):
+        body = body.encode('utf-8', 'surrogatepass')
+    return hashlib.sha256(body or b'').hexdigest()[:16]
 
-        for email_l in emails:
-            if self.insert_email(email_l):
-                successful += 1
-            else:
-                failed += 1
 
-        logger.info(f"Inserted {successful} emails successfully")
-        if failed > 0:
-            logger.error(f"Failed to insert {failed} emails")
+def encode_mask(mask):
+    """Label mask as stored in the database"""
+    return mask if mask < 1 << 63 else str(mask)
 
-        return successful, failed
 
+def decode_mask(value):
+    return int(value) if value is not None else 0
@@ -0,0 +1,104 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Registered first so the labels checked most often get the low bits
+SYSTEM_LABELS = [
+    'INBOX', 'UNREAD', 'STARRED', 'IMPORTANT', 'SENT', 'DRAFT', 'SPAM', 'TRASH', 'CHAT',
+    'CATEGORY_PERSONAL', 'CATEGORY_SOCIAL', 'CATEGORY_PROMOTIONS', 'CATEGORY_UPDATES', 'CATEGORY_FORUMS'
+]
+
+
+class LabelRegistry:
+    """Assign every label ID a bit, so a set of labels is a single integer.
+
+    With a database the assignments are stored in its label_ids table and
+    stay stable across runs; without one they live in memory. Masks for label
+    tuples are memoised, since most emails share a handful of label sets.
+    """
+
+    def __init__(self, db=None):
+        self.db = db
+        self._bits = {}
+        self._masks = {}
+        self._lock = threading.Lock()
+
+        if db is not None:
+            self._bits.update(db.get_label_bits())
+        for label in SYSTEM_LABELS:
+            self.bit(label)
+
+    def bit(self, label):
+        """Bit value of a label, registering the label if it is new"""
+        index = self._bits.get(label)
+        if index is None:
+            if self.db is not None:
+                # Not under our lock: the database takes its own, and its writers compute masks while holding it.
+                # The stored bit wins, even if another thread or process registered the label first.
+                index = self.db.add_label_bit(label)
+                with self._lock:
+                    self._bits[label] = index
+            else:
+                with self._lock:
+                    index = self._bits.setdefault(label, len(self._bits))
+        return 1 << index
+
+    def mask(self, labels):
+        """Bitmask of a collection of label IDs"""
+        if isinstance(labels, str):
+            labels = (labels,)
+        key = tuple(labels)
+        mask = self._masks.get(key)
+        if mask is None:
+            mask = 0
+            for label in key:
+                mask |= self.bit(label)
+            self._masks[key] = mask
+        return mask
+
+    def lookup_mask(self, labels):
+        """Bitmask of the registered labels among label IDs, without registering new ones
+
+        Used for label values in rules, so a mistyped label does not take up a bit.
+
+        Returns:
+            Tuple of (mask, whether every label was registered)
+        """
+        if isinstance(labels, str):
+            labels = (labels,)
+        key = tuple(labels)
+        mask = self._masks.get(key)
+        if mask is not None:
+            return mask, True
+        mask = 0
+        complete = True
+        for label in key:
+            index = self._bits.get(label)
+            if index is None:
+                complete = False
+            else:
+                mask |= 1 << index
+        return mask, complete
+
+    def labels(self, mask):
+        """Label IDs set in a bitmask"""
+        return [label for label, index in self._bits.items() if mask >> index & 1]
+
+    def has(self, mask, label):
+        return bool(mask & self.bit(label))
+
+
+def label_change_groups(changes):
+    """Group label changes that can be applied in one batchModify call
+
+    Args:
+        changes: iterable of (email_id, add_mask, remove_mask)
+
+    Returns:
+        Dictionary of (add_mask, remove_mask) to the list of email IDs
+    """
+    groups = {}
+    for email_id, add_mask, remove_mask in changes:
+        groups.setdefault((add_mask, remove_mask), {})[email_id] = None
+    return {key: list(ids) for key, ids in groups.items()}
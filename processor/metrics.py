@@ -0,0 +1,210 @@
+import bisect
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metrics:
+    """Thread-safe counters and latency histograms.
+
+    Every metric is identified by a name and a set of labels, e.g.
+    ``metrics.inc('gmail_api_calls_total', method='users.messages.get', status='ok')``.
+    The registry renders itself in the Prometheus text format for daemon
+    mode and as a JSON-friendly summary for one-shot runs.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {
+                    'buckets': [0] * (len(self.buckets) + 1), 'count': 0, 'sum': 0.0, 'max': 0.0
+                }
+            histogram['buckets'][index] += 1
+            histogram['count'] += 1
+            histogram['sum'] += value
+            histogram['max'] = max(histogram['max'], value)
+
+    @contextmanager
+    def timed(self, name, **labels):
+        """Observe how long the block (or decorated function) takes"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def counter(self, name, **labels):
+        """Current value of a counter (0 if never incremented)"""
+        return self._counters.get(self._key(name, labels), 0)
+
+    def summary(self):
+        """Counters and histogram statistics as nested dictionaries
+
+        Returns:
+            {'counters': {name: {labels: value}},
+             'histograms': {name: {labels: {'count', 'sum', 'avg', 'max'}}}}
+            where labels is rendered as 'key=value,key=value'
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: dict(value) for key, value in self._histograms.items()}
+
+        result = {'counters': {}, 'histograms': {}}
+        for (name, labels), value in sorted(counters.items()):
+            result['counters'].setdefault(name, {})[_label_text(labels)] = value
+        for (name, labels), histogram in sorted(histograms.items()):
+            result['histograms'].setdefault(name, {})[_label_text(labels)] = {
+                'count': histogram['count'],
+                'sum': round(histogram['sum'], 6),
+                'avg': round(histogram['sum'] / histogram['count'], 6),
+                'max': round(histogram['max'], 6)
+            }
+        return result
+
+    def render_prometheus(self):
+        """Render every metric in the Prometheus text exposition format"""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: dict(value, buckets=list(value['buckets']))
+                          for key, value in self._histograms.items()}
+
+        lines = []
+        declared = set()
+        for (name, labels), value in sorted(counters.items()):
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{_prometheus_labels(labels)} {value}")
+
+        for (name, labels), histogram in sorted(histograms.items()):
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), histogram['buckets']):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{name}_bucket{_prometheus_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{_prometheus_labels(labels)} {histogram['sum']}")
+            lines.append(f"{name}_count{_prometheus_labels(labels)} {histogram['count']}")
+
+        return '\n'.join(lines) + '\n'
+
+
+def _label_text(labels):
+    return ','.join(f"{key}={value}" for key, value in labels)
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+# Process-wide registry used by the parse, database, rules and actions modules
+metrics = Metrics()
+
+
+class ApiMetrics:
+    """ServiceProxy hook counting and timing every Gmail API request by method"""
+
+    def __init__(self, registry=None):
+        self.registry = registry or metrics
+
+    def after_execute(self, method, elapsed, error):
+        self.registry.inc('gmail_api_calls_total', method=method, status='error' if error else 'ok')
+        self.registry.observe('gmail_api_seconds', elapsed, method=method)
+
+
+def write_summary(path, registry=None):
+    """Write the metrics summary as JSON ('-' for stdout)"""
+    content = json.dumps((registry or metrics).summary(), indent=2)
+    if path == '-':
+        print(content)
+    else:
+        with open(path, 'w') as file:
+            file.write(content + '\n')
+
+
+class MetricsServer:
+    """Serve the registry at /metrics for Prometheus to scrape"""
+
+    def __init__(self, registry=None, host='127.0.0.1', port=9100, path='/metrics'):
+        self.registry = registry or metrics
+        self.path = path
+        self._server = ThreadingHTTPServer((host, port), self._make_request_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}{self.path}"
+
+    def _make_request_handler(self):
+        server = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.partition('?')[0] != server.path:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = server.registry.render_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', PROMETHEUS_CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        return RequestHandler
+
+    def start(self):
+        """Serve requests on a background thread"""
+        self._thread = threading.Thread(target=self._server.serve_forever, name='metrics-server', daemon=True)
+        self._thread.start()
+        logger.info(f"Serving metrics on {self.url}")
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
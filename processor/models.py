@@ -0,0 +1,159 @@
+import sys
+from dataclasses import dataclass, field
+
+
+class DictCompat:
+    """Key access for slotted records, so code written against dicts keeps working"""
+    __slots__ = ()
+
+    # Dictionary key -> attribute name
+    _attrs = {}
+
+    def __getitem__(self, key):
+        try:
+            attr = self._attrs[key]
+        except KeyError:
+            raise KeyError(key) from None
+        return getattr(self, attr)
+
+    def __setitem__(self, key, value):
+        try:
+            attr = self._attrs[key]
+        except KeyError:
+            raise KeyError(key) from None
+        setattr(self, attr, value)
+
+    def __contains__(self, key):
+        return key in self._attrs
+
+    def get(self, key, default=None):
+        attr = self._attrs.get(key)
+        if attr is None:
+            return default
+        return getattr(self, attr)
+
+    def keys(self):
+        return list(self._attrs)
+
+    def to_dict(self):
+        return {key: getattr(self, attr) for key, attr in self._attrs.items()}
+
+
+@dataclass(slots=True, eq=False)
+class EmailRecord(DictCompat):
+    """Parsed email as it moves through the pipeline.
+
+    Label IDs are interned so thousands of records share the same few label
+    strings. The body can be loaded lazily: records read from the database
+    carry a loader and only fetch the body when a rule actually needs it.
+    Freshly fetched records keep the decoded body bytes and only build the
+    text when ``body`` is first read; rules match against ``body_raw``.
+    Key access (``record['from']``) is supported for code written against the
+    old email dictionaries.
+    """
+    id: str = None
+    thread_id: str = None
+    from_email: str = ''
+    to_email: str = ''
+    subject: str = ''
+    date: str = ''
+    is_read: bool = False
+    labels: tuple = ()
+    snippet: str = ''
+    # Gmail history ID of the message when it was fetched; with the body hash it fingerprints the stored row
+    history_id: str = None
+    _body: str = field(default=None, repr=False)
+    _body_loader: object = field(default=None, repr=False)
+
+    _attrs = {
+        'id': 'id',
+        'thread_id': 'thread_id',
+        'from': 'from_email',
+        'to': 'to_email',
+        'subject': 'subject',
+        'body': 'body',
+        'date': 'date',
+        'is_read': 'is_read',
+        'labels': 'labels',
+        'snippet': 'snippet'
+    }
+
+    def __post_init__(self):
+        self.labels = intern_labels(self.labels)
+
+    def __eq__(self, other):
+        if not isinstance(other, EmailRecord):
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
+
+    @property
+    def body(self):
+        if self._body is None:
+            self._body = self._body_loader(self.id) if self._body_loader else ''
+            self._body_loader = None
+        elif not isinstance(self._body, str):
+            self._body = str(self._body, 'utf-8', 'replace')
+        return self._body
+
+    @property
+    def body_raw(self):
+        """Body as stored in the record: text, or bytes if it has not been decoded yet"""
+        if self._body is None:
+            return self.body
+        return self._body
+
+    @body.setter
+    def body(self, value):
+        self._body = value
+        self._body_loader = None
+
+    @property
+    def body_loaded(self):
+        return self._body is not None
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            id=data.get('id'),
+            thread_id=data.get('thread_id'),
+            from_email=data.get('from') or '',
+            to_email=data.get('to') or '',
+            subject=data.get('subject') or '',
+            date=data.get('date') or '',
+            is_read=bool(data.get('is_read', False)),
+            labels=data.get('labels') or (),
+            snippet=data.get('snippet') or '',
+            _body=data.get('body') or '',
+        )
+
+    @classmethod
+    def coerce(cls, email_data):
+        """Return the argument if it is already a record, else build one from a dict"""
+        if isinstance(email_data, cls):
+            return email_data
+        return cls.from_dict(email_data)
+
+
+@dataclass(slots=True)
+class ActionItem(DictCompat):
+    """An action a rule wants applied to an email"""
+    rule_name: str
+    action: dict
+    email_id: str
+
+    _attrs = {'rule_name': 'rule_name', 'action': 'action', 'email_id': 'email_id'}
+
+    @classmethod
+    def coerce(cls, action_item):
+        if isinstance(action_item, cls):
+            return action_item
+        return cls(action_item['rule_name'], action_item['action'], action_item['email_id'])
+
+    @property
+    def action_type(self):
+        return self.action['type']
+
+
+def intern_labels(labels):
+    """Label IDs as a tuple of interned strings"""
+    return tuple(sys.intern(label) for label in labels)
@@ -0,0 +1,173 @@
+import email.utils
+import logging
+import re
+from functools import lru_cache
+
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_constants
+    import sre_parse
+
+try:  # the regex module can stop a runaway match after a timeout
+    import regex as _regex
+except ImportError:  # the standard re can't, so matches only look at a bounded prefix instead
+    _regex = None
+
+logger = logging.getLogger(__name__)
+
+# Operators compiled once per condition by compile_matcher
+STRUCTURED_OPERATORS = ('matches', 'in_list', 'domain_in')
+
+# Fields holding email addresses: in_list also compares the parsed addresses, domain_in their domains
+ADDRESS_FIELDS = ('from', 'to')
+
+# Seconds a single regex search may take (only enforced with the regex module)
+MATCH_TIMEOUT = 0.05
+
+# Characters a regex is run against when there is no timeout
+MATCH_INPUT_LIMIT = 100_000
+
+# Repeats that backtrack; possessive repeats and atomic groups (Python 3.11+) don't
+_REPEATS = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+_ATOMIC = (getattr(sre_constants, 'POSSESSIVE_REPEAT', None), getattr(sre_constants, 'ATOMIC_GROUP', None))
+
+
+@lru_cache(maxsize=4096)
+def header_addresses(header):
+    """Addresses in a From/To header as (address, domain) pairs, lowercased
+
+    Memoised, so the header of an email checked by many rules is parsed once.
+    """
+    addresses = []
+    for _, address in email.utils.getaddresses([header]):
+        address = address.strip().lower()
+        if address:
+            addresses.append((address, address.rpartition('@')[2]))
+    return tuple(addresses)
+
+
+def domain_in(domain, domains):
+    """Whether a domain, or any domain it is a subdomain of, is in the set"""
+    while domain:
+        if domain in domains:
+            return True
+        domain = domain.partition('.')[2]
+    return False
+
+
+def _values(value):
+    if value is None:
+        return ()
+    if isinstance(value, str):
+        return (value,)
+    return tuple(str(item) for item in value)
+
+
+def _repeats(parsed, atomic):
+    """(max, subpattern) of every repeat in a parsed pattern, however deeply nested
+
+    Atomic groups and possessive repeats are never backtracked into, so their
+    bodies are collected in atomic instead of being searched.
+    """
+    for op, av in parsed:
+        if op in _REPEATS:
+            yield av[1], av[2]
+            yield from _repeats(av[2], atomic)
+        elif op in _ATOMIC:
+            atomic.append(av[2] if isinstance(av, tuple) else av)
+        elif op is sre_constants.SUBPATTERN:
+            yield from _repeats(av[-1], atomic)
+        elif op is sre_constants.BRANCH:
+            for branch in av[1]:
+                yield from _repeats(branch, atomic)
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            yield from _repeats(av[1], atomic)
+        elif op is sre_constants.GROUPREF_EXISTS:
+            for branch in av[1:]:
+                if branch is not None:
+                    yield from _repeats(branch, atomic)
+
+
+def _nests(parsed):
+    atomic = []
+    for outer, sub in _repeats(parsed, atomic):
+        if outer > 1 and any(inner > 1 for inner, _ in _repeats(sub, [])):
+            return True
+    return any(_nests(body) for body in atomic)
+
+
+def nested_quantifier(value):
+    """Whether a pattern repeats something that repeats itself, like (a+)+
+
+    Such patterns can backtrack exponentially on a near miss. Patterns the
+    standard parser rejects (regex module syntax) are not checked.
+    """
+    try:
+        parsed = sre_parse.parse(value)
+    except Exception:
+        return False
+    return _nests(parsed)
+
+
+def compile_pattern(value, fold_case=True):
+    """Compiled regex for a matches condition, or None if it is invalid or nests quantifiers"""
+    flags = re.IGNORECASE if fold_case else 0
+    try:
+        if nested_quantifier(value):
+            logger.warning(f"Pattern {value!r} nests quantifiers and could take exponential time - ignoring it")
+            return None
+        if _regex is not None:
+            return _regex.compile(value, flags)
+        return re.compile(value, flags)
+    except Exception as e:  # re.error, regex.error (not a subclass of it) or a non-string value
+        logger.warning(f"Invalid pattern {value!r}: {e}")
+        return None
+
+
+def search(pattern, text, limit=MATCH_INPUT_LIMIT):
+    """pattern.search(text), guarded by a timeout or an input limit"""
+    if _regex is not None:
+        try:
+            return pattern.search(text, timeout=MATCH_TIMEOUT) is not None
+        except TimeoutError:
+            logger.warning(f"Pattern {pattern.pattern!r} timed out after {MATCH_TIMEOUT}s")
+            return False
+    return pattern.search(text if limit is None else text[:limit]) is not None
+
+
+def compile_matcher(field, operator, value, fold_case=True):
+    """Build the test for a structured condition once, so each email costs one call
+
+    Args:
+        field: rule field the condition looks at
+        operator: matches, in_list or domain_in
+        value: pattern (matches) or list of values (in_list, domain_in)
+        fold_case: compare case-insensitively
+
+    Returns:
+        Function of the field's text returning whether it matches, or None if
+        the condition can't be compiled (it then matches nothing)
+    """
+    if operator == 'matches':
+        pattern = compile_pattern(value, fold_case)
+        if pattern is None:
+            return None
+        return lambda text: search(pattern, text)
+
+    if operator == 'in_list':
+        values = frozenset(item.strip().lower() if fold_case else item.strip() for item in _values(value))
+        if field not in ADDRESS_FIELDS:
+            return lambda text: (text.strip().lower() if fold_case else text.strip()) in values
+        # The whole header, or any address in it
+        return lambda text: (text.strip().lower() in values
+                             or any(address in values for address, _ in header_addresses(text)))
+
+    if operator == 'domain_in':
+        if field not in ADDRESS_FIELDS:
+            logger.warning(f"domain_in needs an address field, not {field}")
+            return None
+        domains = frozenset(item.strip().lower().lstrip('@') for item in _values(value))
+        return lambda text: any(domain_in(domain, domains) for _, domain in header_addresses(text))
+
+    return None
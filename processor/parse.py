@@ -1,11 +1,20 @@
-import base64
 import logging
+import time
 
+from processor.body import decode_part, decode_text
 from processor.database import EmailDatabase
+from processor.metrics import metrics
+from processor.models import EmailRecord
+from processor.priority import email_timestamp
+from processor.quota import charge_batch
 
 logger = logging.getLogger(__name__)
 
+# Requests per batched label refresh (Gmail allows up to 100 per batch)
+REFRESH_BATCH_SIZE = 100
 
+
+@metrics.timed('email_fetch_seconds')
 def parse_email_content(service, message_id):
     """
     Parse full email content from message ID
@@ -15,7 +24,7 @@ def parse_email_content(service, message_id):
         message_id: Gmail message ID
     
     Returns:
-        Dictionary with parsed email data
+        EmailRecord with parsed email data
     """
     try:
         message = service.users().messages().get(
@@ -24,119 +33,285 @@ def parse_email_content(service, message_id):
             format='full'
         ).execute()
 
-        email_data = {
-            'id': message['id'],
-            'thread_id': message['threadId'],
-            'labels': message.get('labelIds', []),
-            'snippet': message.get('snippet', ''),
-            'from': '',
-            'to': '',
-            'subject': '',
-            'date': '',
-            'body': '',
-            'is_read': 'UNREAD' not in message.get('labelIds', [])
-        }
-
-        headers = message['payload'].get('headers', [])
-        for header in headers:
-            name = header['name'].lower()
-            if name == 'from':
-                email_data['from'] = header['value']
-            elif name == 'to':
-                email_data['to'] = header['value']
-            elif name == 'subject':
-                email_data['subject'] = header['value']
-            elif name == 'date':
-                email_data['date'] = header['value']
-
-        email_data['body'] = extract_body(message['payload'])
-
-        return email_data
+        return parse_message(message)
 
     except Exception as error:
         logger.error(f'Error parsing email {message_id}: {error}')
+        metrics.inc('email_fetch_errors_total')
         return None
 
 
+def parse_message(message):
+    """Build an EmailRecord from a message resource fetched with format='full'"""
+    labels = message.get('labelIds', [])
+    email_data = EmailRecord(
+        id=message['id'],
+        thread_id=message['threadId'],
+        labels=labels,
+        snippet=message.get('snippet', ''),
+        is_read='UNREAD' not in labels,
+        history_id=message.get('historyId')
+    )
+
+    headers = message['payload'].get('headers', [])
+    for header in headers:
+        name = header['name'].lower()
+        if name == 'from':
+            email_data.from_email = header['value']
+        elif name == 'to':
+            email_data.to_email = header['value']
+        elif name == 'subject':
+            email_data.subject = header['value']
+        elif name == 'date':
+            email_data.date = header['value']
+
+    email_data.body = extract_body_bytes(message['payload'])
+
+    return email_data
+
+
 def extract_body(payload):
     """Extract email body from payload"""
-    body = ""
+    return decode_text(extract_body_bytes(payload))
+
+
+def extract_body_bytes(payload):
+    """Extract the email body from a payload as bytes, decoding base64 once and leaving the text undecoded"""
+    body = b""
 
     if 'parts' in payload:
         for part in payload['parts']:
             if part['mimeType'] == 'text/plain':
                 if 'data' in part['body']:
-                    body = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
+                    body = decode_part(part['body']['data'])
                     break
             elif part['mimeType'] == 'text/html' and not body:
                 if 'data' in part['body']:
-                    body = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
+                    body = decode_part(part['body']['data'])
     else:
         if payload['mimeType'] == 'text/plain':
             if 'data' in payload['body']:
-                body = base64.urlsafe_b64decode(payload['body']['data']).decode('utf-8')
+                body = decode_part(payload['body']['data'])
 
     return body
 
 
-def fetch_and_parse_emails(service, query='in:all', max_results=3):
+def fetch_and_parse_emails(service, query='in:all', max_results=3, db=None):
     """Check if we have already fetched the entries from email and had in database
     else fetch and parse the content again
     Args:
         service:
         query:
         max_results:
+        db: EmailDatabase to use, a default one is opened when not given
 
     Returns:
         List of emails
     """
-    db = EmailDatabase()
+    db = db or EmailDatabase()
     try:
-        results = service.users().messages().list(
-            userId='me',
-            q=query,
-            maxResults=max_results
-        ).execute()
+        email_ids, _ = list_message_ids(service, query, max_results)
+
+        if not email_ids:
+            return []
+
+        return load_emails(service, email_ids, db)
+
+    except Exception as error:
+        logger.error(f'Error fetching emails: {error}')
+        return []
+
 
-        messages = results.get('messages', [])
+def list_message_ids(service, query='in:all', max_results=100, page_token=None):
+    """List one page of message IDs
 
-        if not messages:
-            return messages
+    Args:
+        service: Gmail API service object
+        query: Gmail search query
+        max_results: page size
+        page_token: token of the page to list, from a previous call
 
-        existing_emails = []
-        new_email_ids = []
+    Returns:
+        Tuple of (message IDs, next page token or None)
+    """
+    results = service.users().messages().list(
+        userId='me',
+        q=query,
+        maxResults=max_results,
+        pageToken=page_token
+    ).execute()
 
-        for message in messages:
-            email_id = message['id']
-            if db.email_exists(email_id):
-                existing_emails.append(email_id)
-            else:
-                new_email_ids.append(email_id)
+    email_ids = [message['id'] for message in results.get('messages', [])]
+    return email_ids, results.get('nextPageToken')
 
-        parsed_emails = []
-        if existing_emails:
-            logger.info(f"Loading {len(existing_emails)} emails from database")
-            db_emails = db.get_emails_by_ids(existing_emails)
-            parsed_emails.extend(db_emails)
 
-        new_emails = []
+def fetch_minimal(service, email_ids, batch_size=REFRESH_BATCH_SIZE):
+    """Fetch messages with format='minimal' (labels, history ID, received time) in batches
 
-        for i, email_id in enumerate(new_email_ids, 1):
-            email_data = parse_email_content(service, email_id)
-            if email_data:
-                new_emails.append(email_data)
+    One HTTP round trip per batch of batch_size messages.
 
-        if new_emails:
-            logger.info(f"Storing {len(new_emails)} new emails in database")
-            db.insert_emails(new_emails)
-            parsed_emails.extend(new_emails)
+    Returns:
+        Dictionary of email ID to message, for the emails Gmail answered for
+    """
+    responses = {}
 
-        logger.info(f"Total emails processed: {len(parsed_emails)} ({len(existing_emails)} from DB, {len(new_email_ids)} from Gmail)")
+    def collect(request_id, response, exception):
+        if exception is not None:
+            logger.error(f'Error fetching labels of email {request_id}: {exception}')
+            metrics.inc('email_fetch_errors_total')
+            return
+        responses[request_id] = response
 
-        parsed_emails.sort(key=lambda x: x.get('date', ''), reverse=True)
+    email_ids = list(dict.fromkeys(email_ids))
+    for start in range(0, len(email_ids), batch_size):
+        batch = service.new_batch_http_request(callback=collect)
+        for email_id in email_ids[start:start + batch_size]:
+            batch.add(service.users().messages().get(userId='me', id=email_id, format='minimal'),
+                      request_id=email_id)
+        try:
+            charge_batch(service, 'users.messages.get', len(email_ids[start:start + batch_size]))
+            batch.execute()
+        except Exception as error:
+            logger.error(f'Error fetching labels of {len(email_ids[start:start + batch_size])} emails: {error}')
+    return responses
 
-        return parsed_emails
 
-    except Exception as error:
-        logger.error(f'Error fetching emails: {error}')
-        return []
+def refresh_labels(service, db, email_ids, batch_size=REFRESH_BATCH_SIZE):
+    """Bring the labels and read state of stored emails up to date
+
+    The messages are requested with format='minimal' in batches of
+    batch_size, one HTTP round trip per batch. Changed labels are written in
+    bulk and every answered email gets a refreshed_at timestamp.
+
+    Returns:
+        Dictionary of email ID to current label IDs, for the emails Gmail answered for
+    """
+    states = {email_id: (response.get('labelIds', []), response.get('historyId'))
+              for email_id, response in fetch_minimal(service, email_ids, batch_size).items()}
+
+    changed = db.update_labels(((email_id, labels, history_id) for email_id, (labels, history_id) in states.items()),
+                               refreshed_at=time.time())
+    logger.info(f"Refreshed labels of {len(states)} stored emails ({changed} changed)")
+    return {email_id: labels for email_id, (labels, _) in states.items()}
+
+
+def fetch_order(service, email_ids):
+    """Order emails to fetch most valuable first: unread, then newest
+
+    Costs one batched format='minimal' request per 100 emails, far less than
+    fetching them in full. Emails Gmail didn't answer for keep their place
+    after the ranked ones.
+    """
+    if len(email_ids) < 2:
+        return list(email_ids)
+    responses = fetch_minimal(service, email_ids)
+
+    def rank(email_id):
+        response = responses.get(email_id)
+        if response is None:
+            return False, False, 0
+        return True, 'UNREAD' in response.get('labelIds', ()), int(response.get('internalDate') or 0)
+
+    # sort() is stable, so equal ranks keep the list order (newest first)
+    return sorted(email_ids, key=rank, reverse=True)
+
+
+def load_emails(service, email_ids, db, refresh=False, deadline=None, fresh=None):
+    """Load emails from the database, fetching and storing the ones not seen before
+
+    Args:
+        service: Gmail API service object
+        email_ids: Gmail message IDs
+        db: EmailDatabase
+        refresh: bring the labels of stored emails up to date with batched
+            format='minimal' requests (message content never changes, so
+            stored emails are not fetched in full again)
+        deadline: optional Deadline; emails not fetched before it expires are
+            left for the next run. With a time limit, new emails are fetched
+            unread first, then newest first (see fetch_order)
+        fresh: optional set, filled with the IDs of the emails whose labels
+            were just read from Gmail (fetched, or refreshed successfully)
+
+    Returns:
+        List of emails, newest first
+    """
+    existing_emails = []
+    new_email_ids = []
+
+    for email_id in email_ids:
+        if db.email_exists(email_id):
+            existing_emails.append(email_id)
+        else:
+            new_email_ids.append(email_id)
+
+    parsed_emails = []
+    if existing_emails:
+        if refresh:
+            refreshed = refresh_labels(service, db, existing_emails)
+            if fresh is not None:
+                fresh.update(refreshed)
+        logger.info(f"Loading {len(existing_emails)} emails from database")
+        db_emails = db.get_emails_by_ids(existing_emails)
+        parsed_emails.extend(db_emails)
+
+    new_emails = []
+    if deadline is not None and deadline.remaining() is not None:
+        new_email_ids = fetch_order(service, new_email_ids)
+
+    for index, email_id in enumerate(new_email_ids):
+        if deadline is not None and deadline.expired():
+            logger.info(f"Run deadline reached - {len(new_email_ids) - index} emails left for the next run")
+            break
+        email_data = parse_email_content(service, email_id)
+        if email_data:
+            new_emails.append(email_data)
+
+    if new_emails:
+        logger.info(f"Storing {len(new_emails)} new emails in database")
+        db.insert_emails(new_emails)
+        parsed_emails.extend(new_emails)
+        if fresh is not None:
+            fresh.update(email_data.id for email_data in new_emails)
+
+    logger.info(f"Total emails processed: {len(parsed_emails)} ({len(existing_emails)} from DB, {len(new_email_ids)} from Gmail)")
+    metrics.inc('emails_loaded_total', len(existing_emails), source='db')
+    metrics.inc('emails_loaded_total', len(new_emails), source='gmail')
+
+    parsed_emails.sort(key=email_timestamp, reverse=True)
+
+    return parsed_emails
+
+
+def fetch_history(service, start_history_id):
+    """List messages added or relabelled since a mailbox history ID
+
+    Args:
+        service: Gmail API service object
+        start_history_id: history ID to start from (exclusive)
+
+    Returns:
+        Tuple of (message IDs in first-seen order, latest history ID)
+    """
+    message_ids = {}
+    latest_history_id = start_history_id
+    page_token = None
+
+    while True:
+        results = service.users().history().list(
+            userId='me',
+            startHistoryId=start_history_id,
+            historyTypes=['messageAdded', 'labelAdded', 'labelRemoved'],
+            pageToken=page_token
+        ).execute()
+
+        for record in results.get('history', []):
+            for key in ('messagesAdded', 'labelsAdded', 'labelsRemoved'):
+                for change in record.get(key, []):
+                    message_ids.setdefault(change['message']['id'], None)
+
+        latest_history_id = results.get('historyId', latest_history_id)
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+
+    return list(message_ids), latest_history_id
@@ -0,0 +1,279 @@
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+
+from processor.actions import EmailActions
+from processor.parse import fetch_order, list_message_ids, parse_email_content
+from processor.priority import Deadline, action_rank, rule_priorities
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of a stage's input
+_DONE = object()
+
+
+class PipelineError(Exception):
+    """Raised by Pipeline.run when a stage failed"""
+
+
+class RankedQueue(queue.PriorityQueue):
+    """Bounded queue of (rank, item) pairs handing out the highest ranked item first
+
+    Equal ranks come out in the order they were put, and _DONE after everything else.
+    """
+
+    def _init(self, maxsize):
+        super()._init(maxsize)
+        self._order = itertools.count()
+
+    def _put(self, entry):
+        if entry is _DONE:
+            key, item = (1,), _DONE
+        else:
+            rank, item = entry
+            key = (0,) + tuple(-value for value in rank)
+        heapq.heappush(self.queue, (key, next(self._order), item))
+
+    def _get(self):
+        return heapq.heappop(self.queue)[-1]
+
+
+class Pipeline:
+    """Process emails in overlapping stages connected by bounded queues.
+
+        lister -> fetchers -> writer -> evaluator -> executors
+
+    The lister pages through message IDs, fetchers load each email from the
+    database or Gmail, the writer stores new emails, the evaluator applies
+    the rules and executors run the resulting actions. Every queue holds at
+    most ``queue_size`` items, so a fast stage waits for a slow one instead
+    of buffering the whole mailbox, and the first actions run while later
+    pages are still being fetched. Executors take the highest ranked
+    buffered action first (see processor.priority.order_actions).
+
+    With a deadline, each page is fetched unread first (see
+    processor.parse.fetch_order). Once it expires the lister stops and the
+    other stages drop what is still queued instead of working on it, so
+    those emails and actions are left for the next run.
+
+    The Gmail client is not thread-safe: pass ``service_factory`` to give
+    the lister and each fetcher and executor thread its own service. Without it all
+    threads share ``service`` (fine for fakes and mocks).
+
+    If any stage raises, every stage stops and run() raises PipelineError.
+    """
+
+    def __init__(self, service, db, rule_engine, actions=None, fetch_workers=4, action_workers=1,
+                 queue_size=100, page_size=100, service_factory=None):
+        self.service = service
+        self.db = db
+        self.rule_engine = rule_engine
+        self.actions = actions
+        self.fetch_workers = fetch_workers
+        self.action_workers = action_workers
+        self.queue_size = queue_size
+        self.page_size = page_size
+        self.service_factory = service_factory
+
+        self._stop = threading.Event()
+        self._deadline = Deadline()
+        self._errors = []
+        self._stats_lock = threading.Lock()
+        self.stats = {}
+
+    def _new_service(self):
+        return self.service_factory() if self.service_factory else self.service
+
+    def _count(self, key, amount=1):
+        with self._stats_lock:
+            self.stats[key] += amount
+
+    def _put(self, out_queue, item):
+        """Put with backpressure, giving up if the pipeline is stopping"""
+        while not self._stop.is_set():
+            try:
+                out_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, in_queue):
+        while not self._stop.is_set():
+            try:
+                return in_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _start_stage(self, name, workers, target, in_queue, out_queue, downstream_workers):
+        """Start the threads of a stage; the last one to finish signals the next stage"""
+        remaining = [workers]
+        lock = threading.Lock()
+
+        def run(index):
+            try:
+                target(in_queue, out_queue)
+            except Exception as e:
+                logger.error(f"Pipeline stage '{name}' failed: {e}")
+                self._errors.append((name, e))
+                self._stop.set()
+            finally:
+                with lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last and out_queue is not None:
+                    for _ in range(downstream_workers):
+                        self._put(out_queue, _DONE)
+
+        threads = [threading.Thread(target=run, args=(i,), name=f'pipeline-{name}-{i}', daemon=True)
+                   for i in range(workers)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def _list(self, limit, query):
+        def target(_, out_queue):
+            service = self._new_service()
+            page_token = None
+            listed = 0
+            while listed < limit and not self._stop.is_set() and not self._deadline.expired():
+                email_ids, page_token = list_message_ids(service, query, min(self.page_size, limit - listed),
+                                                         page_token)
+                if self._deadline.remaining() is not None:
+                    # Stored emails cost nothing to load; rank the ones to fetch
+                    stored = {email_id for email_id in email_ids if self.db.email_exists(email_id)}
+                    email_ids = [email_id for email_id in email_ids if email_id in stored] + fetch_order(
+                        service, [email_id for email_id in email_ids if email_id not in stored])
+                for email_id in email_ids:
+                    if not self._put(out_queue, email_id):
+                        return
+                listed += len(email_ids)
+                self._count('listed', len(email_ids))
+                if not page_token or not email_ids:
+                    break
+        return target
+
+    def _fetch(self, in_queue, out_queue):
+        service = self._new_service()
+        while True:
+            email_id = self._get(in_queue)
+            if email_id is _DONE:
+                return
+            if self._deadline.expired():
+                self._count('skipped')
+                continue
+            if self.db.email_exists(email_id):
+                records = self.db.get_emails_by_ids([email_id])
+                item = (records[0], False) if records else None
+            else:
+                record = parse_email_content(service, email_id)
+                item = (record, True) if record else None
+            if item is None:
+                self._count('fetch_failed')
+                continue
+            if not self._put(out_queue, item):
+                return
+
+    def _write(self, in_queue, out_queue):
+        while True:
+            item = self._get(in_queue)
+            if item is _DONE:
+                return
+            record, is_new = item
+            if is_new:
+                self.db.insert_email(record)
+                self._count('new')
+            self._count('emails')
+            if not self._put(out_queue, record):
+                return
+
+    def _evaluate(self, in_queue, out_queue):
+        priorities = rule_priorities(self.rule_engine.rules)
+        while True:
+            record = self._get(in_queue)
+            if record is _DONE:
+                return
+            for action_item in self.rule_engine.get_actions_for_email(record):
+                self._count('actions')
+                rank = action_rank(action_item, {record.id: record}, priorities)
+                if not self._put(out_queue, (rank, action_item)):
+                    return
+
+    def _execute(self, in_queue, _):
+        # The shared EmailActions is bound to self.service, so only without per-thread services
+        if self.actions is not None and self.action_workers == 1 and self.service_factory is None:
+            actions = self.actions
+        else:
+            actions = EmailActions(self._new_service(), db=self.db)
+        try:
+            while True:
+                action_item = self._get(in_queue)
+                if action_item is _DONE:
+                    return
+                if self._deadline.expired():
+                    self._count('deferred')
+                    continue
+                with self._stats_lock:
+                    if self.stats['first_action_after'] is None:
+                        self.stats['first_action_after'] = time.perf_counter() - self._started
+                try:
+                    succeeded = actions.execute_action(action_item)
+                except Exception as e:
+                    logger.error(f"Unexpected error executing action: {e}")
+                    succeeded = False
+                self._count('succeeded' if succeeded else 'failed')
+        finally:
+            actions.audit.flush()
+
+    def run(self, limit=100, query='in:all', deadline=None):
+        """Process up to limit emails
+
+        Args:
+            limit: emails to list
+            query: Gmail search query
+            deadline: optional Deadline; work not started by then is left for the next run
+
+        Returns:
+            Dictionary of counters: listed, emails, new, fetch_failed, skipped
+            (listed but not fetched), actions, succeeded, failed, deferred
+            (generated but not executed), elapsed and first_action_after (seconds)
+        """
+        self._stop.clear()
+        self._errors = []
+        self._deadline = deadline if deadline is not None else Deadline()
+        self.stats = {'listed': 0, 'emails': 0, 'new': 0, 'fetch_failed': 0, 'skipped': 0, 'actions': 0,
+                      'succeeded': 0, 'failed': 0, 'deferred': 0, 'elapsed': 0.0, 'first_action_after': None}
+        self._started = time.perf_counter()
+
+        ids_queue = queue.Queue(self.queue_size)
+        fetched_queue = queue.Queue(self.queue_size)
+        stored_queue = queue.Queue(self.queue_size)
+        actions_queue = RankedQueue(self.queue_size)
+
+        threads = []
+        threads += self._start_stage('list', 1, self._list(limit, query), None, ids_queue, self.fetch_workers)
+        threads += self._start_stage('fetch', self.fetch_workers, self._fetch, ids_queue, fetched_queue, 1)
+        threads += self._start_stage('write', 1, self._write, fetched_queue, stored_queue, 1)
+        threads += self._start_stage('evaluate', 1, self._evaluate, stored_queue, actions_queue,
+                                     self.action_workers)
+        threads += self._start_stage('execute', self.action_workers, self._execute, actions_queue, None, 0)
+
+        for thread in threads:
+            thread.join()
+
+        self.stats['elapsed'] = time.perf_counter() - self._started
+        logger.info(f"Pipeline processed {self.stats['emails']} emails ({self.stats['new']} new), "
+                    f"{self.stats['succeeded']} actions successful, {self.stats['failed']} failed "
+                    f"in {self.stats['elapsed']:.1f}s")
+        if self.stats['skipped'] or self.stats['deferred']:
+            logger.info(f"Run deadline reached - {self.stats['skipped']} emails and {self.stats['deferred']} "
+                        f"actions left for the next run")
+
+        if self._errors:
+            name, error = self._errors[0]
+            raise PipelineError(f"Stage '{name}' failed: {error}") from error
+        return self.stats
@@ -0,0 +1,217 @@
+import json
+import logging
+from datetime import datetime, timezone
+
+from googleapiclient.errors import HttpError
+
+from processor.actions import BATCH_MODIFY_LIMIT, EmailActions
+from processor.authenticate import write_atomic
+from processor.labels import SYSTEM_LABELS
+from processor.models import ActionItem
+from processor.quota import quota_cost
+
+logger = logging.getLogger(__name__)
+
+PLAN_VERSION = 2
+
+
+def label_change_names(action):
+    """Label names an action adds and removes, or None if it is not a label change
+
+    Returns:
+        Tuple of (label names to add, label names to remove)
+    """
+    action_type = action['type']
+    if action_type == 'mark_as_read':
+        return (), ('UNREAD',)
+    if action_type == 'mark_as_unread':
+        return ('UNREAD',), ()
+    if action_type == 'move_message':
+        folder = action.get('folder', 'INBOX')
+        if folder.upper() == 'INBOX':
+            return ('INBOX',), ()
+        if folder.upper() == 'TRASH':
+            return None
+        return (folder,), ()
+    return None
+
+
+def build_plan(actions_list, email_actions, emails=0):
+    """Turn generated actions into the smallest set of Gmail API calls, without making them.
+
+    Actions already recorded in email_actions are dropped. Label changes are
+    grouped by the labels they add and remove into batchModify calls of up to
+    1000 messages, including emails whose stored labels look up to date: they
+    may be stale, and adding a label an email has is a no-op. Trash needs one
+    call per message, and labels that do not exist yet are created first.
+    Only read-only calls are made (listing labels).
+
+    Args:
+        actions_list: actions from the rule engine
+        email_actions: EmailActions, for the action log and label lookups
+        emails: number of emails the actions came from (for the report)
+
+    Returns:
+        Plan dictionary, ready for save_plan() or apply_plan()
+    """
+    items = [ActionItem.coerce(item) for item in actions_list]
+
+    already_done = 0
+    unsupported = []
+    labels_to_create = set()
+    changes = {}
+    trash = {}
+
+    for item in items:
+        action_type = EmailActions.action_type_for(item.action)
+        if email_actions.action_already_performed(item.email_id, item.rule_name, action_type):
+            already_done += 1
+            continue
+        entry = {'email_id': item.email_id, 'rule_name': item.rule_name, 'action_type': action_type}
+
+        if item.action['type'] == 'move_message' and item.action.get('folder', '').upper() == 'TRASH':
+            trash.setdefault(item.email_id, []).append(entry)
+            continue
+
+        change = label_change_names(item.action)
+        if change is None:
+            unsupported.append(entry)
+            continue
+
+        add, remove = change
+        labels_to_create.update(name for name in add + remove if _known_label_id(email_actions, name) is None)
+        changes.setdefault((add, remove), {}).setdefault(item.email_id, []).append(entry)
+
+    calls = [{'method': 'users.labels.create', 'label': name} for name in sorted(labels_to_create)]
+    for (add, remove), entries_by_email in changes.items():
+        ids = list(entries_by_email)
+        for start in range(0, len(ids), BATCH_MODIFY_LIMIT):
+            chunk = ids[start:start + BATCH_MODIFY_LIMIT]
+            calls.append({
+                'method': 'users.messages.batchModify',
+                'add': list(add),
+                'remove': list(remove),
+                'ids': chunk,
+                'items': [entry for email_id in chunk for entry in entries_by_email[email_id]]
+            })
+    for email_id, entries in trash.items():
+        calls.append({'method': 'users.messages.trash', 'id': email_id, 'items': entries})
+
+    call_counts = {}
+    for call in calls:
+        call_counts[call['method']] = call_counts.get(call['method'], 0) + 1
+
+    return {
+        'version': PLAN_VERSION,
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'emails': emails,
+        'actions': len(items),
+        'already_done': already_done,
+        'unsupported': unsupported,
+        'calls': calls,
+        'call_counts': call_counts,
+        'quota_units': sum(quota_cost(call['method']) for call in calls)
+    }
+
+
+def _known_label_id(email_actions, name):
+    if name in SYSTEM_LABELS:
+        return name
+    return email_actions.get_label_id(name)
+
+
+def format_plan(plan):
+    """Human-readable summary of a plan"""
+    lines = [
+        f"Plan for {plan['actions']} actions on {plan['emails']} emails:",
+        f"  already done:       {plan['already_done']}",
+        f"  unsupported:        {len(plan['unsupported'])}",
+        f"  API calls:          {len(plan['calls'])}",
+    ]
+    for method, count in sorted(plan['call_counts'].items()):
+        lines.append(f"    {method:<30} {count:>6} x {quota_cost(method)} units")
+    lines.append(f"  estimated quota:    {plan['quota_units']} units")
+    return '\n'.join(lines)
+
+
+def save_plan(plan, path):
+    write_atomic(path, json.dumps(plan, indent=2))
+
+
+def load_plan(path):
+    with open(path, 'r') as file:
+        plan = json.load(file)
+    if plan.get('version') != PLAN_VERSION:
+        raise ValueError(f"Unsupported plan version in {path}: {plan.get('version')}")
+    return plan
+
+
+def apply_plan(plan, email_actions):
+    """Execute a saved plan without re-evaluating any rules.
+
+    Actions recorded since the plan was made are skipped, so applying the same
+    plan twice is safe.
+
+    Returns:
+        Tuple of (successful, failed) action counts
+    """
+    service = email_actions.service
+    succeeded = failed = 0
+
+    def record(entries, details, status='success'):
+        nonlocal succeeded, failed
+        for entry in entries:
+            email_actions.record_action(entry['email_id'], entry['rule_name'], entry['action_type'], details, status)
+            if status == 'success':
+                succeeded += 1
+            else:
+                failed += 1
+
+    def pending(entries):
+        return [entry for entry in entries if not email_actions.action_already_performed(
+            entry['email_id'], entry['rule_name'], entry['action_type'])]
+
+    try:
+        record(plan['unsupported'], 'Unknown action type', 'failed')
+
+        for call in plan['calls']:
+            method = call['method']
+            if method == 'users.labels.create':
+                email_actions.get_or_create_label(call['label'])
+                continue
+
+            entries = pending(call['items'])
+            if not entries:
+                continue
+            try:
+                if method == 'users.messages.batchModify':
+                    ids = list(dict.fromkeys(entry['email_id'] for entry in entries))
+                    add = [_resolve_label(email_actions, name) for name in call['add']]
+                    remove = [_resolve_label(email_actions, name) for name in call['remove']]
+                    if None in add or None in remove:
+                        record(entries, 'Label could not be created', 'failed')
+                        continue
+                    service.users().messages().batchModify(
+                        userId='me',
+                        body={'ids': ids, 'addLabelIds': add, 'removeLabelIds': remove}
+                    ).execute()
+                    record(entries, 'Applied from plan')
+                elif method == 'users.messages.trash':
+                    service.users().messages().trash(userId='me', id=call['id']).execute()
+                    record(entries, 'Moved to trash')
+                else:
+                    record(entries, f'Unknown call {method}', 'failed')
+            except HttpError as error:
+                logger.error(f"Error applying {method} for {len(entries)} actions: {error}")
+                record(entries, f'Error: {error}', 'failed')
+    finally:
+        email_actions.audit.flush()
+
+    logger.info(f"Plan applied: {succeeded} successful, {failed} failed")
+    return succeeded, failed
+
+
+def _resolve_label(email_actions, name):
+    if name in SYSTEM_LABELS:
+        return name
+    return email_actions.get_or_create_label(name)
@@ -0,0 +1,68 @@
+import email.utils
+import logging
+import time
+
+from processor.models import ActionItem
+
+logger = logging.getLogger(__name__)
+
+
+class Deadline:
+    """Time limit for a run; Deadline(None) never expires"""
+
+    def __init__(self, seconds=None, clock=time.monotonic):
+        self.seconds = seconds
+        self._clock = clock
+        self._ends = None if seconds is None else clock() + seconds
+
+    def remaining(self):
+        """Seconds left (None without a limit)"""
+        if self._ends is None:
+            return None
+        return max(self._ends - self._clock(), 0.0)
+
+    def expired(self):
+        return self._ends is not None and self._clock() >= self._ends
+
+
+def email_timestamp(email_data):
+    """When an email was received, as epoch seconds (0 if the Date header can't be parsed)"""
+    try:
+        return email.utils.parsedate_to_datetime(email_data.date).timestamp()
+    except (TypeError, ValueError, AttributeError):
+        return 0.0
+
+
+def rule_priorities(rules):
+    """Priority declared by each rule ("priority", default 0; higher runs first)"""
+    priorities = {}
+    for rule in rules:
+        try:
+            priorities[rule.get('name', 'Unknown Rule')] = int(rule.get('priority', 0))
+        except (TypeError, ValueError):
+            logger.warning(f"Ignoring invalid priority of rule '{rule.get('name')}': {rule.get('priority')}")
+            priorities[rule.get('name', 'Unknown Rule')] = 0
+    return priorities
+
+
+def action_rank(action_item, emails_by_id, priorities):
+    """Rank of an action: (rule priority, unread, received time); higher ranks run first"""
+    email_data = emails_by_id.get(action_item.email_id)
+    if email_data is None:
+        return priorities.get(action_item.rule_name, 0), 0, 0.0
+    return priorities.get(action_item.rule_name, 0), int(not email_data.is_read), email_timestamp(email_data)
+
+
+def order_actions(actions_list, emails, rules):
+    """Sort actions most valuable first: rule priority, then unread mail, then newest mail
+
+    Returns:
+        Tuple of (sorted ActionItems, their ranks in the same order)
+    """
+    emails_by_id = {email_data.id: email_data for email_data in emails}
+    priorities = rule_priorities(rules)
+    ranked = [(action_rank(item, emails_by_id, priorities), index, item)
+              for index, item in enumerate(ActionItem.coerce(item) for item in actions_list)]
+    # The generation order breaks ties, so equal actions keep their order
+    ranked.sort(key=lambda entry: (entry[0], -entry[1]), reverse=True)
+    return [item for _, _, item in ranked], [rank for rank, _, _ in ranked]
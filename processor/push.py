@@ -0,0 +1,216 @@
+import base64
+import json
+import logging
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+
+def register_watch(service, topic_name, label_ids=None):
+    """Ask Gmail to publish mailbox changes to a Pub/Sub topic
+
+    Args:
+        service: Gmail API service object
+        topic_name: full topic name, e.g. projects/my-project/topics/gmail
+        label_ids: only notify for changes to these labels (default: all)
+
+    Returns:
+        Watch response with 'historyId' and 'expiration'
+    """
+    body = {'topicName': topic_name}
+    if label_ids:
+        body['labelIds'] = label_ids
+        body['labelFilterBehavior'] = 'include'
+
+    response = service.users().watch(userId='me', body=body).execute()
+    logger.info(f"Registered Gmail watch on {topic_name} (historyId: {response.get('historyId')})")
+    return response
+
+
+def stop_watch(service):
+    """Stop push notifications for the mailbox"""
+    service.users().stop(userId='me').execute()
+
+
+def decode_push_message(body):
+    """Decode a Pub/Sub push request body into a Gmail notification
+
+    Args:
+        body: raw request body (bytes)
+
+    Returns:
+        Dictionary with 'emailAddress' and 'historyId'
+
+    Raises:
+        ValueError if the body is not a Gmail push message
+    """
+    try:
+        envelope = json.loads(body)
+        data = base64.b64decode(envelope['message']['data'])
+        notification = json.loads(data)
+        return {
+            'emailAddress': notification['emailAddress'],
+            'historyId': int(notification['historyId'])
+        }
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid push message: {e}")
+
+
+def encode_push_message(email_address, history_id, message_id='1'):
+    """Build a Pub/Sub push request body, as Google would send it"""
+    data = json.dumps({'emailAddress': email_address, 'historyId': history_id}).encode('utf-8')
+    return json.dumps({
+        'message': {
+            'data': base64.b64encode(data).decode('ascii'),
+            'messageId': message_id
+        },
+        'subscription': 'projects/local/subscriptions/gmail-push'
+    }).encode('utf-8')
+
+
+def publish_notification(url, email_address, history_id, message_id='1'):
+    """Post a fake push notification to a receiver (local stand-in for Pub/Sub)
+
+    Returns:
+        HTTP status code of the response
+    """
+    request = urllib.request.Request(
+        url,
+        data=encode_push_message(email_address, history_id, message_id),
+        headers={'Content-Type': 'application/json'},
+        method='POST'
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return response.status
+
+
+class Debouncer:
+    """Collapse bursts of notifications into a single callback.
+
+    The callback receives the highest history ID seen once no notification has
+    arrived for ``delay`` seconds, or after ``max_delay`` seconds of
+    continuous notifications.
+    """
+
+    def __init__(self, callback, delay=2.0, max_delay=30.0):
+        self.callback = callback
+        self.delay = delay
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._run_lock = threading.Lock()
+        self._timer = None
+        self._history_id = None
+        self._first_seen = None
+
+    def submit(self, history_id):
+        with self._lock:
+            if self._history_id is None or history_id > self._history_id:
+                self._history_id = history_id
+
+            now = time.monotonic()
+            if self._first_seen is None:
+                self._first_seen = now
+
+            if self._timer:
+                self._timer.cancel()
+            wait = min(self.delay, max(0.0, self._first_seen + self.max_delay - now))
+            self._timer = threading.Timer(wait, self._fire)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _fire(self):
+        with self._lock:
+            history_id = self._history_id
+            self._history_id = None
+            self._first_seen = None
+            self._timer = None
+
+        if history_id is None:
+            return
+        # Callbacks never overlap; a burst arriving mid-run is handled by the next one
+        with self._run_lock:
+            try:
+                self.callback(history_id)
+            except Exception as e:
+                logger.error(f"Error handling notification for history {history_id}: {e}")
+
+    def flush(self):
+        """Fire immediately if a notification is pending"""
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+        self._fire()
+
+
+class PushReceiver:
+    """Small HTTP server that accepts Pub/Sub push requests for Gmail.
+
+    Every valid notification is passed to ``handler`` as the decoded
+    notification dictionary. Requests are acknowledged with 204 so Pub/Sub
+    does not redeliver; malformed ones get 400.
+    """
+
+    def __init__(self, handler, host='127.0.0.1', port=8080, path='/gmail/push', token=None):
+        self.handler = handler
+        self.path = path
+        self.token = token
+        self._server = ThreadingHTTPServer((host, port), self._make_request_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        url = f"http://{host}:{port}{self.path}"
+        if self.token:
+            url += f"?token={self.token}"
+        return url
+
+    def _make_request_handler(self):
+        receiver = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                path, _, query = self.path.partition('?')
+                if path != receiver.path:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                if receiver.token and f"token={receiver.token}" not in query.split('&'):
+                    self.send_response(403)
+                    self.end_headers()
+                    return
+
+                length = int(self.headers.get('Content-Length', 0))
+                try:
+                    notification = decode_push_message(self.rfile.read(length))
+                except ValueError as e:
+                    logger.warning(str(e))
+                    self.send_response(400)
+                    self.end_headers()
+                    return
+
+                receiver.handler(notification)
+                self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        return RequestHandler
+
+    def start(self):
+        """Serve requests on a background thread"""
+        self._thread = threading.Thread(target=self._server.serve_forever, name='push-receiver', daemon=True)
+        self._thread.start()
+        logger.info(f"Listening for push notifications on {self.url}")
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,144 @@
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# Longest search query we send; beyond it we list everything instead
+MAX_QUERY_LENGTH = 1500
+
+# Rule field -> Gmail search operator ('' for a plain full-text term)
+FIELD_OPERATORS = {
+    'from': 'from:',
+    'to': 'to:',
+    'subject': 'subject:',
+    'body': ''
+}
+
+# Label IDs with a search operator of their own
+LABEL_QUERIES = {
+    'INBOX': 'in:inbox',
+    'UNREAD': 'is:unread',
+    'STARRED': 'is:starred',
+    'IMPORTANT': 'is:important',
+    'SENT': 'in:sent',
+    'DRAFT': 'in:drafts',
+    'SPAM': 'in:spam',
+    'TRASH': 'in:trash'
+}
+
+# A value Gmail indexes as one whole word: letters and digits only
+SINGLE_TOKEN = re.compile(r'[^\W_]+')
+
+# Days per date unit, as counted by RuleEngine.check_date_condition
+DATE_UNITS = {'days': 1, 'months': 30}
+
+
+def _quote(value):
+    """Search term for a value, or None if it cannot be expressed safely"""
+    value = str(value).strip()
+    if not value or any(char in value for char in '"<>'):
+        return None
+    if any(char in value for char in ' ()\t{}:'):
+        return f'"{value}"'
+    return value
+
+
+def condition_query(condition):
+    """Gmail search term selecting at least every message the condition can match
+
+    Gmail matches whole words while 'contains' matches any substring, so a
+    contains condition is only pushed down when it opts in with
+    "pushdown": true and its value is a single word.
+
+    Returns:
+        Search term, or None when the condition cannot narrow the search
+        (negations, substring matches and unknown fields/operators)
+    """
+    field = condition.get('field')
+    operator = condition.get('operator')
+    value = condition.get('value')
+
+    if field in FIELD_OPERATORS and operator == 'contains':
+        if condition.get('pushdown') is not True or not SINGLE_TOKEN.fullmatch(str(value).strip()):
+            return None
+        return f'{FIELD_OPERATORS[field]}{str(value).strip()}'
+
+    if field in FIELD_OPERATORS and operator == 'equals':
+        term = _quote(value)
+        return f'{FIELD_OPERATORS[field]}{term}' if term else None
+
+    if field == 'date_received' and operator in ('older_than', 'newer_than'):
+        days_per_unit = DATE_UNITS.get(condition.get('unit', 'days'))
+        try:
+            days = int(value) * days_per_unit
+        except (TypeError, ValueError):
+            return None
+        # Gmail compares whole days; widen by one so the boundary day is always listed
+        if operator == 'older_than':
+            return f'older_than:{days - 1}d' if days > 1 else None
+        return f'newer_than:{days + 1}d'
+
+    if field == 'labels' and operator in ('has', 'has_all'):
+        labels = [value] if isinstance(value, str) else list(value)
+        terms = [LABEL_QUERIES.get(label) for label in labels]
+        return ' '.join(terms) if terms and None not in terms else None
+
+    return None
+
+
+def rule_query(rule):
+    """Search query selecting a superset of the messages a rule matches
+
+    With predicate 'all', conditions that cannot be pushed down are left out
+    (the query only gets broader). With 'any', a single such condition means
+    the rule can match anything.
+
+    Returns:
+        Query string, or None if the rule cannot be narrowed
+    """
+    if rule.get('pushdown') is False:
+        return None
+
+    conditions = rule.get('conditions', [])
+    terms = [condition_query(condition) for condition in conditions]
+    predicate = rule.get('predicate', 'all')
+
+    if predicate == 'all':
+        terms = [term for term in terms if term]
+        return ' '.join(f'({term})' if ' ' in term else term for term in terms) or None
+    if predicate == 'any':
+        if not terms or None in terms:
+            return None
+        return ' OR '.join(f'({term})' for term in terms)
+    return None
+
+
+def rules_query(rules, base='in:all'):
+    """Search query listing only the messages some rule could match
+
+    The query is the union of every rule's query, restricted by base. Rules
+    are still evaluated locally, so the query only has to be a superset.
+
+    Returns:
+        Query string; base alone if any rule cannot be narrowed or the union
+        is too long
+    """
+    queries = []
+    for rule in rules:
+        if not rule.get('actions'):
+            continue
+        query = rule_query(rule)
+        if query is None:
+            logger.debug(f"Rule '{rule.get('name')}' cannot be pushed down - listing everything")
+            return base
+        queries.append(query)
+
+    if not queries:
+        return base
+
+    union = ' OR '.join(f'({query})' for query in dict.fromkeys(queries))
+    query = f'{base} ({union})' if base else union
+    if len(query) > MAX_QUERY_LENGTH:
+        logger.info(f"Pushed-down query is {len(query)} characters - listing everything instead")
+        return base
+    return query
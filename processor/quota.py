@@ -0,0 +1,172 @@
+import threading
+import time
+from collections import deque
+
+from processor.metrics import metrics
+from processor.service import ServiceProxy
+
+# Gmail API quota units per method (https://developers.google.com/gmail/api/reference/quota)
+QUOTA_UNITS = {
+    'users.messages.list': 5,
+    'users.messages.get': 5,
+    'users.messages.modify': 5,
+    'users.messages.batchModify': 50,
+    'users.messages.trash': 5,
+    'users.labels.list': 1,
+    'users.labels.create': 5,
+    'users.history.list': 2,
+    'users.threads.list': 10,
+    'users.threads.get': 10,
+    'users.threads.modify': 10,
+    'users.threads.trash': 10,
+    'users.watch': 100,
+    'users.stop': 50,
+    # The batch envelope is free; its requests are charged one by one (see charge_batch)
+    'new_batch_http_request': 0,
+}
+
+# Charged for methods missing from QUOTA_UNITS
+DEFAULT_UNITS = 5
+
+
+def quota_cost(method):
+    """Quota units charged for one call of a dotted method path, e.g. 'users.messages.get'"""
+    return QUOTA_UNITS.get(method, DEFAULT_UNITS)
+
+
+# Methods that change the mailbox; they may use the share of the budget held back from fetching
+ACTION_METHODS = {
+    'users.messages.modify',
+    'users.messages.batchModify',
+    'users.messages.trash',
+    'users.labels.create',
+    'users.threads.modify',
+    'users.threads.trash',
+}
+
+
+class QuotaExceeded(Exception):
+    """Raised instead of making a request the quota budget does not allow"""
+
+
+class QuotaAccountant:
+    """ServiceProxy hook that budgets Gmail API quota units.
+
+    Every request is charged its unit cost before it is made. Spend is kept
+    in a rolling one-second window and per day (UTC). A request that would
+    exceed the per-second budget waits; one that would exceed the daily
+    budget raises QuotaExceeded.
+
+    A ``reserve`` share of both budgets is kept for actions (ACTION_METHODS):
+    fetches wait once the rolling second is (1 - reserve) spent, and are
+    refused once only the reserve of the daily budget is left, so work that
+    was already fetched can still be acted on.
+    """
+
+    def __init__(self, per_second=250, per_day=None, reserve=0.2, registry=None,
+                 clock=time.time, sleep=time.sleep):
+        self.per_second = per_second
+        self.per_day = per_day
+        self.reserve = reserve
+        self.registry = registry or metrics
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._window = deque()
+        self._window_units = 0
+        self._day = self._today()
+        self.spent_today = 0
+        self.spent = 0
+        # Spend not yet added to the database by save()
+        self._unsaved = 0
+        self.waited = 0.0
+        self.refused = 0
+
+    def _today(self):
+        return time.strftime('%Y-%m-%d', time.gmtime(self._clock()))
+
+    def before_execute(self, method):
+        self.acquire(quota_cost(method), method)
+
+    def acquire(self, units, method=''):
+        """Charge units for a request, waiting for the per-second budget if needed
+
+        Raises:
+            QuotaExceeded: the daily budget does not allow the request
+        """
+        if units <= 0:
+            return
+        share = 1.0 if method in ACTION_METHODS else 1.0 - self.reserve
+
+        while True:
+            with self._lock:
+                now = self._clock()
+                if self._today() != self._day:
+                    self._day, self.spent_today, self._unsaved = self._today(), 0, 0
+                if self.per_day is not None and self.spent_today + units > self.per_day * share:
+                    self.refused += 1
+                    raise QuotaExceeded(f"Daily quota budget spent ({self.spent_today} of {self.per_day} units); "
+                                        f"not calling {method or 'Gmail'}")
+
+                while self._window and self._window[0][0] <= now - 1.0:
+                    self._window_units -= self._window.popleft()[1]
+                limit = self.per_second * share if self.per_second else None
+                # A request costing more than the whole budget may go once the window is empty
+                if limit is None or self._window_units + units <= limit or not self._window:
+                    self._window.append((now, units))
+                    self._window_units += units
+                    self.spent += units
+                    self.spent_today += units
+                    self._unsaved += units
+                    break
+                wait = self._window[0][0] + 1.0 - now
+
+            self.waited += wait
+            self._sleep(wait)
+
+        self.registry.inc('gmail_quota_units_total', units, method=method or 'unknown')
+
+    def load(self, db):
+        """Continue today's spend from the database (sync_state)"""
+        day, _, units = (db.get_state('quota_spent') or '').partition(':')
+        with self._lock:
+            if day == self._day and units:
+                self.spent_today = int(units) + self._unsaved
+
+    def save(self, db):
+        """Add the spend since the last save to today's in the database, for the next run
+
+        Adding rather than storing spent_today keeps the spend of other
+        processes using the same database (e.g. one per account worker).
+        """
+        with self._lock:
+            if self._unsaved:
+                db.add_daily_state('quota_spent', self._day, self._unsaved)
+                self._unsaved = 0
+
+    def summary(self):
+        """Spend of this run and today, for run summaries"""
+        return {
+            'units': self.spent,
+            'today': self.spent_today,
+            'per_day': self.per_day,
+            'waited_seconds': round(self.waited, 3),
+            'refused': self.refused
+        }
+
+
+def find_accountant(service):
+    """The QuotaAccountant among a ServiceProxy's hooks, if any"""
+    if not isinstance(service, ServiceProxy):
+        return None
+    for hook in service.hooks:
+        if isinstance(hook, QuotaAccountant):
+            return hook
+    return None
+
+
+def charge_batch(service, method, count):
+    """Charge the requests of a batch, which the proxy only sees as one execute()"""
+    accountant = find_accountant(service)
+    if accountant is not None:
+        accountant.acquire(quota_cost(method) * count, method)
@@ -0,0 +1,109 @@
+import logging
+
+from processor.operators import header_addresses
+
+logger = logging.getLogger(__name__)
+
+# Fields whose values rules can be indexed on; <field>@ keys hold the addresses' domains
+INDEXED_FIELDS = ('from', 'to')
+
+
+def condition_keys(condition):
+    """Index keys of which an email needs one for the condition to match
+
+    Returns:
+        Set of (field, value) keys, or None if the condition can't be indexed
+    """
+    field = condition.get('field')
+    operator = condition.get('operator')
+    value = condition.get('value')
+    if field not in INDEXED_FIELDS:
+        return None
+
+    if operator == 'equals' and isinstance(value, str):
+        return {(field, value.lower())}
+    if operator in ('in_list', 'domain_in') and isinstance(value, (list, tuple, str)):
+        values = (value,) if isinstance(value, str) else value
+        if operator == 'in_list':
+            return {(field, str(item).strip().lower()) for item in values}
+        return {(field + '@', str(item).strip().lower().lstrip('@')) for item in values}
+    return None
+
+
+def rule_keys(rule):
+    """Index keys of which an email needs one for the rule to match
+
+    A rule matching all of its conditions is indexed on its most selective
+    indexable condition; a rule matching any of them only if every condition
+    is indexable.
+
+    Returns:
+        Set of keys (empty if the rule never matches), or None if the rule must
+        be evaluated against every email
+    """
+    conditions = rule.get('conditions', [])
+    predicate = rule.get('predicate', 'all')
+    if not conditions:
+        return set()
+
+    keys = [condition_keys(condition) for condition in conditions]
+    if predicate == 'all':
+        indexable = [condition for condition in keys if condition is not None]
+        return min(indexable, key=len) if indexable else None
+    if predicate == 'any' and None not in keys:
+        return set().union(*keys)
+    return None
+
+
+def email_keys(email_data):
+    """Index keys of an email: its From/To headers and addresses, and every domain they are in"""
+    keys = set()
+    for field, header in (('from', email_data.from_email), ('to', email_data.to_email)):
+        header = header or ''
+        keys.add((field, header.lower()))
+        keys.add((field, header.strip().lower()))
+        for address, domain in header_addresses(header):
+            keys.add((field, address))
+            while domain:
+                keys.add((field + '@', domain))
+                domain = domain.partition('.')[2]
+    return keys
+
+
+class RuleIndex:
+    """Find the rules that could match an email without evaluating all of them.
+
+    Rules requiring an exact from/to value (equals, in_list) or a sender or
+    recipient domain (domain_in) are looked up by the email's headers; all
+    other rules are candidates for every email. Candidates keep the order of
+    the rules, so stop_processing and action order are unaffected.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self._by_key = {}
+        unindexed = []
+        for position, rule in enumerate(rules):
+            keys = rule_keys(rule)
+            if keys is None:
+                unindexed.append(position)
+                continue
+            for key in keys:
+                self._by_key.setdefault(key, []).append(position)
+        self._unindexed = unindexed
+        self._unindexed_rules = [rules[position] for position in unindexed]
+        self.indexed = len(rules) - len(unindexed)
+        if self.indexed:
+            logger.info(f"Indexed {self.indexed} of {len(rules)} rules on from/to values and domains")
+
+    def candidates(self, email_data):
+        """Rules that could match the email, in rule order"""
+        if not self._by_key:
+            return self._unindexed_rules
+        positions = set()
+        for key in email_keys(email_data):
+            positions.update(self._by_key.get(key, ()))
+        if not positions:
+            return self._unindexed_rules
+        positions.update(self._unindexed)
+        return [self.rules[position] for position in sorted(positions)]
@@ -1,50 +1,240 @@
 import email.utils
+import hashlib
 import json
 import logging
+import os
+import time
 from datetime import datetime, timedelta
 
+from processor.body import DEFAULT_SCAN_LIMIT, decode_text, text_contains, text_equals
+from processor.labels import LabelRegistry
+from processor.metrics import metrics
+from processor.models import ActionItem, EmailRecord
+from processor.operators import STRUCTURED_OPERATORS, compile_matcher
 from processor.parse import fetch_and_parse_emails
+from processor.rule_index import RuleIndex
 
 logger = logging.getLogger(__name__)
 
+# Rule field -> EmailRecord attribute, and whether the value is compared case-insensitively
+FIELD_ATTRS = {
+    'from': ('from_email', True),
+    'to': ('to_email', True),
+    'subject': ('subject', True),
+    'body': ('body', True),
+    'date_received': ('date', False)
+}
+
+
+def rule_version(rule):
+    """Content hash identifying a version of a rule"""
+    canonical = json.dumps(rule, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:16]
+
 
 class RuleEngine:
-    def __init__(self, rules_file='rules.json'):
+    def __init__(self, rules_file='rules.json', label_registry=None, profiler=None,
+                 body_scan_limit=DEFAULT_SCAN_LIMIT):
         self.rules_file = rules_file
+        # Body conditions stop looking after this many characters (None: whole body)
+        self.body_scan_limit = body_scan_limit
+        self.label_registry = label_registry or LabelRegistry()
+        # RuleProfiler collecting per-rule and per-condition statistics, if profiling
+        self.profiler = profiler
+        self.rules_mtime = None
+        self.rules_hash = None
+        # Compiled matches/in_list/domain_in conditions, keyed by (field, operator, value)
+        self._matchers = {}
+        self._index = None
         self.rules = self.load_rules()
 
+    @property
+    def rule_versions(self):
+        """Version hash of every loaded rule, keyed by rule name"""
+        return {rule.get('name', 'Unknown Rule'): rule_version(rule) for rule in self.rules}
+
+    def _read_rules(self):
+        mtime = os.path.getmtime(self.rules_file)
+        with open(self.rules_file, 'rb') as file:
+            content = file.read()
+        rules = json.loads(content).get('rules', [])
+        self.rules_mtime = mtime
+        self.rules_hash = hashlib.sha256(content).hexdigest()
+        return rules
+
     def load_rules(self):
         """Load rules from JSON file"""
         try:
-            with open(self.rules_file, 'r') as file:
-                data = json.load(file)
-                rules = data.get('rules', [])
-                logger.info(f"Loaded {len(rules)} rules from {self.rules_file}")
-                return rules
+            rules = self._read_rules()
+            logger.info(f"Loaded {len(rules)} rules from {self.rules_file}")
+            self.compile_rules(rules)
+            return rules
         except Exception as e:
             logger.error(f"Error loading rules: {e}")
             return []
 
+    def rules_changed(self):
+        """Check whether the rules file changed since it was loaded (mtime first, then content hash)"""
+        try:
+            if os.path.getmtime(self.rules_file) == self.rules_mtime:
+                return False
+            with open(self.rules_file, 'rb') as file:
+                return hashlib.sha256(file.read()).hexdigest() != self.rules_hash
+        except OSError:
+            return False
+
+    def reload(self):
+        """Re-read the rules file, keeping the current rules if it can't be loaded
+
+        Returns:
+            Dictionary with the 'added', 'changed' and 'removed' rule names,
+            or None if the file could not be loaded
+        """
+        old_versions = self.rule_versions
+        try:
+            rules = self._read_rules()
+        except Exception as e:
+            logger.error(f"Error reloading rules, keeping {len(self.rules)} current rules: {e}")
+            return None
+
+        self.rules = rules
+        self.compile_rules(rules)
+        new_versions = self.rule_versions
+        changes = {
+            'added': [name for name in new_versions if name not in old_versions],
+            'changed': [name for name in new_versions
+                        if name in old_versions and new_versions[name] != old_versions[name]],
+            'removed': [name for name in old_versions if name not in new_versions]
+        }
+        logger.info(f"Reloaded {len(rules)} rules from {self.rules_file} "
+                    f"({len(changes['added'])} added, {len(changes['changed'])} changed, "
+                    f"{len(changes['removed'])} removed)")
+        return changes
+
+    def reload_if_changed(self):
+        """Reload the rules only if the file changed
+
+        Returns:
+            Changes as returned by reload(), or None if nothing changed
+        """
+        if not self.rules_changed():
+            return None
+        return self.reload()
+
+    def compile_rules(self, rules):
+        """Index the rules and compile their structured conditions up front, so invalid ones are reported at load"""
+        self._matchers = {}
+        self._index = RuleIndex(rules)
+        for rule in rules:
+            for condition in rule.get('conditions', []):
+                if condition.get('operator') in STRUCTURED_OPERATORS and condition.get('field') in FIELD_ATTRS:
+                    if self._matcher(condition['field'], condition['operator'], condition.get('value')) is None:
+                        logger.warning(f"Condition {condition} of rule '{rule.get('name')}' will never match")
+
+    def _matcher(self, field, operator, value):
+        key = (field, operator, value if isinstance(value, str) else tuple(value or ()))
+        try:
+            return self._matchers[key]
+        except KeyError:
+            matcher = self._matchers[key] = compile_matcher(field, operator, value, FIELD_ATTRS[field][1])
+            return matcher
+
+    def candidate_rules(self, email_data):
+        """Rules that could match an email, in order (see processor.rule_index.RuleIndex)"""
+        if self._index is None or self._index.rules is not self.rules:
+            self._index = RuleIndex(self.rules)
+        return self._index.candidates(email_data)
+
+    def pending_backfill(self, db):
+        """Names of rules whose current version has not been applied to the stored emails"""
+        applied = db.get_rule_versions()
+        return [name for name, version in self.rule_versions.items() if applied.get(name) != version]
+
+    def backfill(self, db, rule_names):
+        """Evaluate only the given rules against every email stored in the database
+
+        Args:
+            db: EmailDatabase
+            rule_names: names of the rules to evaluate
+
+        Earlier stop_processing rules are evaluated too, so that an email they
+        match is not given actions by the backfilled rules after them.
+
+        Returns:
+            List of actions to apply
+        """
+        rule_names = set(rule_names)
+        rules = [rule for rule in self.rules if rule.get('name', 'Unknown Rule') in rule_names]
+        if not rules:
+            return []
+
+        all_actions = []
+        evaluated = 0
+        for stored_email in db.iter_emails():
+            evaluated += 1
+            for rule in self.candidate_rules(stored_email):
+                if rule.get('name', 'Unknown Rule') in rule_names:
+                    matched = self._rule_matches(stored_email, rule)
+                    if matched:
+                        all_actions.extend(self._rule_actions(stored_email, rule))
+                elif rule.get('stop_processing'):
+                    matched = self.evaluate_rule(stored_email, rule)
+                else:
+                    continue
+                if matched and rule.get('stop_processing'):
+                    break
+
+        logger.info(f"Backfill of {len(rules)} rules over {evaluated} stored emails generated {len(all_actions)} actions")
+        return all_actions
+
     def check_condition(self, email_data, condition):
         """Check if a single condition matches the email"""
         field = condition['field']
         operator = condition['operator']
         value = condition['value']
 
-        if field == 'from':
-            email_value = email_data.get('from', '').lower()
-        elif field == 'to':
-            email_value = email_data.get('to', '').lower()
-        elif field == 'subject':
-            email_value = email_data.get('subject', '').lower()
-        elif field == 'body':
-            email_value = email_data.get('body', '').lower()
-        elif field == 'date_received':
-            email_value = email_data.get('date', '')
-        else:
+        if field == 'labels':
+            return self.check_label_condition(email_data, operator, value)
+
+        try:
+            attr, fold_case = FIELD_ATTRS[field]
+        except KeyError:
             logger.warning(f"Unknown field: {field}")
             return False
 
+        email_data = EmailRecord.coerce(email_data)
+        if operator in STRUCTURED_OPERATORS:
+            matcher = self._matcher(field, operator, value)
+            if matcher is None:
+                return False
+            if field == 'body':
+                # Only the scanned part of undecoded body bytes is decoded, and the record keeps its bytes
+                email_value = email_data.body_raw or ''
+                if self.body_scan_limit is not None:
+                    email_value = email_value[:self.body_scan_limit]
+                email_value = decode_text(email_value)
+            else:
+                email_value = getattr(email_data, attr) or ''
+            return matcher(email_value)
+
+        if fold_case and operator in ('contains', 'not_contains', 'equals', 'not_equals'):
+            # Case-insensitive matching straight on the field (or undecoded body bytes), without lowered copies
+            if field == 'body':
+                email_value, limit = email_data.body_raw or '', self.body_scan_limit
+            else:
+                email_value, limit = getattr(email_data, attr) or '', None
+            if operator == 'contains':
+                return text_contains(email_value, value, limit)
+            elif operator == 'not_contains':
+                return not text_contains(email_value, value, limit)
+            elif operator == 'equals':
+                return text_equals(email_value, value)
+            return not text_equals(email_value, value)
+
+        email_value = getattr(email_data, attr) or ''
+        if fold_case:
+            email_value = email_value.lower()
+
         if operator in ['contains', 'not_contains', 'equals', 'not_equals']:
             value = value.lower()
 
@@ -64,6 +254,32 @@ class RuleEngine:
             logger.warning(f"Unknown operator: {operator}")
             return False
 
+    def check_label_condition(self, email_data, operator, value):
+        """Check label conditions with bit operations on label masks
+        Args:
+            email_data:
+            operator: has, has_any, has_all or not_has
+            value: label ID or list of label IDs
+
+        Returns:
+
+        """
+        registry = self.label_registry
+        # The email's labels are registered first, so a target label it carries is known below
+        email_mask = registry.mask(EmailRecord.coerce(email_data).labels)
+        target, complete = registry.lookup_mask(value)
+
+        if operator in ('has', 'has_all'):
+            # An unregistered label is on no stored email
+            return complete and email_mask & target == target
+        elif operator == 'has_any':
+            return email_mask & target != 0
+        elif operator == 'not_has':
+            return email_mask & target == 0
+        else:
+            logger.warning(f"Unknown operator: {operator}")
+            return False
+
     def check_date_condition(self, email_date_str, value, unit, older=True):
         """Check date-based conditions
         Args:
@@ -111,9 +327,14 @@ class RuleEngine:
         if not conditions:
             return False
 
+        started = time.perf_counter()
+        email_data = EmailRecord.coerce(email_data)
         condition_results = []
-        for condition in conditions:
-            result = self.check_condition(email_data, condition)
+        for index, condition in enumerate(conditions):
+            if self.profiler is None:
+                result = self.check_condition(email_data, condition)
+            else:
+                result = self._profile_condition(email_data, rule, index, condition)
             condition_results.append(result)
 
         if predicate == 'all':
@@ -124,8 +345,24 @@ class RuleEngine:
             logger.warning(f"Unknown predicate: {predicate}")
             match = False
 
+        rule_name = rule.get('name', '')
+        metrics.observe('rule_evaluation_seconds', time.perf_counter() - started, rule=rule_name)
+        metrics.inc('rule_evaluations_total', rule=rule_name, result='match' if match else 'miss')
         return match
 
+    def _profile_condition(self, email_data, rule, index, condition):
+        started = time.perf_counter()
+        result = self.check_condition(email_data, condition)
+        elapsed = time.perf_counter() - started
+
+        scanned = 0
+        field = FIELD_ATTRS.get(condition.get('field'))
+        if field:
+            email_value = email_data.body_raw if field[0] == 'body' else getattr(email_data, field[0])
+            scanned = len(email_value or '')
+        self.profiler.record_condition(rule.get('name', 'Unknown Rule'), index, condition, result, elapsed, scanned)
+        return result
+
     def get_actions_for_email(self, email_data):
         """Get all actions that should be applied to an email
 
@@ -136,38 +373,61 @@ class RuleEngine:
 
         """
         actions_to_apply = []
-
-        for rule in self.rules:
-            if self.evaluate_rule(email_data, rule):
-                rule_name = rule.get('name', 'Unknown Rule')
-                actions = rule.get('actions', [])
-
-                logger.info(f"Rule matched: '{rule_name}' for email: {email_data.get('subject', 'No Subject')}")
-
-                for action in actions:
-                    actions_to_apply.append({
-                        'rule_name': rule_name,
-                        'action': action,
-                        'email_id': email_data['id']
-                    })
+        email_data = EmailRecord.coerce(email_data)
+
+        candidates = self.candidate_rules(email_data)
+        metrics.inc('rules_skipped_total', len(self.rules) - len(candidates))
+        for rule in candidates:
+            if not self._rule_matches(email_data, rule):
+                continue
+            actions_to_apply.extend(self._rule_actions(email_data, rule))
+            if rule.get('stop_processing'):
+                logger.info(f"Rule '{rule.get('name', 'Unknown Rule')}' stops processing of this email")
+                break
 
         return actions_to_apply
 
-    def fetch_actions(self, email_service, limit=10):
+    def _rule_matches(self, email_data, rule):
+        if self.profiler is None:
+            return self.evaluate_rule(email_data, rule)
+        started = time.perf_counter()
+        matched = self.evaluate_rule(email_data, rule)
+        self.profiler.record_rule(rule.get('name', 'Unknown Rule'), matched, time.perf_counter() - started,
+                                  len(rule.get('actions', [])) if matched else 0)
+        return matched
+
+    def _rule_actions(self, email_data, rule):
+        rule_name = rule.get('name', 'Unknown Rule')
+        logger.info(f"Rule matched: '{rule_name}' for email: {email_data.subject or 'No Subject'}")
+        return [ActionItem(rule_name, action, email_data.id) for action in rule.get('actions', [])]
+
+    def fetch_actions(self, email_service, limit=10, db=None):
         """Parse the emails and get the actions to be done based on rules
         Args:
             email_service:
             limit:
+            db:
+
+        Returns:
+
+        """
+        parsed_emails = fetch_and_parse_emails(email_service, max_results=limit, db=db)
+        return self.get_actions_for_emails(parsed_emails)
+
+    def get_actions_for_emails(self, emails):
+        """Evaluate the rules against a batch of already parsed emails
+
+        Args:
+            emails:
 
         Returns:
 
         """
         all_actions = []
-        parsed_emails = fetch_and_parse_emails(email_service, max_results=limit)
 
-        logger.info(f"Processing {len(parsed_emails)} emails against {len(self.rules)} rules")
+        logger.info(f"Processing {len(emails)} emails against {len(self.rules)} rules")
 
-        for parsed_email in parsed_emails:
+        for parsed_email in emails:
             email_actions = self.get_actions_for_email(parsed_email)
             all_actions.extend(email_actions)
 
@@ -0,0 +1,86 @@
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+_PLAIN_TYPES = (dict, list, tuple, set, str, bytes, int, float, bool, type(None))
+
+
+class ServiceProxy:
+    """Wrap a Gmail service object so every request's ``execute()`` runs hooks.
+
+    Resource calls are passed through unchanged, e.g.
+    ``proxy.users().messages().get(userId='me', id=x).execute()``; the
+    ``execute()`` call is reported to each hook with the dotted method path
+    (``'users.messages.get'``). Hooks may implement either of:
+
+        before_execute(method)
+        after_execute(method, elapsed, error)
+
+    ``before_execute`` may raise to stop the request.
+    """
+
+    def __init__(self, target, hooks=(), path=()):
+        self._target = target
+        # A list is shared rather than copied, so proxies built from the same
+        # hook list see hooks added later
+        self._hooks = hooks if isinstance(hooks, list) else list(hooks)
+        self._path = tuple(path)
+
+    @property
+    def hooks(self):
+        return self._hooks
+
+    def add_hook(self, hook):
+        self._hooks.append(hook)
+
+    def unwrap(self):
+        return self._target
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+
+        path = self._path + (name,)
+
+        def call(*args, **kwargs):
+            args = [unwrap(arg) for arg in args]
+            kwargs = {key: unwrap(value) for key, value in kwargs.items()}
+            result = attr(*args, **kwargs)
+            if isinstance(result, _PLAIN_TYPES):
+                return result
+            return ServiceProxy(result, self._hooks, path)
+
+        return call
+
+    def execute(self, *args, **kwargs):
+        method = '.'.join(self._path)
+        for hook in self._hooks:
+            before = getattr(hook, 'before_execute', None)
+            if before:
+                before(method)
+
+        started = time.perf_counter()
+        error = None
+        try:
+            return self._target.execute(*args, **kwargs)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            for hook in self._hooks:
+                after = getattr(hook, 'after_execute', None)
+                if after:
+                    try:
+                        after(method, elapsed, error)
+                    except Exception as e:
+                        logger.error(f"Error in service hook for {method}: {e}")
+
+
+def unwrap(obj):
+    """Return the object wrapped by a ServiceProxy, or the object itself"""
+    if isinstance(obj, ServiceProxy):
+        return obj.unwrap()
+    return obj
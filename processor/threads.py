@@ -0,0 +1,226 @@
+import logging
+
+from googleapiclient.errors import HttpError
+
+from processor.actions import EmailActions
+from processor.models import ActionItem, EmailRecord
+from processor.parse import parse_message
+from processor.priority import email_timestamp, order_actions
+
+logger = logging.getLogger(__name__)
+
+# How a rule is evaluated against a conversation
+THREAD_MODES = ('any', 'latest')
+
+
+def list_threads(service, query='in:all', max_results=100, page_token=None):
+    """List one page of threads
+
+    Returns:
+        Tuple of (thread resources with 'id' and 'historyId', next page token or None)
+    """
+    results = service.users().threads().list(
+        userId='me',
+        q=query,
+        maxResults=max_results,
+        pageToken=page_token
+    ).execute()
+
+    return results.get('threads', []), results.get('nextPageToken')
+
+
+def list_thread_ids(service, query='in:all', max_results=100, page_token=None):
+    """List one page of thread IDs
+
+    Returns:
+        Tuple of (thread IDs, next page token or None)
+    """
+    threads, next_page_token = list_threads(service, query, max_results, page_token)
+    return [thread['id'] for thread in threads], next_page_token
+
+
+def thread_history_id(messages):
+    """A thread's history ID: the newest of its messages' (None if one is missing)"""
+    try:
+        return max(int(message.history_id) for message in messages)
+    except (TypeError, ValueError):
+        return None
+
+
+def fetch_thread(service, thread_id):
+    """Fetch every message of a thread in one request
+
+    Returns:
+        List of EmailRecords, oldest first (empty if the thread could not be fetched)
+    """
+    try:
+        thread = service.users().threads().get(userId='me', id=thread_id, format='full').execute()
+    except HttpError as error:
+        logger.error(f'Error fetching thread {thread_id}: {error}')
+        return []
+    return [parse_message(message) for message in thread.get('messages', [])]
+
+
+class ThreadProcessor:
+    """Evaluate rules once per conversation and act on whole threads.
+
+    With mode 'any' a rule matches a thread if it matches any of its
+    messages; with 'latest' only the newest message is considered. Matching
+    actions are applied with threads().modify or threads().trash, one call
+    per thread, and recorded in email_actions for every message of the
+    thread.
+    """
+
+    def __init__(self, service, db, rule_engine, email_actions, mode='any'):
+        if mode not in THREAD_MODES:
+            raise ValueError(f"Unknown thread mode: {mode} (expected one of {', '.join(THREAD_MODES)})")
+        self.service = service
+        self.db = db
+        self.rule_engine = rule_engine
+        self.email_actions = email_actions
+        self.mode = mode
+
+    def load_thread(self, thread_id, history_id=None):
+        """Fetch a thread and store its messages (unchanged ones are not rewritten)
+
+        Given the thread's history ID from the listing, a thread stored whole
+        at that history ID has not changed since and is read from the
+        database instead, saving the threads().get call.
+        """
+        if history_id is not None and self.db.get_thread_history_id(thread_id) == str(history_id):
+            messages = self.db.get_emails_by_thread(thread_id)
+            if messages:
+                return sorted(messages, key=email_timestamp)
+
+        messages = fetch_thread(self.service, thread_id)
+        if messages and self.db.upsert_emails(messages)['failed'] == 0:
+            # The listed history ID, even if the thread changed since: the next listing then differs
+            if history_id is None:
+                history_id = thread_history_id(messages)
+            if history_id is not None:
+                self.db.set_thread_history_id(thread_id, history_id)
+        return messages
+
+    def matching_rules(self, messages):
+        """Rules matching a thread under the configured mode, up to the first matching stop_processing rule"""
+        if not messages:
+            return []
+        candidates = messages if self.mode == 'any' else messages[-1:]
+        matched = []
+        for rule in self.rule_engine.rules:
+            if any(self.rule_engine.evaluate_rule(message, rule) for message in candidates):
+                matched.append(rule)
+                if rule.get('stop_processing'):
+                    break
+        return matched
+
+    def actions_for_thread(self, thread_id, messages):
+        """Actions for a thread, as ActionItems whose email_id is the thread ID"""
+        actions_to_apply = []
+        for rule in self.matching_rules(messages):
+            rule_name = rule.get('name', 'Unknown Rule')
+            logger.info(f"Rule matched: '{rule_name}' for thread {thread_id} ({len(messages)} messages)")
+            actions_to_apply.extend(ActionItem(rule_name, action, thread_id) for action in rule.get('actions', []))
+        return actions_to_apply
+
+    def execute_thread_action(self, action_item, messages):
+        """Apply one action to a whole thread
+
+        Returns:
+            True if the action was applied (or had been already)
+        """
+        email_actions = self.email_actions
+        thread_id = action_item.email_id
+        rule_name = action_item.rule_name
+        action = action_item.action
+        action_type = EmailActions.action_type_for(action)
+
+        pending = [message.id for message in messages
+                   if not email_actions.action_already_performed(message.id, rule_name, action_type)]
+        if not pending:
+            logger.info(f"Action '{action_type}' already recorded for every message of thread {thread_id} - skipping")
+            return True
+
+        try:
+            if action['type'] == 'move_message' and action.get('folder', 'INBOX').upper() == 'TRASH':
+                self.service.users().threads().trash(userId='me', id=thread_id).execute()
+                details = 'Thread moved to trash'
+            else:
+                change = email_actions.label_change(action)
+                if change is None:
+                    for message_id in pending:
+                        email_actions.record_action(message_id, rule_name, action_type,
+                                                    'Unsupported thread action', 'failed')
+                    return False
+                add, remove = change
+                self.service.users().threads().modify(
+                    userId='me',
+                    id=thread_id,
+                    body={'addLabelIds': add, 'removeLabelIds': remove}
+                ).execute()
+                details = f'Applied to thread {thread_id}'
+        except HttpError as error:
+            logger.error(f"Error applying '{action_type}' to thread {thread_id}: {error}")
+            for message_id in pending:
+                email_actions.record_action(message_id, rule_name, action_type, f'Error: {error}', 'failed')
+            return False
+
+        for message_id in pending:
+            email_actions.record_action(message_id, rule_name, action_type, details)
+        return True
+
+    def process_page(self, limit=10, page_token=None, query='in:all', deadline=None):
+        """Fetch one page of threads, evaluate the rules and apply the actions
+
+        Actions run highest ranked first (see processor.priority.order_actions),
+        a thread counting as unread if any of its messages is. Threads not
+        fetched and actions not started before the deadline are left for the
+        next run.
+
+        Returns:
+            Dictionary with 'threads', 'emails', 'actions', 'succeeded', 'failed'
+            counts and the 'next_page_token'
+        """
+        threads, next_page_token = list_threads(self.service, query, limit, page_token)
+        thread_ids = [thread['id'] for thread in threads]
+        history_ids = {thread['id']: thread.get('historyId') for thread in threads}
+
+        emails = succeeded = failed = 0
+        loaded = {}
+        actions_to_apply = []
+        try:
+            for index, thread_id in enumerate(thread_ids):
+                if deadline is not None and deadline.expired():
+                    logger.info(f"Run deadline reached - {len(thread_ids) - index} threads left for the next run")
+                    break
+                messages = self.load_thread(thread_id, history_ids[thread_id])
+                emails += len(messages)
+                loaded[thread_id] = messages
+                actions_to_apply.extend(self.actions_for_thread(thread_id, messages))
+
+            # A thread ranks as its newest message, and as unread if any message is
+            summaries = [EmailRecord(id=thread_id, date=max(messages, key=email_timestamp).date,
+                                     is_read=all(message.is_read for message in messages))
+                         for thread_id, messages in loaded.items() if messages]
+            actions_to_apply, _ = order_actions(actions_to_apply, summaries, self.rule_engine.rules)
+            for index, action_item in enumerate(actions_to_apply):
+                if deadline is not None and deadline.expired():
+                    logger.info(f"Run deadline reached - {len(actions_to_apply) - index} actions left for the next run")
+                    break
+                if self.execute_thread_action(action_item, loaded[action_item.email_id]):
+                    succeeded += 1
+                else:
+                    failed += 1
+        finally:
+            self.email_actions.audit.flush()
+
+        logger.info(f"Processed {len(loaded)} threads ({emails} messages): "
+                    f"{succeeded} actions successful, {failed} failed")
+        return {
+            'threads': len(loaded),
+            'emails': emails,
+            'actions': len(actions_to_apply),
+            'succeeded': succeeded,
+            'failed': failed,
+            'next_page_token': next_page_token
+        }
@@ -166,6 +166,6 @@ def rule_engine_with_temp_file(temp_rules_file):
 
 
 @pytest.fixture
-def mock_email_actions(mock_gmail_service):
+def mock_email_actions(mock_gmail_service, temp_db):
     """Mock EmailActions with mocked Gmail service"""
-    return EmailActions(mock_gmail_service)
+    return EmailActions(mock_gmail_service, db=temp_db)
@@ -0,0 +1,145 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from processor import accounts as accounts_module
+from processor.accounts import format_summary, load_accounts, process_accounts
+
+
+class FakeProcessor:
+    """Serves a mailbox of `size` emails in pages, one action per email"""
+
+    def __init__(self, account, calls):
+        self.account = account
+        self.calls = calls
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    def process_batch(self, limit=10, page_token=None, deadline=None):
+        if self.account.get('fail'):
+            raise RuntimeError('quota exceeded')
+        start = int(page_token or 0)
+        count = max(0, min(limit, self.account['size'] - start))
+        self.calls.append(self.account['name'])
+        end = start + count
+        result = {
+            'emails': count,
+            'actions': count,
+            'succeeded': count,
+            'failed': 0,
+            'next_page_token': str(end) if end < self.account['size'] else None
+        }
+        if self.account.get('thread_size'):
+            # In thread mode pages and limits count threads of thread_size emails
+            result['threads'] = count
+            result['emails'] = count * self.account['thread_size']
+        return result
+
+
+class TestAccounts:
+
+    @pytest.fixture(autouse=True)
+    def clear_processors(self):
+        accounts_module._processors.clear()
+        yield
+        accounts_module._processors.clear()
+
+    def _accounts(self, *entries):
+        return [{'limit': 100, 'batch_size': 10, **entry} for entry in entries]
+
+    def test_load_accounts(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        manifest = tmp_path / 'accounts.json'
+        manifest.write_text(json.dumps({
+            'defaults': {'limit': 50},
+            'accounts': [{'name': 'support'}, {'name': 'sales', 'db': 'shared/sales.db', 'limit': 5}]
+        }))
+
+        support, sales = load_accounts(str(manifest))
+
+        assert support['limit'] == 50
+        assert support['db'] == 'accounts/support/emails.db'
+        assert support['token'] == 'accounts/support/token.json'
+        assert support['rules'] == 'rules.json'
+        assert sales['limit'] == 5
+        assert sales['db'] == 'shared/sales.db'
+
+    def test_load_accounts_rejects_duplicates(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        manifest = tmp_path / 'accounts.json'
+        manifest.write_text(json.dumps({'accounts': [{'name': 'a'}, {'name': 'a'}]}))
+
+        with pytest.raises(ValueError):
+            load_accounts(str(manifest))
+
+    def test_accounts_take_turns(self):
+        calls = []
+        accounts = self._accounts({'name': 'big', 'size': 40}, {'name': 'small', 'size': 20})
+
+        summaries = process_accounts(accounts, lambda account: FakeProcessor(account, calls),
+                                     max_workers=1, executor_class=ThreadPoolExecutor)
+
+        assert calls[:4] == ['big', 'small', 'big', 'small']
+        assert summaries['big']['emails'] == 40
+        assert summaries['big']['batches'] == 4
+        assert summaries['small']['emails'] == 20
+
+    def test_account_limit_and_errors(self):
+        calls = []
+        accounts = self._accounts({'name': 'capped', 'size': 100, 'limit': 15},
+                                  {'name': 'broken', 'size': 10, 'fail': True})
+
+        summaries = process_accounts(accounts, lambda account: FakeProcessor(account, calls),
+                                     max_workers=2, executor_class=ThreadPoolExecutor)
+
+        assert summaries['capped']['emails'] == 15
+        assert summaries['broken']['error'] == 'quota exceeded'
+        assert 'broken' in format_summary(summaries)
+
+    def test_thread_mode_limit_counts_threads(self):
+        calls = []
+        accounts = self._accounts({'name': 'threads', 'size': 100, 'limit': 15, 'thread_size': 3})
+
+        summaries = process_accounts(accounts, lambda account: FakeProcessor(account, calls),
+                                     max_workers=1, executor_class=ThreadPoolExecutor)
+
+        assert summaries['threads']['batches'] == 2
+        assert summaries['threads']['emails'] == 45
+
+    def test_account_deadline_covers_every_batch(self):
+        calls = []
+        accounts = self._accounts({'name': 'slow', 'size': 100, 'deadline': 0}, {'name': 'other', 'size': 20})
+
+        summaries = process_accounts(accounts, lambda account: FakeProcessor(account, calls),
+                                     max_workers=1, executor_class=ThreadPoolExecutor)
+
+        assert summaries['slow']['batches'] == 1
+        assert summaries['other']['emails'] == 20
+
+    def test_processors_are_closed(self):
+        calls = []
+        built = []
+        accounts = self._accounts({'name': 'big', 'size': 40}, {'name': 'capped', 'size': 100, 'limit': 15},
+                                  {'name': 'broken', 'size': 10, 'fail': True})
+
+        def factory(account):
+            built.append(FakeProcessor(account, calls))
+            return built[-1]
+
+        process_accounts(accounts, factory, max_workers=2, executor_class=ThreadPoolExecutor)
+
+        assert len(built) == 3 and all(processor.closed for processor in built)
+        assert accounts_module._processors == {}
+
+    def test_processor_kept_between_batches(self):
+        calls = []
+        account = {'name': 'big', 'size': 40}
+
+        first = accounts_module.run_account_batch(lambda a: FakeProcessor(a, calls), account, 10)
+        processor = accounts_module._processors['big']
+        accounts_module.run_account_batch(None, account, 10, first['next_page_token'], last=True)
+
+        assert processor.closed and 'big' not in accounts_module._processors
@@ -0,0 +1,136 @@
+import threading
+import time
+from unittest.mock import Mock
+
+from benchmarks.fake_gmail import make_service
+from processor.action_queue import ActionQueue
+from processor.actions import EmailActions
+
+
+def actions_for(ids, action=None):
+    return [{'rule_name': 'rule', 'action': action or {'type': 'mark_as_unread'}, 'email_id': email_id}
+            for email_id in ids]
+
+
+class TestActionQueue:
+
+    def test_enqueue_is_idempotent(self, temp_db):
+        queue = ActionQueue(temp_db)
+
+        assert queue.enqueue(actions_for(['a', 'b'])) == 2
+        assert queue.enqueue(actions_for(['b', 'c'])) == 1
+        assert queue.counts() == {'pending': 3, 'in_flight': 0, 'done': 0, 'failed': 0}
+
+    def test_lease_complete_and_fail(self, temp_db):
+        queue = ActionQueue(temp_db, max_attempts=2)
+        queue.enqueue(actions_for(['a', 'b', 'c']))
+
+        leased = queue.lease(2, owner='w1')
+        assert [item.email_id for _, item in leased] == ['a', 'b']
+        assert leased[0][1].action == {'type': 'mark_as_unread'}
+        # Leased actions are not handed out twice
+        assert [item.email_id for _, item in queue.lease(10, owner='w2')] == ['c']
+        assert queue.lease(10, owner='w3') == []
+
+        queue.complete([leased[0][0]])
+        queue.fail([leased[1][0]], 'boom')
+        assert queue.counts() == {'pending': 1, 'in_flight': 1, 'done': 1, 'failed': 0}
+
+        # A second failure uses up the attempts
+        retry = queue.lease(10, owner='w1')
+        queue.fail([queue_id for queue_id, _ in retry], 'boom')
+        assert queue.counts()['failed'] == 1
+
+    def test_expired_lease_is_resumed(self, temp_db):
+        queue = ActionQueue(temp_db, lease_seconds=0.05)
+        queue.enqueue(actions_for(['a']))
+
+        # The worker holding the lease "crashes"
+        assert len(queue.lease(10, owner='crashed')) == 1
+        assert queue.lease(10, owner='w2') == []
+        time.sleep(0.1)
+
+        assert [item.email_id for _, item in queue.lease(10, owner='w2')] == ['a']
+
+    def test_release_on_shutdown(self, temp_db):
+        queue = ActionQueue(temp_db)
+        queue.enqueue(actions_for(['a', 'b']))
+        queue.lease(10, owner='w1')
+
+        assert queue.release('w1') == 2
+        assert queue.counts()['pending'] == 2
+
+    def test_release_covers_leases_from_other_threads(self, temp_db):
+        queue = ActionQueue(temp_db)
+        queue.enqueue(actions_for(['a', 'b']))
+        # e.g. a push notification timer thread
+        leaser = threading.Thread(target=queue.lease, args=(10,))
+        leaser.start()
+        leaser.join()
+
+        assert queue.release() == 2
+        assert queue.counts()['pending'] == 2
+
+    def test_release_only_given_actions(self, temp_db):
+        queue = ActionQueue(temp_db)
+        queue.enqueue(actions_for(['a', 'b']))
+        leased = queue.lease(10)
+
+        assert queue.release(queue_ids=[leased[1][0]]) == 1
+        assert queue.counts() == {'pending': 1, 'in_flight': 1, 'done': 0, 'failed': 0}
+
+    def test_concurrent_workers_never_share(self, temp_db):
+        queue = ActionQueue(temp_db)
+        queue.enqueue(actions_for([f'id{i}' for i in range(200)]))
+        leased = []
+        lock = threading.Lock()
+
+        def worker(name):
+            while True:
+                batch = queue.lease(7, owner=name)
+                if not batch:
+                    return
+                with lock:
+                    leased.extend(queue_id for queue_id, _ in batch)
+
+        threads = [threading.Thread(target=worker, args=(f'w{i}',)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert sorted(leased) == sorted(set(leased))
+        assert len(leased) == 200
+
+    def test_drain_executes_and_records(self, temp_db):
+        service = make_service(20)
+        email_actions = EmailActions(service, db=temp_db)
+        queue = ActionQueue(temp_db)
+        ids = [service.mailbox.message_id(i) for i in range(10)]
+        queue.enqueue(actions_for(ids, {'type': 'move_message', 'folder': 'TRASH'}))
+        queue.enqueue(actions_for(['missing'], {'type': 'move_message', 'folder': 'TRASH'}))
+
+        succeeded, failed = queue.drain(email_actions, lease_size=4)
+
+        assert (succeeded, failed) == (10, 1)
+        assert queue.counts() == {'pending': 0, 'in_flight': 0, 'done': 10, 'failed': 1}
+        assert temp_db.action_exists(ids[0], 'rule', 'move_to_trash')
+
+    def test_drain_batched(self, temp_db):
+        service = make_service(20)
+        email_actions = EmailActions(service, db=temp_db)
+        queue = ActionQueue(temp_db)
+        queue.enqueue(actions_for([service.mailbox.message_id(i) for i in range(10)]))
+
+        assert queue.drain(email_actions, batch=True) == (10, 0)
+        assert service.calls['users.messages.batchModify'] == 1
+
+    def test_drain_stops_when_asked(self, temp_db):
+        queue = ActionQueue(temp_db)
+        queue.enqueue(actions_for(['a', 'b', 'c']))
+        stop = threading.Event()
+        email_actions = Mock()
+        email_actions.execute_action.side_effect = lambda item: stop.set() or True
+
+        assert queue.drain(email_actions, lease_size=1, stop=stop) == (1, 0)
+        assert queue.counts()['pending'] == 2
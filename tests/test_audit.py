@@ -0,0 +1,118 @@
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock
+
+import pytest
+
+from processor.audit import AuditWriter, flush_all, install_signal_handlers
+
+
+class TestAuditWriter:
+
+    def test_buffers_until_flush(self, temp_db):
+        writer = AuditWriter(temp_db, batch_size=10, flush_interval=60)
+
+        writer.record('email_1', 'Rule', 'mark_as_read', 'Marked as read')
+
+        assert writer.pending_count() == 1
+        assert writer.is_recorded('email_1', 'Rule', 'mark_as_read') is True
+        assert temp_db.action_exists('email_1', 'Rule', 'mark_as_read') is False
+
+        assert writer.flush() == 1
+        assert writer.pending_count() == 0
+        assert temp_db.action_exists('email_1', 'Rule', 'mark_as_read') is True
+
+    def test_flushes_on_batch_size(self, temp_db):
+        writer = AuditWriter(temp_db, batch_size=3, flush_interval=60)
+
+        for i in range(3):
+            writer.record(f'email_{i}', 'Rule', 'mark_as_read')
+
+        assert writer.pending_count() == 0
+        assert all(temp_db.action_exists(f'email_{i}', 'Rule', 'mark_as_read') for i in range(3))
+
+    def test_failed_record_is_not_treated_as_done(self, temp_db):
+        writer = AuditWriter(temp_db, batch_size=10, flush_interval=60)
+
+        writer.record('email_1', 'Rule', 'mark_as_read', 'Error: boom', 'failed')
+
+        assert writer.is_recorded('email_1', 'Rule', 'mark_as_read') is False
+
+    def test_failed_flush_keeps_records(self):
+        db = Mock()
+        db.record_actions.side_effect = Exception('database is locked')
+        writer = AuditWriter(db, batch_size=10, flush_interval=60)
+
+        writer.record('email_1', 'Rule', 'mark_as_read')
+
+        assert writer.flush() == 0
+        assert writer.pending_count() == 1
+
+        db.record_actions.side_effect = None
+        db.record_actions.return_value = 1
+        assert writer.flush() == 1
+
+    def test_concurrent_records(self, temp_db):
+        writer = AuditWriter(temp_db, batch_size=7, flush_interval=60)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda i: writer.record(f'email_{i}', 'Rule', 'mark_as_read'), range(100)))
+        writer.close()
+
+        assert all(temp_db.action_exists(f'email_{i}', 'Rule', 'mark_as_read') for i in range(100))
+
+    def test_flush_all(self, temp_db):
+        writer = AuditWriter(temp_db, batch_size=10, flush_interval=60)
+        writer.record('email_1', 'Rule', 'mark_as_read')
+
+        flush_all()
+
+        assert temp_db.action_exists('email_1', 'Rule', 'mark_as_read') is True
+
+    def test_interrupted_flush_keeps_records(self):
+        db = Mock()
+        db.record_actions.side_effect = SystemExit(143)
+        writer = AuditWriter(db, batch_size=10, flush_interval=60)
+        writer.record('email_1', 'Rule', 'mark_as_read')
+
+        with pytest.raises(SystemExit):
+            writer.flush()
+
+        assert writer.pending_count() == 1
+        db.record_actions.side_effect = None
+        writer.flush()
+
+    def test_background_flush(self, temp_db):
+        writer = AuditWriter(temp_db, batch_size=10, flush_interval=0.05)
+        writer.record('email_1', 'Rule', 'mark_as_read')
+        writer.start()
+        try:
+            deadline = time.monotonic() + 2
+            while not temp_db.action_exists('email_1', 'Rule', 'mark_as_read') and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert temp_db.action_exists('email_1', 'Rule', 'mark_as_read') is True
+        finally:
+            writer.close()
+
+
+class TestSignalHandlers:
+
+    def test_sigterm_takes_no_lock(self, temp_db):
+        writer = AuditWriter(temp_db, batch_size=10, flush_interval=60)
+        writer.record('email_1', 'Rule', 'mark_as_read')
+        previous = signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        try:
+            install_signal_handlers(signals=(signal.SIGTERM,))
+            handler = signal.getsignal(signal.SIGTERM)
+            # As if the signal arrived while the main thread was inside record()
+            with writer._lock:
+                with pytest.raises(SystemExit) as exited:
+                    handler(signal.SIGTERM, None)
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+
+        assert exited.value.code == 128 + signal.SIGTERM
+        # Flushed while unwinding, outside the handler
+        writer.flush()
+        assert temp_db.action_exists('email_1', 'Rule', 'mark_as_read') is True
@@ -0,0 +1,113 @@
+import pytest
+from googleapiclient.errors import HttpError
+
+from benchmarks.bodies import format_rows, run_body_benchmark
+from benchmarks.fake_gmail import FakeGmailService, make_service
+from benchmarks.mailbox import SyntheticMailbox
+from benchmarks.run import STAGES, baseline_key, compare, load_baselines, run_benchmarks, save_baseline
+from processor.parse import list_message_ids, parse_email_content
+
+
+class TestSyntheticMailbox:
+
+    def test_deterministic(self):
+        first = SyntheticMailbox(100, seed=3)
+        second = SyntheticMailbox(100, seed=3)
+
+        assert first.message(42) == second.message(42)
+        assert first.message(42) != SyntheticMailbox(100, seed=4).message(42)
+
+    def test_messages_parse(self):
+        mailbox = SyntheticMailbox(200)
+        service = FakeGmailService(mailbox)
+        shapes = set()
+
+        for index in range(200):
+            shapes.add(mailbox.message(index)['payload']['mimeType'])
+            record = parse_email_content(service, mailbox.message_id(index))
+            assert record.id == mailbox.message_id(index)
+            assert '<' in record.from_email and record.subject and record.date
+
+        assert shapes == {'text/plain', 'multipart/alternative', 'multipart/mixed'}
+
+
+class TestFakeGmailService:
+
+    def test_pagination(self):
+        service = make_service(1200)
+        seen = []
+        page_token = None
+        while True:
+            ids, page_token = list_message_ids(service, max_results=500, page_token=page_token)
+            seen.extend(ids)
+            if not page_token:
+                break
+
+        assert len(seen) == len(set(seen)) == 1200
+        assert service.calls['users.messages.list'] == 3
+        assert service.units == 15
+
+    def test_label_changes_persist(self):
+        service = make_service(10)
+        message_id = service.mailbox.message_id(0)
+
+        service.users().messages().batchModify(
+            userId='me', body={'ids': [message_id], 'addLabelIds': ['Label_1'], 'removeLabelIds': ['INBOX']}
+        ).execute()
+        labels = service.users().messages().get(userId='me', id=message_id, format='minimal').execute()['labelIds']
+
+        assert 'Label_1' in labels
+        assert 'INBOX' not in labels
+
+    def test_errors(self):
+        service = make_service(10, error_rate=1.0)
+        with pytest.raises(HttpError) as error:
+            service.users().messages().list(userId='me', q='in:all', maxResults=10).execute()
+        assert error.value.resp.status == 500
+        assert service.errors == 1
+
+    def test_quota(self):
+        service = make_service(10, quota_per_second=12)
+        request = service.users().messages().get(userId='me', id=service.mailbox.message_id(1), format='minimal')
+        request.execute()
+        request.execute()
+
+        with pytest.raises(HttpError) as error:
+            request.execute()
+        assert error.value.resp.status == 429
+
+
+class TestBenchmarkRunner:
+
+    def test_run_benchmarks(self, tmp_path):
+        results = run_benchmarks(60, workdir=str(tmp_path))
+
+        assert list(results) == STAGES
+        assert results['fetch']['items'] == results['db_insert']['items'] == 60
+        assert results['actions']['items'] == results['actions_batched']['items'] > 0
+        assert all(result['per_second'] > 0 for result in results.values())
+
+    def test_baselines(self, tmp_path):
+        path = str(tmp_path / 'baselines.json')
+        results = {'fetch': {'items': 100, 'seconds': 1.0, 'per_second': 100.0}}
+        key = baseline_key(1000, {'latency': 0.0, 'error_rate': 0.01})
+        save_baseline(results, key, path)
+
+        baseline = load_baselines(path)[key]
+        assert key == '1000[error_rate=0.01]'
+        assert compare(results, baseline) == [('fetch', 100.0, 100.0, False)]
+
+        slower = {'fetch': {'items': 100, 'seconds': 2.0, 'per_second': 50.0}}
+        assert compare(slower, baseline, tolerance=0.25) == [('fetch', 50.0, 100.0, True)]
+        assert compare(slower, None) == [('fetch', 50.0, None, False)]
+
+
+class TestBodyBenchmark:
+
+    def test_variants_agree(self):
+        rows = run_body_benchmark((1,), limit=1 << 12, isolate=False)
+
+        matched = {row['variant']: row['matched'] for row in rows}
+        # Only the last value occurs, at the very end of the body
+        assert matched == {'lowercase': 1, 'text': 1, 'bytes': 1, 'bytes_limited': 0}
+        assert 'peak RSS MB' in format_rows(rows)
@@ -0,0 +1,94 @@
+import base64
+import json
+
+import pytest
+
+from benchmarks.fake_gmail import make_service
+from processor import body, rules
+from processor.body import decode_part, text_contains, text_equals
+from processor.models import EmailRecord
+from processor.parse import load_emails
+from processor.rules import RuleEngine
+
+TEXT = 'Dear customer,\nYour INVOICE #123 is attached. Café opening hours apply.\n' * 50
+
+
+class TestBodyMatching:
+
+    @pytest.mark.parametrize('haystack', [TEXT, TEXT.encode('utf-8'), bytearray(TEXT.encode('utf-8')),
+                                          memoryview(TEXT.encode('utf-8'))])
+    def test_contains_is_case_insensitive(self, haystack):
+        assert text_contains(haystack, 'invoice #123')
+        assert text_contains(haystack, 'CAFÉ')
+        assert not text_contains(haystack, 'receipt')
+
+    def test_match_across_chunk_boundary(self, monkeypatch):
+        monkeypatch.setattr(body, 'SCAN_CHUNK', 16)
+        data = b'x' * 14 + b'NeEdLe' + b'y' * 40
+
+        assert text_contains(data, 'needle')
+        assert text_contains(data.decode('ascii'), 'needle')
+
+    def test_scan_limit(self):
+        data = b'a' * 1000 + b'needle'
+
+        assert text_contains(data, 'needle')
+        assert not text_contains(data, 'needle', limit=1000)
+        assert text_contains(data, 'needle', limit=1006)
+
+    def test_equals(self):
+        assert text_equals(b'Hello World', 'hello world')
+        assert text_equals('Hello World', 'HELLO WORLD')
+        assert not text_equals(TEXT.encode('utf-8'), 'hello')
+
+    def test_chunked_decode(self, monkeypatch):
+        raw = TEXT.encode('utf-8')
+        data = base64.urlsafe_b64encode(raw).decode('ascii')
+        monkeypatch.setattr(body, 'DECODE_CHUNK', 64)
+
+        assert decode_part(data) == raw
+
+
+class TestBytesBody:
+
+    def test_body_decoded_lazily(self):
+        record = EmailRecord(id='1')
+        record.body = TEXT.encode('utf-8')
+
+        assert isinstance(record.body_raw, bytes)
+        assert record.body == TEXT
+        assert record.body_raw == TEXT
+
+    def test_rules_respect_scan_limit(self, tmp_path):
+        rules_file = tmp_path / 'rules.json'
+        rules_file.write_text(json.dumps({'rules': []}))
+        record = EmailRecord(id='1')
+        record.body = b'a' * 5000 + b'Unsubscribe'
+        condition = {'field': 'body', 'operator': 'contains', 'value': 'unsubscribe'}
+
+        assert RuleEngine(str(rules_file)).check_condition(record, condition)
+        assert not RuleEngine(str(rules_file), body_scan_limit=4096).check_condition(record, condition)
+        # Matching did not decode the body
+        assert isinstance(record.body_raw, bytes)
+
+    def test_stored_emails_are_matched_on_bytes(self, temp_db, tmp_path, monkeypatch):
+        service = make_service(5)
+        rules_file = tmp_path / 'rules.json'
+        rules_file.write_text(json.dumps({'rules': [
+            {'name': 'Body', 'conditions': [{'field': 'body', 'operator': 'contains', 'value': 'zzz-no-match'}],
+             'actions': [{'type': 'mark_as_read'}]},
+            {'name': 'Pattern', 'conditions': [{'field': 'body', 'operator': 'matches', 'value': 'zzz'}],
+             'actions': [{'type': 'mark_as_read'}]}
+        ]}))
+        matched_types = []
+        original = rules.text_contains
+        monkeypatch.setattr(rules, 'text_contains',
+                            lambda text, *args: matched_types.append(type(text)) or original(text, *args))
+
+        emails = load_emails(service, [service.mailbox.message_id(i) for i in range(5)], temp_db)
+        RuleEngine(str(rules_file)).get_actions_for_emails(emails)
+
+        assert matched_types and all(kind in (bytes, bytearray) for kind in matched_types)
+        assert all(isinstance(email_data.body_raw, (bytes, bytearray)) for email_data in emails)
+        # The database still holds the text
+        assert temp_db.get_email_body(emails[0].id) == emails[0].body
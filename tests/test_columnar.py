@@ -0,0 +1,110 @@
+import json
+import os
+import threading
+
+import pytest
+
+from benchmarks.fake_gmail import make_service
+from processor.columnar import (VectorizedEvaluator, compare_with_engine, export_database, iter_record_batches,
+                                read_table, received_at, row_to_email)
+from processor.database import EmailDatabase
+from processor.parse import load_emails
+from processor.rules import RuleEngine
+
+RULES = [
+    {'name': 'From example', 'predicate': 'all',
+     'conditions': [{'field': 'from', 'operator': 'contains', 'value': 'EXAMPLE'}],
+     'actions': [{'type': 'mark_as_read'}]},
+    {'name': 'Old or starred', 'predicate': 'any',
+     'conditions': [{'field': 'date_received', 'operator': 'older_than', 'value': 365, 'unit': 'days'},
+                    {'field': 'labels', 'operator': 'has', 'value': 'STARRED'}],
+     'actions': [{'type': 'mark_as_read'}]},
+    {'name': 'Unread invoices', 'predicate': 'all',
+     'conditions': [{'field': 'subject', 'operator': 'not_equals', 'value': 'x'},
+                    {'field': 'body', 'operator': 'contains', 'value': 'invoice'},
+                    {'field': 'labels', 'operator': 'has_all', 'value': ['INBOX', 'UNREAD']}],
+     'actions': [{'type': 'mark_as_read'}]},
+    {'name': 'Not in inbox', 'predicate': 'all',
+     'conditions': [{'field': 'labels', 'operator': 'not_has', 'value': ['INBOX']}],
+     'actions': [{'type': 'mark_as_read'}]}
+]
+
+
+@pytest.fixture
+def exported(temp_db, tmp_path):
+    pytest.importorskip('pyarrow')
+    service = make_service(300)
+    load_emails(service, [service.mailbox.message_id(i) for i in range(300)], temp_db)
+    return temp_db, tmp_path
+
+
+def rule_engine(db, tmp_path):
+    rules_file = tmp_path / 'rules.json'
+    rules_file.write_text(json.dumps({'rules': RULES}))
+    return RuleEngine(str(rules_file), label_registry=db.labels)
+
+
+class TestColumnarHelpers:
+
+    def test_received_at(self):
+        assert received_at('Mon, 15 Jan 2024 10:30:00 +0000') == 1705314600
+        assert received_at('yesterday') is None
+        assert received_at(None) is None
+
+    def test_row_to_email(self):
+        email_data = row_to_email({'id': '1', 'thread_id': 't', 'from_email': None, 'to_email': 'a@b.c',
+                                   'subject': 'Hi', 'body': 'text', 'date_received': '', 'is_read': True,
+                                   'labels': ['INBOX'], 'snippet': None})
+        assert email_data.from_email == '' and email_data.labels == ('INBOX',) and email_data.body == 'text'
+
+
+class TestColumnarExport:
+
+    @pytest.mark.parametrize('export_format', ['parquet', 'arrow'])
+    def test_export_in_chunks(self, exported, export_format):
+        db, tmp_path = exported
+
+        result = export_database(db, str(tmp_path / 'export'), export_format, chunk_size=64)
+
+        path, rows = result['emails']
+        assert rows == 300 and os.path.exists(path)
+        table = read_table(path)
+        assert table.num_rows == 300
+        stored = db.get_emails_by_ids([table.column('id')[0].as_py()])[0]
+        assert table.column('subject')[0].as_py() == stored.subject
+        assert table.column('labels')[0].as_py() == list(stored.labels)
+        assert result['email_actions'][1] == 0
+
+    def test_batches_do_not_hold_the_connection(self, exported):
+        db, _ = exported
+        shared = EmailDatabase(db.db_path, keep_alive=True)
+        batches = iter_record_batches(shared, chunk_size=100)
+        first = next(batches)
+
+        # Another thread can use the shared connection while the consumer works on a batch
+        reader = threading.Thread(target=shared.email_exists, args=(first.column('id')[0].as_py(),))
+        reader.start()
+        reader.join(timeout=5)
+
+        assert not reader.is_alive()
+        assert first.num_rows + sum(batch.num_rows for batch in batches) == 300
+        shared.close()
+
+    def test_vectorized_masks_match_engine(self, exported):
+        db, tmp_path = exported
+        table = read_table(export_database(db, str(tmp_path / 'export'))['emails'][0])
+        engine = rule_engine(db, tmp_path)
+        assert len(engine.rules) == len(RULES)
+
+        masks = VectorizedEvaluator(engine.rules).evaluate(table)
+
+        assert set(masks) == {rule['name'] for rule in RULES}
+        assert all(len(mask) == 300 for mask in masks.values())
+        assert compare_with_engine(engine, table, masks) == {rule['name']: [] for rule in RULES}
+
+    def test_unknown_operator_matches_nothing(self, exported):
+        db, tmp_path = exported
+        table = read_table(export_database(db, str(tmp_path / 'export'))['emails'][0])
+        rule = {'name': 'odd', 'conditions': [{'field': 'from', 'operator': 'sounds_like', 'value': 'x'}]}
+
+        assert not any(VectorizedEvaluator([rule]).rule_mask(table, rule).to_pylist())
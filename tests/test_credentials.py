@@ -0,0 +1,100 @@
+import json
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from unittest.mock import Mock, patch
+
+import pytest
+from google.oauth2.credentials import Credentials
+
+from processor.credentials import CredentialManager
+from processor.service import ServiceProxy
+
+
+def _utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _write_token(path, token, expires_in):
+    creds = Credentials(token=token, refresh_token='refresh', token_uri='https://oauth2.googleapis.com/token',
+                        client_id='client', client_secret='secret', expiry=_utcnow() + timedelta(seconds=expires_in))
+    with open(path, 'w') as f:
+        f.write(creds.to_json())
+
+
+class TestCredentialManager:
+
+    def test_valid_token_is_not_refreshed(self, tmp_path):
+        token_path = str(tmp_path / 'token.json')
+        _write_token(token_path, 'fresh', expires_in=3600)
+        manager = CredentialManager(token_path, refresh_margin=300)
+
+        with patch.object(Credentials, 'refresh') as refresh:
+            assert manager.get_credentials().token == 'fresh'
+
+        refresh.assert_not_called()
+
+    def test_refreshes_once_across_threads(self, tmp_path):
+        token_path = str(tmp_path / 'token.json')
+        _write_token(token_path, 'stale', expires_in=60)
+        manager = CredentialManager(token_path, refresh_margin=300)
+
+        def refresh(creds, request):
+            creds.token = 'refreshed'
+            creds.expiry = _utcnow() + timedelta(hours=1)
+
+        with patch.object(Credentials, 'refresh', autospec=True, side_effect=refresh) as mock_refresh:
+            threads = [threading.Thread(target=manager.get_credentials) for _ in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        assert mock_refresh.call_count == 1
+        with open(token_path) as f:
+            assert json.load(f)['token'] == 'refreshed'
+        assert not [name for name in os.listdir(tmp_path) if name.startswith('.tmp-')]
+
+    def test_adopts_token_refreshed_by_another_process(self, tmp_path):
+        token_path = str(tmp_path / 'token.json')
+        _write_token(token_path, 'stale', expires_in=3600)
+        manager = CredentialManager(token_path, refresh_margin=300)
+        creds = manager.get_credentials()
+
+        creds.expiry = _utcnow() + timedelta(seconds=60)
+        _write_token(token_path, 'from-other-process', expires_in=3600)
+        stat = os.stat(token_path)
+        os.utime(token_path, (stat.st_atime, stat.st_mtime + 1))
+
+        with patch.object(Credentials, 'refresh') as refresh:
+            assert manager.get_credentials() is creds
+        refresh.assert_not_called()
+        assert creds.token == 'from-other-process'
+
+
+class TestServiceProxy:
+
+    def test_hooks_wrap_execute(self):
+        service = Mock()
+        service.users().messages().get().execute.return_value = {'id': 'abc'}
+        hook = Mock()
+        proxy = ServiceProxy(service, hooks=[hook])
+
+        result = proxy.users().messages().get(userId='me', id='abc').execute()
+
+        assert result == {'id': 'abc'}
+        hook.before_execute.assert_called_once_with('users.messages.get')
+        method, elapsed, error = hook.after_execute.call_args[0]
+        assert method == 'users.messages.get'
+        assert error is None
+
+    def test_before_hook_can_stop_request(self):
+        service = Mock()
+        hook = Mock()
+        hook.before_execute.side_effect = RuntimeError('no token')
+        proxy = ServiceProxy(service, hooks=[hook])
+
+        with pytest.raises(RuntimeError):
+            proxy.users().labels().list(userId='me').execute()
+
+        service.users().labels().list().execute.assert_not_called()
@@ -0,0 +1,53 @@
+import threading
+from unittest.mock import Mock
+
+from processor.daemon import PollingScheduler
+
+
+class TestPollingScheduler:
+
+    def test_backoff_when_idle(self):
+        scheduler = PollingScheduler(Mock(), interval=10, max_interval=50, backoff_factor=2)
+
+        assert scheduler.next_interval(had_work=False) == 20
+        assert scheduler.next_interval(had_work=False) == 40
+        assert scheduler.next_interval(had_work=False) == 50
+        assert scheduler.next_interval(had_work=True) == 10
+
+    def test_run_polls_until_limit(self):
+        processor = Mock()
+        processor.process_emails.return_value = 1
+        scheduler = PollingScheduler(processor, interval=0, max_interval=0, limit=5)
+
+        assert scheduler.run(max_polls=3) == 3
+        processor.process_emails.assert_called_with(limit=5)
+
+    def test_poll_survives_errors(self):
+        processor = Mock()
+        processor.process_emails.side_effect = Exception('boom')
+        scheduler = PollingScheduler(processor)
+
+        assert scheduler.poll() == 0
+
+    def test_reload_before_next_poll(self):
+        processor = Mock()
+        processor.process_emails.return_value = 0
+        scheduler = PollingScheduler(processor)
+
+        scheduler.request_reload()
+        scheduler.poll()
+        scheduler.poll()
+
+        processor.reload.assert_called_once()
+
+    def test_stop_interrupts_sleep(self):
+        processor = Mock()
+        processor.process_emails.return_value = 0
+        scheduler = PollingScheduler(processor, interval=3600, max_interval=3600)
+
+        thread = threading.Thread(target=scheduler.run)
+        thread.start()
+        scheduler.stop()
+        thread.join(timeout=5)
+
+        assert not thread.is_alive()
@@ -0,0 +1,67 @@
+from benchmarks.fake_gmail import make_service
+from processor.models import EmailRecord
+from processor.parse import load_emails
+
+
+def record(history_id='100', labels=('INBOX', 'UNREAD'), body='Hello'):
+    return EmailRecord(id='msg1', thread_id='t1', from_email='a@example.com', subject='Hi', date='',
+                       labels=labels, is_read='UNREAD' not in labels, history_id=history_id, _body=body)
+
+
+class TestFingerprint:
+
+    def test_repeated_upsert_is_a_no_op(self, temp_db):
+        assert temp_db.upsert_emails([record()])['inserted'] == 1
+
+        counts = temp_db.upsert_emails([record()])
+
+        assert counts == {'inserted': 0, 'updated': 0, 'unchanged': 1, 'failed': 0}
+        assert temp_db.get_fingerprints(['msg1'])['msg1']['history_id'] == '100'
+
+    def test_unadvanced_history_skips_the_write(self, temp_db):
+        temp_db.upsert_emails([record()])
+
+        # Same history ID: trusted as unchanged without comparing columns
+        assert temp_db.upsert_emails([record(labels=('INBOX',))])['unchanged'] == 1
+        assert temp_db.get_emails_by_ids(['msg1'])[0].labels == ('INBOX', 'UNREAD')
+
+    def test_relabel_updates_only_label_columns(self, temp_db):
+        temp_db.upsert_emails([record()])
+        before = temp_db.get_fingerprints(['msg1'])['msg1']
+
+        assert temp_db.upsert_emails([record('101', labels=('INBOX',))])['updated'] == 1
+
+        stored = temp_db.get_emails_by_ids(['msg1'])[0]
+        assert stored.labels == ('INBOX',) and stored.is_read
+        after = temp_db.get_fingerprints(['msg1'])['msg1']
+        assert after['history_id'] == '101'
+        assert after['body_hash'] == before['body_hash']
+
+    def test_changed_body_rewrites_content(self, temp_db):
+        temp_db.upsert_emails([record()])
+
+        temp_db.upsert_emails([record('101', body='Edited')])
+
+        assert temp_db.get_email_body('msg1') == 'Edited'
+
+    def test_update_labels(self, temp_db):
+        temp_db.upsert_emails([record()])
+
+        assert temp_db.update_labels([('msg1', ['INBOX', 'UNREAD'], '100')]) == 0
+        assert temp_db.update_labels([('msg1', ['STARRED'], '105')]) == 1
+        assert temp_db.get_emails_by_ids(['msg1'])[0].labels == ('STARRED',)
+
+    def test_refresh_fetches_labels_not_content(self, temp_db):
+        service = make_service(10)
+        ids = [service.mailbox.message_id(i) for i in range(10)]
+        load_emails(service, ids, temp_db)
+        service.users().messages().modify(userId='me', id=ids[0], body={'addLabelIds': ['STARRED']}).execute()
+        service.calls.clear()
+
+        emails = load_emails(service, ids, temp_db, refresh=True)
+
+        # One batch of minimal gets, no full fetches
+        assert service.calls == {'batch': 1, 'users.messages.get': 10}
+        assert 'STARRED' in next(email for email in emails if email.id == ids[0]).labels
+        assert temp_db.get_fingerprints(ids[:1])[ids[0]]['history_id'] == service.users().messages().get(
+            userId='me', id=ids[0], format='minimal').execute()['historyId']
@@ -0,0 +1,150 @@
+import sqlite3
+import threading
+import time
+
+from processor.actions import EmailActions
+from processor.database import EmailDatabase
+from processor.labels import LabelRegistry, label_change_groups
+
+
+class TestLabelRegistry:
+
+    def test_mask_round_trip(self):
+        registry = LabelRegistry()
+
+        mask = registry.mask(['INBOX', 'Label_7'])
+
+        assert sorted(registry.labels(mask)) == ['INBOX', 'Label_7']
+        assert registry.has(mask, 'INBOX')
+        assert not registry.has(mask, 'UNREAD')
+
+    def test_bits_persist_in_database(self, temp_db):
+        bit = temp_db.labels.bit('Label_42')
+
+        assert EmailDatabase(temp_db.db_path).labels.bit('Label_42') == bit
+
+    def test_wide_masks_are_stored(self, temp_db, sample_email_data):
+        labels = [f'Label_{i}' for i in range(80)]
+        temp_db.insert_email(dict(sample_email_data, labels=labels))
+
+        mask = temp_db.get_label_masks(['test_email_123'])['test_email_123']
+
+        assert sorted(temp_db.labels.labels(mask)) == sorted(labels)
+
+    def test_masks_filled_for_existing_rows(self, tmp_path):
+        db_path = str(tmp_path / 'old.db')
+        conn = sqlite3.connect(db_path)
+        conn.execute('''CREATE TABLE emails (id TEXT PRIMARY KEY, thread_id TEXT, from_email TEXT, to_email TEXT,
+                        subject TEXT, body TEXT, date_received TEXT, is_read BOOLEAN, labels TEXT, snippet TEXT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+        conn.execute("INSERT INTO emails (id, labels) VALUES ('old_1', 'INBOX,UNREAD')")
+        conn.commit()
+        conn.close()
+
+        db = EmailDatabase(db_path)
+
+        assert db.get_label_masks(['old_1'])['old_1'] == db.labels.mask(['INBOX', 'UNREAD'])
+
+    def test_label_change_groups(self):
+        groups = label_change_groups([('a', 1, 0), ('b', 1, 0), ('a', 1, 0), ('c', 0, 2)])
+
+        assert groups == {(1, 0): ['a', 'b'], (0, 2): ['c']}
+
+
+class TestLabelConditions:
+
+    def test_label_operators(self, rule_engine_with_temp_file, sample_email_data):
+        rule_engine = rule_engine_with_temp_file
+
+        def check(operator, value):
+            condition = {'field': 'labels', 'operator': operator, 'value': value}
+            return rule_engine.check_condition(sample_email_data, condition)
+
+        assert check('has', 'UNREAD') is True
+        assert check('has', 'STARRED') is False
+        assert check('has_all', ['INBOX', 'UNREAD']) is True
+        assert check('has_all', ['INBOX', 'STARRED']) is False
+        assert check('has_any', ['STARRED', 'INBOX']) is True
+        assert check('not_has', ['STARRED', 'SPAM']) is True
+        assert check('unknown', 'INBOX') is False
+
+
+class TestBatchedActions:
+
+    def test_label_changes_grouped_into_batch_modify(self, mock_gmail_service, temp_db):
+        actions = EmailActions(mock_gmail_service, db=temp_db)
+        items = [
+            {'rule_name': 'Read', 'action': {'type': 'mark_as_read'}, 'email_id': f'email_{i}'}
+            for i in range(3)
+        ] + [
+            {'rule_name': 'Label', 'action': {'type': 'move_message', 'folder': 'Test Label'}, 'email_id': 'email_0'},
+            {'rule_name': 'Trash', 'action': {'type': 'move_message', 'folder': 'TRASH'}, 'email_id': 'email_9'}
+        ]
+
+        success, failed = actions.execute_actions(items, batch=True)
+
+        assert (success, failed) == (5, 0)
+        calls = actions.service.users().messages().batchModify.call_args_list
+        bodies = sorted((call.kwargs['body'] for call in calls), key=lambda body: len(body['ids']))
+        assert bodies == [
+            {'ids': ['email_0'], 'addLabelIds': ['Label_1'], 'removeLabelIds': []},
+            {'ids': ['email_0', 'email_1', 'email_2'], 'addLabelIds': [], 'removeLabelIds': ['UNREAD']}
+        ]
+        actions.service.users().messages().trash.assert_called_with(userId='me', id='email_9')
+        assert temp_db.action_exists('email_2', 'Read', 'mark_as_read')
+        assert temp_db.action_exists('email_0', 'Label', 'move_to_Test Label')
+
+
+class TestSharedLabelBits:
+
+    def test_processes_never_share_a_bit(self, temp_db):
+        other = EmailDatabase(temp_db.db_path)
+        # Both registries start from the same stored bits and register different labels
+        first = temp_db.labels.bit('Label_a')
+        second = other.labels.bit('Label_b')
+
+        assert first != second
+        # The label the other process registered keeps its stored bit here too
+        assert temp_db.labels.bit('Label_b') == second
+        stored = temp_db.get_label_bits()
+        assert (1 << stored['Label_a'], 1 << stored['Label_b']) == (first, second)
+
+    def test_registering_while_storing_does_not_deadlock(self, temp_db):
+        db = EmailDatabase(temp_db.db_path, keep_alive=True)
+        storing = threading.Event()
+
+        def writer():
+            # Like insert_emails: holds the connection, then needs a mask
+            with db.connect():
+                storing.set()
+                time.sleep(0.2)
+                db.labels.mask(['Label_writer'])
+
+        def executor():
+            # Like get_email_label_mask on another thread, registering a new label
+            storing.wait()
+            db.labels.bit('Label_executor')
+
+        threads = [threading.Thread(target=target, daemon=True) for target in (writer, executor)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=5)
+
+        assert not any(thread.is_alive() for thread in threads)
+        assert {'Label_writer', 'Label_executor'} <= set(db.get_label_bits())
+        db.close()
+
+    def test_rule_labels_are_not_registered(self, rule_engine_with_temp_file, sample_email_data, temp_db):
+        rule_engine = rule_engine_with_temp_file
+        rule_engine.label_registry = temp_db.labels
+
+        def check(operator, value):
+            condition = {'field': 'labels', 'operator': operator, 'value': value}
+            return rule_engine.check_condition(sample_email_data, condition)
+
+        assert check('has', 'Lable_typo') is False
+        assert check('has_all', ['INBOX', 'Lable_typo']) is False
+        assert check('has_any', ['INBOX', 'Lable_typo']) is True
+        assert check('not_has', ['Lable_typo']) is True
+        assert 'Lable_typo' not in temp_db.get_label_bits()
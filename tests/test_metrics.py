@@ -0,0 +1,134 @@
+import json
+import urllib.error
+import urllib.request
+from unittest.mock import Mock
+
+import pytest
+
+from processor.actions import EmailActions
+from processor.metrics import ApiMetrics, Metrics, MetricsServer, metrics, write_summary
+from processor.service import ServiceProxy
+
+
+class TestMetrics:
+
+    def test_counters_and_histograms(self):
+        registry = Metrics(buckets=(0.1, 1.0))
+        registry.inc('calls_total', method='get')
+        registry.inc('calls_total', 2, method='get')
+        registry.inc('calls_total', method='list')
+        registry.observe('latency_seconds', 0.05, method='get')
+        registry.observe('latency_seconds', 0.5, method='get')
+
+        summary = registry.summary()
+
+        assert summary['counters']['calls_total'] == {'method=get': 3, 'method=list': 1}
+        assert summary['histograms']['latency_seconds']['method=get'] == {
+            'count': 2, 'sum': 0.55, 'avg': 0.275, 'max': 0.5
+        }
+        assert registry.counter('calls_total', method='get') == 3
+        assert registry.counter('calls_total', method='modify') == 0
+
+    def test_prometheus_format(self):
+        registry = Metrics(buckets=(0.1, 1.0))
+        registry.inc('calls_total', method='users.messages.get', status='ok')
+        registry.observe('latency_seconds', 0.05, rule='say "hi"')
+        registry.observe('latency_seconds', 5.0, rule='say "hi"')
+
+        lines = registry.render_prometheus().splitlines()
+
+        assert '# TYPE calls_total counter' in lines
+        assert 'calls_total{method="users.messages.get",status="ok"} 1' in lines
+        assert '# TYPE latency_seconds histogram' in lines
+        assert 'latency_seconds_bucket{rule="say \\"hi\\"",le="0.1"} 1' in lines
+        assert 'latency_seconds_bucket{rule="say \\"hi\\"",le="1.0"} 1' in lines
+        assert 'latency_seconds_bucket{rule="say \\"hi\\"",le="+Inf"} 2' in lines
+        assert 'latency_seconds_count{rule="say \\"hi\\""} 2' in lines
+
+    def test_timed_decorator(self):
+        registry = Metrics()
+
+        @registry.timed('work_seconds', kind='test')
+        def work():
+            return 42
+
+        assert work() == 42
+        assert work() == 42
+        assert registry.summary()['histograms']['work_seconds']['kind=test']['count'] == 2
+
+    def test_api_metrics_hook(self):
+        registry = Metrics()
+        target = Mock()
+        target.users().messages().get().execute.return_value = {'id': '1'}
+        target.users().messages().modify().execute.side_effect = RuntimeError('boom')
+        service = ServiceProxy(target, hooks=[ApiMetrics(registry)])
+
+        service.users().messages().get(userId='me', id='1').execute()
+        with pytest.raises(RuntimeError):
+            service.users().messages().modify(userId='me', id='1', body={}).execute()
+
+        assert registry.counter('gmail_api_calls_total', method='users.messages.get', status='ok') == 1
+        assert registry.counter('gmail_api_calls_total', method='users.messages.modify', status='error') == 1
+
+    def test_metrics_server(self):
+        registry = Metrics()
+        registry.inc('polls_total')
+        server = MetricsServer(registry, port=0)
+        server.start()
+        try:
+            with urllib.request.urlopen(server.url) as response:
+                assert response.headers['Content-Type'].startswith('text/plain')
+                assert 'polls_total 1' in response.read().decode()
+
+            with pytest.raises(urllib.error.HTTPError) as error:
+                urllib.request.urlopen(server.url.replace('/metrics', '/other'))
+            assert error.value.code == 404
+        finally:
+            server.stop()
+
+    def test_write_summary(self, tmp_path):
+        registry = Metrics()
+        registry.inc('actions_total', type='mark_as_read', status='success')
+        path = tmp_path / 'metrics.json'
+
+        write_summary(str(path), registry)
+
+        assert json.loads(path.read_text())['counters']['actions_total'] == {'status=success,type=mark_as_read': 1}
+
+
+class TestInstrumentation:
+
+    @pytest.fixture(autouse=True)
+    def reset_metrics(self):
+        metrics.reset()
+        yield
+        metrics.reset()
+
+    def test_rule_evaluations_counted_per_rule(self, rule_engine_with_temp_file, sample_email_data):
+        rule_engine_with_temp_file.get_actions_for_email(sample_email_data)
+
+        assert metrics.counter('rule_evaluations_total', rule='Test Rule 1', result='match') == 1
+        assert metrics.counter('rule_evaluations_total', rule='Test Rule 2', result='miss') == 1
+        assert 'rule=Test Rule 1' in metrics.summary()['histograms']['rule_evaluation_seconds']
+
+    def test_db_operations_timed(self, temp_db, sample_email_data):
+        temp_db.insert_email(sample_email_data)
+        temp_db.email_exists(sample_email_data['id'])
+
+        histograms = metrics.summary()['histograms']['db_operation_seconds']
+        assert histograms['operation=insert_email']['count'] == 1
+        assert histograms['operation=email_exists']['count'] == 1
+
+    def test_action_outcomes_counted(self, mock_gmail_service, temp_db):
+        email_actions = EmailActions(mock_gmail_service, db=temp_db)
+        email_actions.get_email_labels = Mock(return_value=['INBOX', 'UNREAD'])
+
+        email_actions.execute_actions([
+            {'rule_name': 'r', 'action': {'type': 'mark_as_read'}, 'email_id': 'a'},
+            {'rule_name': 'r', 'action': {'type': 'move_message', 'folder': 'Test Label'}, 'email_id': 'a'},
+            {'rule_name': 'r', 'action': {'type': 'explode'}, 'email_id': 'a'}
+        ])
+
+        assert metrics.counter('actions_total', type='mark_as_read', status='success') == 1
+        assert metrics.counter('actions_total', type='move_to_label', status='success') == 1
+        assert metrics.counter('actions_total', type='explode', status='failed') == 1
@@ -0,0 +1,48 @@
+import pytest
+
+from processor.models import ActionItem, EmailRecord
+
+
+class TestEmailRecord:
+
+    def test_dict_compat(self, sample_email_data):
+        record = EmailRecord.from_dict(sample_email_data)
+
+        assert record['from'] == 'test@example.com'
+        assert record.get('subject') == 'Test Email Subject'
+        assert record.get('missing', 'default') == 'default'
+        assert 'body' in record
+        assert record.to_dict() == dict(sample_email_data, labels=('INBOX', 'UNREAD'))
+        with pytest.raises(KeyError):
+            record['missing']
+
+    def test_labels_are_interned(self):
+        first = EmailRecord(id='1', labels=[''.join(['IN', 'BOX'])])
+        second = EmailRecord(id='2', labels=[''.join(['INB', 'OX'])])
+
+        assert first.labels[0] is second.labels[0]
+
+    def test_no_instance_dict(self):
+        assert not hasattr(EmailRecord(id='1'), '__dict__')
+        assert not hasattr(ActionItem('Rule', {'type': 'mark_as_read'}, '1'), '__dict__')
+
+    def test_body_loaded_lazily_from_database(self, temp_db, sample_email_data):
+        temp_db.insert_email(sample_email_data)
+
+        record = temp_db.get_emails_by_ids(['test_email_123'])[0]
+
+        assert record.body_loaded is False
+        assert record.body == 'This is a test email body content.'
+        assert record.body_loaded is True
+
+
+class TestActionItem:
+
+    def test_dict_compat(self):
+        item = ActionItem('Rule', {'type': 'mark_as_read'}, 'email_1')
+
+        assert item['rule_name'] == 'Rule'
+        assert item['action']['type'] == 'mark_as_read'
+        assert item.action_type == 'mark_as_read'
+        assert ActionItem.coerce({'rule_name': 'Rule', 'action': {'type': 'mark_as_read'},
+                                  'email_id': 'email_1'}) == item
@@ -0,0 +1,109 @@
+import json
+import time
+
+import pytest
+
+from processor import operators
+from processor.operators import compile_matcher, domain_in, header_addresses
+from processor.rules import RuleEngine
+
+
+@pytest.fixture
+def engine(tmp_path):
+    def make(rules):
+        rules_file = tmp_path / 'rules.json'
+        rules_file.write_text(json.dumps({'rules': rules}))
+        return RuleEngine(str(rules_file))
+    return make
+
+
+def email(from_email='Alice <Alice@Mail.Example.com>', **fields):
+    return dict({'id': '1', 'from': from_email, 'to': 'me@gmail.com, Bob <bob@corp.test>',
+                 'subject': 'Invoice #1234 due', 'body': 'Please pay', 'date': '', 'labels': []}, **fields)
+
+
+class TestStructuredOperators:
+
+    def test_header_addresses(self):
+        assert header_addresses('Alice <Alice@Mail.Example.com>') == (('alice@mail.example.com', 'mail.example.com'),)
+        assert header_addresses('a@x.com, "B, C" <b@y.org>') == (('a@x.com', 'x.com'), ('b@y.org', 'y.org'))
+        assert header_addresses('') == ()
+
+    def test_domain_in_matches_subdomains(self):
+        domains = frozenset({'example.com'})
+        assert domain_in('example.com', domains)
+        assert domain_in('mail.example.com', domains)
+        assert not domain_in('notexample.com', domains)
+
+    def test_matches(self, engine):
+        rule_engine = engine([])
+        condition = {'field': 'subject', 'operator': 'matches', 'value': r'invoice #\d+'}
+        assert rule_engine.check_condition(email(), condition) is True
+        assert rule_engine.check_condition(email(subject='Invoice pending'), condition) is False
+
+    def test_matches_is_compiled_once(self, engine, monkeypatch):
+        condition = {'field': 'subject', 'operator': 'matches', 'value': r'due$'}
+        rule_engine = engine([{'name': 'r', 'conditions': [condition], 'actions': []}])
+        compiled = []
+        original = operators.compile_pattern
+        monkeypatch.setattr(operators, 'compile_pattern', lambda *args: compiled.append(args) or original(*args))
+
+        for _ in range(5):
+            assert rule_engine.check_condition(email(), dict(condition)) is True
+        assert compiled == []
+
+    def test_invalid_pattern_matches_nothing(self, engine):
+        rule_engine = engine([{'name': 'r', 'conditions': [{'field': 'subject', 'operator': 'matches',
+                                                           'value': '(unclosed'}], 'actions': []}])
+        assert rule_engine.evaluate_rule(email(), rule_engine.rules[0]) is False
+
+    @pytest.mark.parametrize('pattern', [r'(a+)+$', r'(a*)*b', r'(\w+\s?)+$', r'(?:x|y+)*z'])
+    def test_nested_quantifiers_are_rejected(self, engine, pattern):
+        rule_engine = engine([{'name': 'r', 'conditions': [{'field': 'subject', 'operator': 'matches',
+                                                           'value': pattern}], 'actions': []}])
+        started = time.perf_counter()
+
+        assert rule_engine.evaluate_rule(email(subject='a' * 40 + '!'), rule_engine.rules[0]) is False
+        assert time.perf_counter() - started < 1
+
+    def test_nested_quantifier(self):
+        assert not operators.nested_quantifier(r'invoice #\d+ (due|paid)+')
+        assert not operators.nested_quantifier(r'(\d{3})-(\d+)')
+        assert operators.nested_quantifier(r'((ab)+c)*')
+
+    def test_matches_input_is_bounded(self, engine, monkeypatch):
+        monkeypatch.setattr(operators, '_regex', None)
+        rule_engine = engine([])
+        condition = {'field': 'body', 'operator': 'matches', 'value': 'needle'}
+        body = 'x' * operators.MATCH_INPUT_LIMIT + 'needle'
+        assert rule_engine.check_condition(email(body=body), condition) is False
+
+    def test_in_list(self, engine):
+        rule_engine = engine([])
+        condition = {'field': 'from', 'operator': 'in_list', 'value': ['alice@mail.example.com', 'x@y.z']}
+        assert rule_engine.check_condition(email(), condition) is True
+        assert rule_engine.check_condition(email(from_email='carol@example.com'), condition) is False
+
+        subjects = {'field': 'subject', 'operator': 'in_list', 'value': ['hello', 'INVOICE #1234 DUE']}
+        assert rule_engine.check_condition(email(), subjects) is True
+
+    def test_domain_in(self, engine):
+        rule_engine = engine([])
+        condition = {'field': 'from', 'operator': 'domain_in', 'value': ['@example.com', 'other.org']}
+        assert rule_engine.check_condition(email(), condition) is True
+        assert rule_engine.check_condition(email(from_email='eve@example.com.evil.net'), condition) is False
+        # Any recipient counts for the To header
+        recipients = {'field': 'to', 'operator': 'domain_in', 'value': ['corp.test']}
+        assert rule_engine.check_condition(email(), recipients) is True
+
+    def test_domain_in_needs_address_field(self):
+        assert compile_matcher('subject', 'domain_in', ['example.com']) is None
+
+    def test_reload_recompiles(self, engine, tmp_path):
+        condition = {'field': 'from', 'operator': 'domain_in', 'value': ['example.com']}
+        rule_engine = engine([{'name': 'r', 'conditions': [condition], 'actions': []}])
+        (tmp_path / 'rules.json').write_text(json.dumps({'rules': []}))
+
+        rule_engine.reload()
+
+        assert rule_engine._matchers == {}
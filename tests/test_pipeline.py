@@ -0,0 +1,184 @@
+import threading
+from unittest.mock import Mock
+
+import pytest
+
+from processor.actions import EmailActions
+from processor.pipeline import Pipeline, PipelineError
+from processor.priority import Deadline
+
+
+class FakeRequest:
+    def __init__(self, response):
+        self.response = response
+
+    def execute(self):
+        return self.response() if callable(self.response) else self.response
+
+
+class FakeMailbox:
+    """Just enough of the Gmail service for the pipeline: paged list, get, modify"""
+
+    def __init__(self, size, page_size=5):
+        self.size = size
+        self.page_size = page_size
+        self.fetched = []
+        self.modified = []
+        self.lock = threading.Lock()
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def labels(self):
+        return Mock(list=Mock(return_value=FakeRequest({'labels': []})))
+
+    def list(self, userId, q, maxResults, pageToken=None):
+        start = int(pageToken or 0)
+        end = min(start + min(maxResults, self.page_size), self.size)
+        return FakeRequest({
+            'messages': [{'id': f'msg{i}'} for i in range(start, end)],
+            'nextPageToken': str(end) if end < self.size else None
+        })
+
+    def get(self, userId, id, format):
+        if format == 'full':
+            with self.lock:
+                self.fetched.append(id)
+        index = int(id[3:])
+        sender = 'test@example.com' if index % 2 == 0 else 'other@example.com'
+        return FakeRequest({
+            'id': id,
+            'threadId': f'thread{index}',
+            'labelIds': ['INBOX', 'UNREAD'],
+            'snippet': '',
+            'payload': {
+                'headers': [
+                    {'name': 'From', 'value': sender},
+                    {'name': 'Subject', 'value': f'Message {index}'},
+                    {'name': 'Date', 'value': 'Mon, 15 Jan 2024 10:30:00 +0000'}
+                ],
+                'mimeType': 'text/plain',
+                'body': {'data': ''}
+            }
+        })
+
+    def modify(self, userId, id, body):
+        with self.lock:
+            self.modified.append(id)
+        return FakeRequest({})
+
+
+class TestPipeline:
+
+    def _pipeline(self, service, db, rule_engine, **kwargs):
+        return Pipeline(service, db, rule_engine, actions=EmailActions(service, db=db), **kwargs)
+
+    def test_processes_every_page(self, temp_db, rule_engine_with_temp_file):
+        service = FakeMailbox(23)
+        pipeline = self._pipeline(service, temp_db, rule_engine_with_temp_file, fetch_workers=3)
+
+        stats = pipeline.run(limit=100)
+
+        assert stats['listed'] == 23
+        assert stats['emails'] == stats['new'] == 23
+        assert stats['actions'] == stats['succeeded'] == 12
+        assert stats['failed'] == 0
+        assert stats['first_action_after'] is not None
+        assert sorted(service.modified) == sorted(f'msg{i}' for i in range(0, 23, 2))
+        assert temp_db.email_exists('msg22')
+
+    def test_respects_limit_and_reuses_stored_emails(self, temp_db, rule_engine_with_temp_file):
+        service = FakeMailbox(20)
+        self._pipeline(service, temp_db, rule_engine_with_temp_file).run(limit=8)
+        assert len(service.fetched) == 8
+
+        service.fetched.clear()
+        stats = self._pipeline(service, temp_db, rule_engine_with_temp_file).run(limit=8)
+
+        assert service.fetched == []
+        assert stats['emails'] == 8
+        assert stats['new'] == 0
+
+    def test_small_queues_apply_backpressure(self, temp_db, rule_engine_with_temp_file):
+        service = FakeMailbox(30, page_size=30)
+        pipeline = self._pipeline(service, temp_db, rule_engine_with_temp_file, queue_size=1, fetch_workers=2)
+
+        stats = pipeline.run(limit=30)
+
+        assert stats['emails'] == 30
+        assert stats['succeeded'] == 15
+
+    def test_stage_error_stops_pipeline(self, temp_db, rule_engine_with_temp_file):
+        service = FakeMailbox(50)
+        rule_engine_with_temp_file.get_actions_for_email = Mock(side_effect=RuntimeError('bad rule'))
+        pipeline = self._pipeline(service, temp_db, rule_engine_with_temp_file, queue_size=2)
+
+        with pytest.raises(PipelineError, match='evaluate'):
+            pipeline.run(limit=50)
+
+        assert not any(thread.name.startswith('pipeline-') for thread in threading.enumerate())
+        assert len(service.fetched) < 50
+
+    def test_service_factory_per_worker(self, temp_db, rule_engine_with_temp_file):
+        service = FakeMailbox(10)
+        factory = Mock(return_value=service)
+        pipeline = Pipeline(service, temp_db, rule_engine_with_temp_file, fetch_workers=3, action_workers=2,
+                            service_factory=factory)
+
+        stats = pipeline.run(limit=10)
+
+        # One lister, three fetchers, two executors
+        assert factory.call_count == 6
+        assert stats['succeeded'] == 5
+
+    def test_service_factory_bypasses_shared_actions(self, temp_db, rule_engine_with_temp_file):
+        service = FakeMailbox(10)
+        shared = Mock()
+        pipeline = Pipeline(service, temp_db, rule_engine_with_temp_file, actions=shared, fetch_workers=1,
+                            service_factory=Mock(return_value=service))
+
+        stats = pipeline.run(limit=10)
+
+        shared.execute_actions.assert_not_called()
+        shared.execute_batched.assert_not_called()
+        assert stats['succeeded'] == 5
+
+    def test_expired_deadline_lists_nothing(self, temp_db, rule_engine_with_temp_file):
+        service = FakeMailbox(10)
+
+        stats = self._pipeline(service, temp_db, rule_engine_with_temp_file).run(limit=10, deadline=Deadline(0))
+
+        assert stats['listed'] == 0 and service.fetched == [] and service.modified == []
+
+    def test_deadline_leaves_queued_work(self, temp_db, rule_engine_with_temp_file):
+        service = FakeMailbox(40, page_size=40)
+
+        class AfterFirstAction:
+            def expired(self):
+                return bool(service.modified)
+
+            def remaining(self):
+                return None
+
+        stats = self._pipeline(service, temp_db, rule_engine_with_temp_file).run(limit=40, deadline=AfterFirstAction())
+
+        assert len(service.modified) == stats['succeeded'] == 1
+        assert stats['deferred'] + stats['succeeded'] == stats['actions']
+        assert stats['skipped'] + stats['emails'] + stats['fetch_failed'] == stats['listed'] == 40
+
+    @pytest.mark.parametrize('flag', [['--durable-queue'], ['--batch-actions'], ['--refresh-labels']])
+    def test_rejects_flags_it_cannot_honour(self, flag, capsys):
+        from main import parse_args
+        with pytest.raises(SystemExit):
+            parse_args(['--pipeline'] + flag)
+        assert f'--pipeline cannot be combined with {flag[0]}' in capsys.readouterr().err
+        # --threads takes precedence over --pipeline, so the combination is fine there
+        assert parse_args(['--pipeline', '--threads', 'any'] + flag).pipeline
+
+    def test_processor_rejects_durable_queue(self, temp_rules_file):
+        from main import GmailProcessor
+        with pytest.raises(ValueError):
+            GmailProcessor(temp_rules_file, pipeline_options={}, durable_queue=True)
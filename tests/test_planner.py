@@ -0,0 +1,114 @@
+import pytest
+
+from benchmarks.fake_gmail import make_service
+from processor.actions import EmailActions
+from processor.parse import parse_email_content
+from processor.planner import apply_plan, build_plan, format_plan, load_plan, save_plan
+
+
+@pytest.fixture
+def mailbox_setup(temp_db):
+    """Fake Gmail service with its first 12 messages stored in the database"""
+    service = make_service(12)
+    records = [parse_email_content(service, service.mailbox.message_id(i)) for i in range(12)]
+    temp_db.insert_emails(records)
+    service.calls.clear()
+    return service, EmailActions(service, db=temp_db), records
+
+
+def action(record, action, rule_name='rule'):
+    return {'rule_name': rule_name, 'action': action, 'email_id': record.id}
+
+
+class TestPlanner:
+
+    def test_groups_calls_and_estimates_quota(self, mailbox_setup):
+        service, email_actions, records = mailbox_setup
+        unread = [r for r in records if not r.is_read]
+        read = [r for r in records if r.is_read]
+        actions_list = (
+            [action(r, {'type': 'mark_as_read'}) for r in unread]
+            + [action(read[0], {'type': 'mark_as_read'})]
+            + [action(r, {'type': 'move_message', 'folder': 'Newsletters'}) for r in records[:3]]
+            + [action(records[4], {'type': 'move_message', 'folder': 'TRASH'})]
+            + [action(records[5], {'type': 'forward'})]
+        )
+
+        plan = build_plan(actions_list, email_actions, emails=len(records))
+
+        assert plan['actions'] == len(actions_list)
+        assert plan['already_done'] == 0
+        assert [entry['action_type'] for entry in plan['unsupported']] == ['forward']
+        assert plan['call_counts'] == {
+            'users.labels.create': 1, 'users.messages.batchModify': 2, 'users.messages.trash': 1
+        }
+        assert plan['quota_units'] == 5 + 2 * 50 + 5
+
+        mark_read = next(call for call in plan['calls'] if call.get('remove') == ['UNREAD'])
+        # The stored labels say read[0] is read already, but they may be stale
+        assert sorted(mark_read['ids']) == sorted(r.id for r in unread + [read[0]])
+        assert 'estimated quota:    110 units' in format_plan(plan)
+
+        # Planning only lists labels
+        assert set(service.calls) == {'users.labels.list'}
+
+    def test_skips_recorded_actions(self, mailbox_setup):
+        _, email_actions, records = mailbox_setup
+        email_actions.record_action(records[0].id, 'rule', 'move_to_trash', 'done')
+
+        plan = build_plan([action(records[0], {'type': 'move_message', 'folder': 'TRASH'})], email_actions)
+
+        assert plan['already_done'] == 1
+        assert plan['calls'] == []
+        assert plan['quota_units'] == 0
+
+    def test_chunks_large_batches(self, temp_db):
+        service = make_service(10)
+        email_actions = EmailActions(service, db=temp_db)
+        actions_list = [{'rule_name': 'r', 'action': {'type': 'mark_as_unread'}, 'email_id': f'id{i}'}
+                        for i in range(2500)]
+
+        plan = build_plan(actions_list, email_actions)
+
+        assert [len(call['ids']) for call in plan['calls']] == [1000, 1000, 500]
+        assert plan['quota_units'] == 150
+
+    def test_save_and_apply(self, mailbox_setup, tmp_path):
+        service, email_actions, records = mailbox_setup
+        actions_list = [action(r, {'type': 'move_message', 'folder': 'Newsletters'}) for r in records[:3]]
+        actions_list.append(action(records[4], {'type': 'move_message', 'folder': 'TRASH'}))
+        path = str(tmp_path / 'plan.json')
+        save_plan(build_plan(actions_list, email_actions, emails=4), path)
+
+        succeeded, failed = apply_plan(load_plan(path), email_actions)
+
+        assert (succeeded, failed) == (4, 0)
+        labels = service.users().messages().get(userId='me', id=records[0].id, format='minimal').execute()
+        assert 'Label_1' in labels['labelIds']
+        assert service.calls['users.messages.batchModify'] == 1
+        assert service.calls['users.messages.trash'] == 1
+        assert email_actions.db.action_exists(records[0].id, 'rule', 'move_to_Newsletters')
+
+        # Applying again finds everything recorded
+        service.calls.clear()
+        assert apply_plan(load_plan(path), email_actions) == (0, 0)
+        assert 'users.messages.batchModify' not in service.calls
+
+    def test_apply_fixes_stale_stored_labels(self, mailbox_setup):
+        service, email_actions, records = mailbox_setup
+        record = next(r for r in records if r.is_read)
+        # Marked unread in Gmail after it was stored
+        service.users().messages().modify(userId='me', id=record.id, body={'addLabelIds': ['UNREAD']}).execute()
+
+        plan = build_plan([action(record, {'type': 'mark_as_read'})], email_actions)
+        assert apply_plan(plan, email_actions) == (1, 0)
+
+        labels = service.users().messages().get(userId='me', id=record.id, format='minimal').execute()
+        assert 'UNREAD' not in labels['labelIds']
+
+    def test_load_rejects_unknown_version(self, tmp_path):
+        path = tmp_path / 'plan.json'
+        path.write_text('{"version": 99}')
+
+        with pytest.raises(ValueError):
+            load_plan(str(path))
@@ -0,0 +1,183 @@
+import json
+
+from benchmarks.fake_gmail import make_service
+from processor.action_queue import ActionQueue
+from processor.actions import EmailActions
+from processor.models import EmailRecord
+from processor.parse import load_emails
+from processor.pipeline import RankedQueue
+from processor.priority import Deadline, email_timestamp, order_actions, rule_priorities
+from processor.rules import RuleEngine
+from processor.threads import ThreadProcessor
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class ExpiresAfter:
+    """Deadline that expires after a number of checks"""
+
+    def __init__(self, checks, limited=False):
+        self.checks = checks
+        self.limited = limited
+
+    def expired(self):
+        self.checks -= 1
+        return self.checks < 0
+
+    def remaining(self):
+        # Only a time-limited deadline reorders fetches
+        return max(self.checks, 0) if self.limited else None
+
+
+def email(email_id, date, is_read=True):
+    return EmailRecord(id=email_id, date=date, is_read=is_read)
+
+
+def action(email_id, rule_name='rule'):
+    return {'rule_name': rule_name, 'action': {'type': 'move_message', 'folder': 'INBOX'}, 'email_id': email_id}
+
+
+class TestPriority:
+
+    def test_deadline(self):
+        clock = FakeClock()
+        deadline = Deadline(10, clock=clock)
+        assert not deadline.expired() and deadline.remaining() == 10
+        clock.now = 10
+        assert deadline.expired() and deadline.remaining() == 0
+        assert not Deadline(None).expired() and Deadline(None).remaining() is None
+
+    def test_email_timestamp(self):
+        # Dates are compared as times, not strings
+        assert email_timestamp(email('a', 'Tue, 2 Jan 2024 10:00:00 +0000')) > \
+            email_timestamp(email('b', 'Sat, 30 Dec 2023 10:00:00 +0000'))
+        assert email_timestamp(email('c', 'not a date')) == 0
+
+    def test_rule_priorities(self):
+        rules = [{'name': 'a', 'priority': 5}, {'name': 'b'}, {'name': 'c', 'priority': 'high'}]
+        assert rule_priorities(rules) == {'a': 5, 'b': 0, 'c': 0}
+
+    def test_order_actions(self):
+        emails = [email('old', 'Mon, 1 Jan 2024 10:00:00 +0000'),
+                  email('new', 'Fri, 5 Jan 2024 10:00:00 +0000'),
+                  email('unread', 'Mon, 1 Jan 2024 09:00:00 +0000', is_read=False),
+                  email('urgent', 'Mon, 1 Jan 2024 08:00:00 +0000')]
+        rules = [{'name': 'rule'}, {'name': 'urgent', 'priority': 1}]
+        actions_list = [action('old'), action('new'), action('unread'), action('urgent', 'urgent')]
+
+        ordered, ranks = order_actions(actions_list, emails, rules)
+
+        assert [item.email_id for item in ordered] == ['urgent', 'unread', 'new', 'old']
+        assert ranks[0][:2] == (1, 0) and ranks[1][:2] == (0, 1)
+
+    def test_equal_ranks_keep_their_order(self):
+        emails = [email('a', '')]
+        ordered, _ = order_actions([action('a', 'first'), action('a', 'second')], emails, [])
+        assert [item.rule_name for item in ordered] == ['first', 'second']
+
+    def test_load_emails_stops_at_deadline(self, temp_db):
+        service = make_service(10)
+        ids = [service.mailbox.message_id(i) for i in range(10)]
+
+        emails = load_emails(service, ids, temp_db, deadline=ExpiresAfter(4))
+
+        assert len(emails) == 4
+        assert {item.id for item in emails} == set(ids[:4])
+
+    def test_load_emails_fetches_unread_first_with_deadline(self, temp_db):
+        service = make_service(12)
+        ids = [service.mailbox.message_id(i) for i in range(12)]
+        unread = [email_id for i, email_id in enumerate(ids) if 'UNREAD' in service.mailbox.labels(i)]
+
+        emails = load_emails(service, ids, temp_db, deadline=ExpiresAfter(len(unread), limited=True))
+
+        assert sorted(item.id for item in emails) == sorted(unread)
+
+    def test_execute_actions_stops_at_deadline(self, temp_db):
+        service = make_service(10)
+        ids = [service.mailbox.message_id(i) for i in range(10)]
+        email_actions = EmailActions(service, db=temp_db)
+
+        succeeded, failed = email_actions.execute_actions([action(email_id) for email_id in ids],
+                                                          deadline=ExpiresAfter(3))
+
+        assert (succeeded, failed) == (3, 0)
+
+    def test_batched_actions_stop_at_deadline(self, temp_db):
+        service = make_service(10)
+        ids = [service.mailbox.message_id(i) for i in range(10)]
+        email_actions = EmailActions(service, db=temp_db)
+        # Two label changes, so two batchModify calls
+        actions_list = [action(email_id) for email_id in ids[:5]] + \
+            [{'rule_name': 'read', 'action': {'type': 'mark_as_read'}, 'email_id': email_id} for email_id in ids[5:]]
+
+        succeeded, failed = email_actions.execute_actions(actions_list, batch=True, deadline=ExpiresAfter(1))
+
+        assert (succeeded, failed) == (5, 0)
+        assert service.calls['users.messages.batchModify'] == 1
+
+    def test_ranked_queue(self):
+        ranked = RankedQueue(10)
+        for rank, name in [((0, 0, 1.0), 'old'), ((0, 1, 0.0), 'unread'), ((0, 0, 2.0), 'new'),
+                           ((1, 0, 0.0), 'urgent'), ((0, 0, 2.0), 'new too')]:
+            ranked.put((rank, name))
+
+        assert [ranked.get() for _ in range(5)] == ['urgent', 'unread', 'new', 'new too', 'old']
+
+    def test_thread_actions_run_highest_ranked_first(self, temp_db, tmp_path):
+        service = make_service(12)
+        rules_file = tmp_path / 'rules.json'
+        rules_file.write_text(json.dumps({'rules': [
+            {'name': 'all', 'conditions': [{'field': 'subject', 'operator': 'contains', 'value': ''}],
+             'actions': [{'type': 'mark_as_read'}]},
+            {'name': 'urgent', 'priority': 1, 'conditions': [{'field': 'subject', 'operator': 'contains',
+                                                              'value': 'invoice'}],
+             'actions': [{'type': 'mark_as_read'}]}]}))
+        threads = ThreadProcessor(service, temp_db, RuleEngine(str(rules_file)), EmailActions(service, db=temp_db))
+        executed = []
+        threads.execute_thread_action = lambda item, messages: executed.append(item.rule_name) or True
+
+        result = threads.process_page(limit=12, deadline=ExpiresAfter(100))
+
+        assert 'urgent' in executed
+        assert executed == sorted(executed, key=lambda name: name != 'urgent')
+        assert result['succeeded'] == len(executed) == result['actions']
+
+    def test_thread_mode_stops_at_deadline(self, temp_db, temp_rules_file):
+        service = make_service(12)
+        threads = ThreadProcessor(service, temp_db, RuleEngine(temp_rules_file), EmailActions(service, db=temp_db))
+
+        result = threads.process_page(limit=12, deadline=ExpiresAfter(3))
+
+        assert result['threads'] == 3 and result['succeeded'] + result['failed'] == 0
+
+    def test_queue_leases_highest_rank_first(self, temp_db):
+        queue = ActionQueue(temp_db)
+        queue.enqueue([action('low'), action('high'), action('unread')],
+                      ranks=[(0, 0, 200.0), (2, 0, 100.0), (0, 1, 100.0)])
+
+        leased = queue.lease(3, 'worker')
+
+        assert [item.email_id for _, item in leased] == ['high', 'unread', 'low']
+
+    def test_queue_drain_leaves_rest_queued_at_deadline(self, temp_db):
+        service = make_service(10)
+        ids = [service.mailbox.message_id(i) for i in range(10)]
+        queue = ActionQueue(temp_db)
+        queue.enqueue([action(email_id) for email_id in ids])
+        email_actions = EmailActions(service, db=temp_db)
+
+        # Checked before the lease and before each action: two actions start
+        succeeded, _ = queue.drain(email_actions, lease_size=4, deadline=ExpiresAfter(3))
+
+        assert succeeded == 2
+        assert queue.counts() == {'pending': 8, 'in_flight': 0, 'done': 2, 'failed': 0}
+        # The rest of the lease was handed back without using up an attempt
+        with temp_db.connect() as conn:
+            assert conn.execute("SELECT MAX(attempts) FROM action_queue WHERE state = 'pending'").fetchone()[0] == 0
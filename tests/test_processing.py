@@ -20,9 +20,7 @@ class TestGmailProcessor:
 
         rule_engine = RuleEngine(rules_path)
         mock_service = Mock()
-        actions = EmailActions(mock_service)
-
-        actions.db = temp_db
+        actions = EmailActions(mock_service, db=temp_db)
 
         yield {
             'db': temp_db,
@@ -89,3 +87,7 @@ class TestGmailProcessor:
         assert result is True
 
         is_email_read.assert_not_called()
+
+    def test_no_actions_counts_nothing(self, mock_email_actions):
+        assert mock_email_actions.execute_actions([]) == (0, 0)
+        assert mock_email_actions.execute_actions([], batch=True) == (0, 0)
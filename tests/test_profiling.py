@@ -0,0 +1,75 @@
+import argparse
+from unittest.mock import patch
+
+from processor.profiling import RuleProfiler, format_report, profile_rules
+from processor.rules import RuleEngine
+
+
+class TestRuleProfiling:
+
+    def _store(self, db, sample_email_data, count):
+        for i in range(count):
+            db.insert_email({
+                **sample_email_data,
+                'id': f'email_{i}',
+                'from': 'test@example.com' if i % 2 == 0 else 'other@example.com',
+                'subject': 'Important' if i % 4 == 0 else 'Hello'
+            })
+
+    def test_profile_counts(self, temp_db, temp_rules_file, sample_email_data):
+        self._store(temp_db, sample_email_data, 8)
+        rule_engine = RuleEngine(temp_rules_file, label_registry=temp_db.labels)
+
+        report, count, _ = profile_rules(rule_engine, temp_db)
+
+        assert count == 8
+        rules = {rule['rule']: rule for rule in report}
+        assert rules['Test Rule 1']['evaluations'] == 8
+        assert rules['Test Rule 1']['matches'] == 4
+        assert rules['Test Rule 1']['actions'] == 4
+        assert rules['Test Rule 1']['match_rate'] == 0.5
+        assert rules['Test Rule 2']['matches'] == 2
+
+        from_condition = rules['Test Rule 1']['conditions'][0]
+        assert from_condition['condition'] == "from contains 'test@example.com'"
+        assert from_condition['evaluations'] == 8
+        assert from_condition['avg_scanned'] == len('test@example.com') / 2 + len('other@example.com') / 2
+
+        important, urgent = rules['Test Rule 2']['conditions']
+        assert important['matches'] == 2
+        assert urgent['matches'] == 0
+
+        assert report == sorted(report, key=lambda rule: rule['time'], reverse=True)
+
+    def test_profile_limit(self, temp_db, temp_rules_file, sample_email_data):
+        self._store(temp_db, sample_email_data, 5)
+        rule_engine = RuleEngine(temp_rules_file, profiler=RuleProfiler())
+
+        _, count, _ = profile_rules(rule_engine, temp_db, limit=3)
+
+        assert count == 3
+
+    def test_no_profiler_by_default(self, rule_engine_with_temp_file, sample_email_data):
+        assert rule_engine_with_temp_file.profiler is None
+        assert len(rule_engine_with_temp_file.get_actions_for_email(sample_email_data)) == 1
+
+    def test_format_report(self, temp_db, temp_rules_file, sample_email_data):
+        self._store(temp_db, sample_email_data, 2)
+        report, _, _ = profile_rules(RuleEngine(temp_rules_file), temp_db)
+
+        text = format_report(report)
+
+        assert 'Test Rule 1' in text
+        assert "subject contains 'Urgent'" in text
+
+    def test_profile_rules_cli_skips_gmail(self, temp_db, temp_rules_file, sample_email_data, capsys):
+        import main
+
+        self._store(temp_db, sample_email_data, 3)
+        args = argparse.Namespace(rules=temp_rules_file)
+        with patch('main.authenticate_gmail') as authenticate:
+            report = main.run_profile(args, db_path=temp_db.db_path)
+
+        authenticate.assert_not_called()
+        assert {rule['rule'] for rule in report} == {'Test Rule 1', 'Test Rule 2'}
+        assert '3 stored emails' in capsys.readouterr().out
@@ -0,0 +1,78 @@
+import threading
+from unittest.mock import patch
+
+import pytest
+
+from processor.push import Debouncer, PushReceiver, decode_push_message, encode_push_message, publish_notification
+
+
+class TestPushNotifications:
+
+    def test_decode_push_message(self):
+        body = encode_push_message('user@gmail.com', 12345)
+
+        assert decode_push_message(body) == {'emailAddress': 'user@gmail.com', 'historyId': 12345}
+
+    def test_decode_invalid_push_message(self):
+        with pytest.raises(ValueError):
+            decode_push_message(b'{"message": {}}')
+
+    def test_debouncer_collapses_burst(self):
+        fired = []
+        done = threading.Event()
+        debouncer = Debouncer(lambda history_id: (fired.append(history_id), done.set()), delay=0.05)
+
+        for history_id in (101, 103, 102):
+            debouncer.submit(history_id)
+
+        assert done.wait(timeout=5)
+        assert fired == [103]
+
+    def test_receiver_rejects_bad_token(self):
+        receiver = PushReceiver(lambda notification: None, port=0, token='secret')
+        receiver.start()
+        try:
+            url = receiver.url.replace('secret', 'wrong')
+            with pytest.raises(Exception) as error:
+                publish_notification(url, 'user@gmail.com', 1)
+            assert '403' in str(error.value)
+        finally:
+            receiver.stop()
+
+    def test_end_to_end_notification_processing(self, temp_db, temp_rules_file, mock_gmail_service,
+                                                sample_gmail_message):
+        from main import GmailProcessor
+
+        mock_gmail_service.users().history().list().execute.return_value = {
+            'history': [{'messagesAdded': [{'message': {'id': 'test_email_123'}}]}],
+            'historyId': '105'
+        }
+        mock_gmail_service.users().messages().get().execute.return_value = sample_gmail_message
+
+        with patch('main.authenticate_gmail', return_value=mock_gmail_service), \
+                patch('main.EmailDatabase', return_value=temp_db):
+            processor = GmailProcessor(temp_rules_file)
+        temp_db.set_state('history_id', 100)
+
+        processed = threading.Event()
+
+        def process(history_id):
+            processor.process_history(history_id)
+            processed.set()
+
+        debouncer = Debouncer(process, delay=0.05)
+        receiver = PushReceiver(lambda notification: debouncer.submit(notification['historyId']), port=0)
+        receiver.start()
+        try:
+            for history_id in (101, 102, 103):
+                assert publish_notification(receiver.url, 'user@gmail.com', history_id) == 204
+            assert processed.wait(timeout=5)
+        finally:
+            receiver.stop()
+
+        mock_gmail_service.users().messages().modify.assert_called_with(
+            userId='me', id='test_email_123', body={'removeLabelIds': ['UNREAD']}
+        )
+        assert temp_db.email_exists('test_email_123')
+        assert temp_db.action_exists('test_email_123', 'Test Rule 1', 'mark_as_read')
+        assert temp_db.get_state('history_id') == '105'
@@ -0,0 +1,109 @@
+import json
+from unittest.mock import patch
+
+import pytest
+
+from benchmarks.fake_gmail import make_service
+from processor.query import MAX_QUERY_LENGTH, condition_query, rule_query, rules_query
+
+
+def rule(conditions, predicate='all', **extra):
+    return {'name': 'rule', 'predicate': predicate, 'conditions': conditions,
+            'actions': [{'type': 'mark_as_read'}], **extra}
+
+
+class TestQueryPushdown:
+
+    @pytest.mark.parametrize('condition, expected', [
+        ({'field': 'from', 'operator': 'contains', 'value': 'google', 'pushdown': True}, 'from:google'),
+        ({'field': 'from', 'operator': 'contains', 'value': 'google'}, None),
+        ({'field': 'subject', 'operator': 'contains', 'value': 'Job Interview', 'pushdown': True}, None),
+        ({'field': 'from', 'operator': 'contains', 'value': 'a@b.com', 'pushdown': True}, None),
+        ({'field': 'subject', 'operator': 'equals', 'value': 'Job Interview'}, 'subject:"Job Interview"'),
+        ({'field': 'to', 'operator': 'equals', 'value': 'me@gmail.com'}, 'to:me@gmail.com'),
+        ({'field': 'body', 'operator': 'contains', 'value': 'invoice', 'pushdown': True}, 'invoice'),
+        ({'field': 'date_received', 'operator': 'older_than', 'value': 7}, 'older_than:6d'),
+        ({'field': 'date_received', 'operator': 'newer_than', 'value': 2, 'unit': 'months'}, 'newer_than:61d'),
+        ({'field': 'labels', 'operator': 'has', 'value': ['INBOX', 'UNREAD']}, 'in:inbox is:unread'),
+        ({'field': 'from', 'operator': 'not_contains', 'value': 'google'}, None),
+        ({'field': 'subject', 'operator': 'equals', 'value': 'say "hi"'}, None),
+        ({'field': 'labels', 'operator': 'has', 'value': 'Label_1'}, None),
+        ({'field': 'date_received', 'operator': 'older_than', 'value': 'soon'}, None),
+    ])
+    def test_condition_query(self, condition, expected):
+        assert condition_query(condition) == expected
+
+    def test_rule_query(self):
+        google = {'field': 'from', 'operator': 'contains', 'value': 'google', 'pushdown': True}
+        negated = {'field': 'subject', 'operator': 'not_contains', 'value': 'alert'}
+        interview = {'field': 'subject', 'operator': 'contains', 'value': 'Interview', 'pushdown': True}
+
+        # Unpushable conditions only broaden an 'all' rule
+        assert rule_query(rule([google, negated])) == 'from:google'
+        assert rule_query(rule([google, interview])) == 'from:google subject:Interview'
+        assert rule_query(rule([google, interview], 'any')) == '(from:google) OR (subject:Interview)'
+        # ...but make an 'any' rule match anything
+        assert rule_query(rule([google, negated], 'any')) is None
+        assert rule_query(rule([negated])) is None
+        assert rule_query(rule([google], pushdown=False)) is None
+
+    def test_rules_query(self, test_rules):
+        # Substring conditions don't opt in by default
+        assert rules_query(test_rules['rules']) == 'in:all'
+
+        for rule_data in test_rules['rules']:
+            for condition in rule_data['conditions']:
+                condition['pushdown'] = True
+        test_rules['rules'][0]['conditions'][0] = {'field': 'from', 'operator': 'equals', 'value': 'test@example.com'}
+        query = rules_query(test_rules['rules'])
+
+        assert query == ('in:all ((from:test@example.com) OR '
+                         '((subject:Important) OR (subject:Urgent)))')
+
+    def test_rules_query_falls_back(self):
+        google = {'field': 'from', 'operator': 'contains', 'value': 'google', 'pushdown': True}
+        negated = {'field': 'subject', 'operator': 'not_contains', 'value': 'alert'}
+
+        assert rules_query([rule([google]), rule([negated])]) == 'in:all'
+        assert rules_query([]) == 'in:all'
+        long_rules = [rule([{'field': 'from', 'operator': 'contains', 'value': f'sender{i}', 'pushdown': True}])
+                      for i in range(MAX_QUERY_LENGTH // 10)]
+        assert rules_query(long_rules) == 'in:all'
+
+    def test_processor_lists_with_pushed_down_query(self, temp_db, tmp_path, mock_gmail_service):
+        from main import GmailProcessor
+
+        rules_file = tmp_path / 'rules.json'
+        rules_file.write_text(json.dumps({'rules': [rule([{'field': 'from', 'operator': 'equals',
+                                                          'value': 'test@example.com'}])]}))
+        messages = mock_gmail_service.users().messages()
+        messages.list().execute.return_value = {'messages': []}
+        with patch('main.authenticate_gmail', return_value=mock_gmail_service), \
+                patch('main.EmailDatabase', return_value=temp_db):
+            processor = GmailProcessor(str(rules_file), query_pushdown=True)
+
+        processor.process_batch(limit=5)
+
+        query = messages.list.call_args.kwargs['q']
+        assert query.startswith('in:all (') and 'from:test@example.com' in query
+
+    def test_substring_match_is_still_listed(self, temp_db, tmp_path):
+        from main import GmailProcessor
+
+        # The fake mailbox's subjects look like 'Invoice #34936'; Gmail's search for the
+        # partial word would list nothing, so only the full listing finds the email
+        service = make_service(1)
+        list_messages = service._list
+        service._list = lambda userId, q='in:all', **kwargs: \
+            list_messages(userId, q, **kwargs) if q == 'in:all' else {'messages': []}
+        rules_file = tmp_path / 'rules.json'
+        rules_file.write_text(json.dumps({'rules': [
+            rule([{'field': 'subject', 'operator': 'contains', 'value': 'nvoice #349', 'pushdown': True}])]}))
+        with patch('main.authenticate_gmail', return_value=service), \
+                patch('main.EmailDatabase', return_value=temp_db):
+            processor = GmailProcessor(str(rules_file), query_pushdown=True)
+
+        assert processor.search_query() == 'in:all'
+        result = processor.process_batch(limit=5)
+
+        assert result['emails'] == 1 and result['actions'] == 1
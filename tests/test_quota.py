@@ -0,0 +1,153 @@
+import pytest
+
+from benchmarks.fake_gmail import make_service
+from processor.action_queue import ActionQueue
+from processor.actions import EmailActions
+from processor.metrics import Metrics
+from processor.parse import load_emails, refresh_labels
+from processor.quota import QuotaAccountant, QuotaExceeded, quota_cost
+from processor.service import ServiceProxy
+
+
+class FakeClock:
+    def __init__(self, now=1_700_000_000.0):
+        self.now = now
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+def accountant(**options):
+    clock = FakeClock()
+    return QuotaAccountant(registry=Metrics(), clock=clock, sleep=clock.sleep, **options), clock
+
+
+class TestQuotaAccountant:
+
+    def test_waits_for_the_rolling_second(self):
+        quota, clock = accountant(per_second=10, reserve=0)
+
+        quota.acquire(5, 'users.messages.get')
+        quota.acquire(5, 'users.messages.get')
+        assert clock.slept == []
+        quota.acquire(5, 'users.messages.get')
+
+        assert clock.slept == [1.0]
+        assert quota.spent == 15
+
+    def test_reserve_is_kept_for_actions(self):
+        quota, clock = accountant(per_second=10, reserve=0.5)
+
+        quota.acquire(5, 'users.messages.get')
+        # Fetches may only use half of the second...
+        quota.acquire(5, 'users.messages.modify')
+        assert clock.slept == []
+        quota.acquire(5, 'users.messages.get')
+        assert clock.slept == [1.0]
+
+    def test_daily_budget(self):
+        quota, _ = accountant(per_second=None, per_day=100, reserve=0.2)
+
+        for _ in range(16):
+            quota.acquire(5, 'users.messages.get')
+        # 80 units spent: only the actions' reserve is left
+        with pytest.raises(QuotaExceeded):
+            quota.acquire(5, 'users.messages.get')
+        for _ in range(4):
+            quota.acquire(5, 'users.messages.modify')
+        with pytest.raises(QuotaExceeded):
+            quota.acquire(5, 'users.messages.modify')
+
+        assert quota.summary() == {'units': 100, 'today': 100, 'per_day': 100, 'waited_seconds': 0, 'refused': 2}
+
+    def test_new_day_resets_the_budget(self):
+        quota, clock = accountant(per_second=None, per_day=10, reserve=0)
+        quota.acquire(10, 'users.messages.get')
+
+        clock.now += 24 * 3600
+        quota.acquire(10, 'users.messages.get')
+
+        assert quota.spent_today == 10 and quota.spent == 20
+
+    def test_daily_spend_is_persisted(self, temp_db):
+        quota, clock = accountant(per_day=100)
+        quota.acquire(40, 'users.messages.get')
+        quota.save(temp_db)
+
+        later = QuotaAccountant(per_day=100, clock=clock)
+        later.load(temp_db)
+
+        assert later.spent_today == 40 and later.spent == 0
+
+    def test_saves_add_up_across_processes(self, temp_db):
+        first, clock = accountant(per_day=100)
+        second = QuotaAccountant(per_day=100, registry=Metrics(), clock=clock, sleep=clock.sleep)
+        first.load(temp_db)
+        second.load(temp_db)
+        first.acquire(30, 'users.messages.get')
+        second.acquire(20, 'users.messages.get')
+        first.save(temp_db)
+        second.save(temp_db)
+        first.acquire(5, 'users.messages.get')
+        first.save(temp_db)
+
+        later = QuotaAccountant(per_day=100, clock=clock)
+        later.load(temp_db)
+
+        assert later.spent_today == 55
+
+    def test_new_day_restarts_the_stored_spend(self, temp_db):
+        quota, clock = accountant(per_day=100)
+        quota.acquire(40, 'users.messages.get')
+        quota.save(temp_db)
+        clock.now += 24 * 3600
+        quota.acquire(10, 'users.messages.get')
+        quota.save(temp_db)
+
+        later = QuotaAccountant(per_day=100, clock=clock)
+        later.load(temp_db)
+
+        assert later.spent_today == 10
+
+    def test_hook_charges_method_cost(self):
+        quota, _ = accountant()
+        service = ServiceProxy(make_service(10), hooks=[quota])
+
+        service.users().messages().list(userId='me', maxResults=10).execute()
+        service.users().labels().list(userId='me').execute()
+
+        assert quota.spent == quota_cost('users.messages.list') + quota_cost('users.labels.list')
+        assert quota.registry.counter('gmail_quota_units_total', method='users.labels.list') == 1
+
+    def test_batched_refresh_is_charged_per_message(self, temp_db):
+        quota, _ = accountant()
+        fake = make_service(10)
+        service = ServiceProxy(fake, hooks=[quota])
+        ids = [fake.mailbox.message_id(i) for i in range(10)]
+        load_emails(fake, ids, temp_db)
+
+        refresh_labels(service, temp_db, ids)
+
+        assert quota.spent == 10 * quota_cost('users.messages.get')
+
+    def test_queue_drain_stops_when_quota_runs_out(self, temp_db):
+        quota, _ = accountant(per_second=None, per_day=7 * quota_cost('users.messages.modify'), reserve=0)
+        fake = make_service(20)
+        service = ServiceProxy(fake, hooks=[quota])
+        ids = [fake.mailbox.message_id(i) for i in range(10)]
+        queue = ActionQueue(temp_db)
+        queue.enqueue([{'rule_name': 'rule', 'action': {'type': 'move_message', 'folder': 'INBOX'}, 'email_id': email_id}
+                       for email_id in ids])
+        email_actions = EmailActions(service, db=temp_db)
+        # State checks are free here, so only the modify calls use the budget
+        email_actions.get_email_labels = lambda email_id: []
+
+        succeeded, failed = queue.drain(email_actions, lease_size=4)
+
+        assert (succeeded, failed) == (7, 0)
+        assert queue.counts() == {'pending': 3, 'in_flight': 0, 'done': 7, 'failed': 0}
@@ -0,0 +1,77 @@
+import json
+from unittest.mock import patch
+
+from benchmarks.fake_gmail import make_service
+from processor.actions import EmailActions
+from processor.parse import load_emails, refresh_labels
+
+
+class TestLabelRefresh:
+
+    def test_refresh_in_batches(self, temp_db):
+        service = make_service(250)
+        ids = [service.mailbox.message_id(i) for i in range(250)]
+        load_emails(service, ids, temp_db)
+        for email_id in ids[:3]:
+            service.users().messages().modify(userId='me', id=email_id, body={'addLabelIds': ['STARRED']}).execute()
+        service.calls.clear()
+
+        states = refresh_labels(service, temp_db, ids + ['missing'])
+
+        assert service.calls == {'batch': 3, 'users.messages.get': 251}
+        assert len(states) == 250 and 'missing' not in states
+        assert all('STARRED' in labels for labels in (states[email_id] for email_id in ids[:3]))
+        stored = {email.id: email for email in temp_db.get_emails_by_ids(ids[:3])}
+        assert all('STARRED' in stored[email_id].labels for email_id in ids[:3])
+        refreshed = temp_db.get_refreshed_at(ids)
+        assert None not in refreshed.values()
+
+    def test_primed_labels_replace_live_check_once(self, temp_db):
+        service = make_service(5)
+        email_id = service.mailbox.message_id(0)
+        emails = load_emails(service, [email_id], temp_db)
+        email_actions = EmailActions(service, db=temp_db)
+        email_actions.prime_labels(emails)
+        service.calls.clear()
+
+        assert email_actions.get_email_labels(email_id) == list(emails[0].labels)
+        assert service.calls == {}
+        # The primed state is used once; the next check asks Gmail
+        email_actions.get_email_labels(email_id)
+        assert service.calls == {'users.messages.get': 1}
+
+    def test_fresh_excludes_failed_refreshes(self, temp_db):
+        service = make_service(5)
+        ids = [service.mailbox.message_id(i) for i in range(5)]
+        load_emails(service, ids[:3], temp_db)
+        # Gmail no longer answers for this one, so its stored labels may be stale
+        service.users().messages().trash(userId='me', id=ids[0]).execute()
+
+        fresh = set()
+        emails = load_emails(service, ids, temp_db, refresh=True, fresh=fresh)
+
+        assert len(emails) == 5
+        assert fresh == set(ids[1:])
+
+    def test_process_batch_refreshes_stored_emails(self, temp_db, tmp_path):
+        from main import GmailProcessor
+
+        service = make_service(20)
+        rules_file = tmp_path / 'rules.json'
+        rules_file.write_text(json.dumps({'rules': [{
+            'name': 'Read all', 'predicate': 'all',
+            'conditions': [{'field': 'to', 'operator': 'contains', 'value': 'me@gmail.com'}],
+            'actions': [{'type': 'mark_as_read'}]
+        }]}))
+        with patch('main.authenticate_gmail', return_value=service), \
+                patch('main.EmailDatabase', return_value=temp_db):
+            processor = GmailProcessor(str(rules_file), refresh_labels=True)
+        load_emails(service, [service.mailbox.message_id(i) for i in range(20)], temp_db)
+        service.calls.clear()
+
+        result = processor.process_batch(limit=20)
+
+        assert result['succeeded'] == 20
+        # One batched refresh instead of a state check per action
+        assert service.calls['batch'] == 1
+        assert service.calls['users.messages.get'] == 20
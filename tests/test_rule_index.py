@@ -0,0 +1,133 @@
+import json
+
+import pytest
+
+from benchmarks.fake_gmail import make_service
+from processor.models import EmailRecord
+from processor.parse import load_emails
+from processor.rule_index import RuleIndex, condition_keys, rule_keys
+from processor.rules import RuleEngine
+from processor.threads import ThreadProcessor
+
+MARK_READ = [{'type': 'mark_as_read'}]
+
+
+def rule(name, conditions, predicate='all', **options):
+    return dict({'name': name, 'predicate': predicate, 'conditions': conditions, 'actions': MARK_READ}, **options)
+
+
+def from_equals(value):
+    return {'field': 'from', 'operator': 'equals', 'value': value}
+
+
+def subject_contains(value):
+    return {'field': 'subject', 'operator': 'contains', 'value': value}
+
+
+def email(from_email='Alice <alice@mail.example.com>', to_email='me@gmail.com', subject='Hello'):
+    return EmailRecord(id='1', from_email=from_email, to_email=to_email, subject=subject)
+
+
+@pytest.fixture
+def engine(tmp_path):
+    def make(rules):
+        rules_file = tmp_path / 'rules.json'
+        rules_file.write_text(json.dumps({'rules': rules}))
+        return RuleEngine(str(rules_file))
+    return make
+
+
+class TestRuleIndex:
+
+    def test_condition_keys(self):
+        assert condition_keys(from_equals('A@x.com')) == {('from', 'a@x.com')}
+        assert condition_keys({'field': 'to', 'operator': 'in_list', 'value': [' B@y.org']}) == {('to', 'b@y.org')}
+        assert condition_keys({'field': 'from', 'operator': 'domain_in', 'value': ['@x.com']}) == {('from@', 'x.com')}
+        assert condition_keys({'field': 'from', 'operator': 'contains', 'value': 'x'}) is None
+        assert condition_keys(subject_contains('x')) is None
+
+    def test_rule_keys(self):
+        domains = {'field': 'from', 'operator': 'domain_in', 'value': ['x.com', 'y.com']}
+        # The most selective indexable condition of an 'all' rule
+        assert rule_keys(rule('a', [subject_contains('x'), domains, from_equals('a@z.com')])) == {('from', 'a@z.com')}
+        assert rule_keys(rule('b', [subject_contains('x')])) is None
+        # 'any' rules only when every condition is indexable
+        assert rule_keys(rule('c', [domains, from_equals('a@z.com')], 'any')) == \
+            {('from@', 'x.com'), ('from@', 'y.com'), ('from', 'a@z.com')}
+        assert rule_keys(rule('d', [domains, subject_contains('x')], 'any')) is None
+
+    def test_candidates_keep_rule_order(self):
+        rules = [rule('subject', [subject_contains('hello')]),
+                 rule('domain', [{'field': 'from', 'operator': 'domain_in', 'value': ['example.com']}]),
+                 rule('other sender', [from_equals('bob@other.org')]),
+                 rule('exact', [from_equals('Alice <alice@mail.example.com>')])]
+        index = RuleIndex(rules)
+
+        assert index.indexed == 3
+        assert [r['name'] for r in index.candidates(email())] == ['subject', 'domain', 'exact']
+        assert [r['name'] for r in index.candidates(email('bob@other.org'))] == ['subject', 'other sender']
+
+    def test_index_only_evaluates_candidates(self, engine, monkeypatch):
+        rules = [rule(f'sender {i}', [from_equals(f'user{i}@example.com')]) for i in range(200)]
+        rule_engine = engine(rules + [rule('subject', [subject_contains('hello')])])
+        evaluated = []
+        original = rule_engine.evaluate_rule
+        monkeypatch.setattr(rule_engine, 'evaluate_rule', lambda e, r: evaluated.append(r['name']) or original(e, r))
+
+        actions = rule_engine.get_actions_for_email(email('USER7@example.com', subject='Invoice'))
+
+        assert evaluated == ['sender 7', 'subject']
+        assert [action.rule_name for action in actions] == ['sender 7']
+
+    def test_index_agrees_with_evaluating_every_rule(self, engine, temp_db):
+        service = make_service(200)
+        emails = load_emails(service, [service.mailbox.message_id(i) for i in range(200)], temp_db)
+        senders = sorted({e.from_email for e in emails})
+        domains = sorted({e.from_email.rpartition('@')[2].rstrip('>') for e in emails})
+        rules = [rule('first senders', [{'field': 'from', 'operator': 'in_list', 'value': senders[:3]}]),
+                 rule('one sender', [from_equals(senders[-1]), subject_contains('e')]),
+                 rule('domains', [{'field': 'from', 'operator': 'domain_in', 'value': domains[:2]}]),
+                 rule('subjects', [subject_contains('a')])]
+        rule_engine = engine(rules)
+
+        for email_data in emails:
+            expected = [r['name'] for r in rules if rule_engine.evaluate_rule(email_data, r)]
+            assert [a.rule_name for a in rule_engine.get_actions_for_email(email_data)] == expected
+
+
+class TestStopProcessing:
+
+    def test_stop_processing(self, engine):
+        rule_engine = engine([rule('first', [subject_contains('hello')]),
+                              rule('stop', [subject_contains('hel')], stop_processing=True),
+                              rule('after', [subject_contains('h')])])
+
+        assert [a.rule_name for a in rule_engine.get_actions_for_email(email())] == ['first', 'stop']
+        # A stop rule that doesn't match lets the later rules run
+        assert [a.rule_name for a in rule_engine.get_actions_for_email(email(subject='hat'))] == ['after']
+
+    def test_stop_rule_without_actions(self, engine):
+        rule_engine = engine([dict(rule('ignore', [from_equals('noreply@example.com')], stop_processing=True),
+                                   actions=[]),
+                              rule('all', [subject_contains('')])])
+
+        assert rule_engine.get_actions_for_email(email('noreply@example.com')) == []
+        assert len(rule_engine.get_actions_for_email(email())) == 1
+
+    def test_backfill_respects_earlier_stop_rules(self, engine, temp_db, sample_email_data):
+        temp_db.insert_email(sample_email_data)
+        rule_engine = engine([rule('stop', [{'field': 'from', 'operator': 'contains', 'value': 'test'}],
+                                   stop_processing=True),
+                              rule('new', [subject_contains('test')])])
+
+        assert rule_engine.backfill(temp_db, ['new']) == []
+        assert [a.rule_name for a in rule_engine.backfill(temp_db, ['stop', 'new'])] == ['stop']
+
+    def test_thread_mode_stops(self, engine, temp_db):
+        service = make_service(10)
+        messages = load_emails(service, [service.mailbox.message_id(0)], temp_db)
+        rule_engine = engine([rule('stop', [subject_contains('')], stop_processing=True),
+                              rule('after', [subject_contains('')])])
+        threads = ThreadProcessor(service, temp_db, rule_engine, None, mode='any')
+
+        assert [r['name'] for r in threads.matching_rules(messages)] == ['stop']
@@ -1,3 +1,6 @@
+import json
+import os
+
 from processor.rules import RuleEngine
 
 
@@ -258,3 +261,53 @@ class TestRuleEngine:
 
         result = rule_engine.evaluate_rule(sample_email_data, rule)
         assert result is False
+
+
+class TestRuleReload:
+
+    def _write_rules(self, path, rules):
+        with open(path, 'w') as f:
+            json.dump({'rules': rules}, f)
+        # Make sure the mtime moves even on filesystems with coarse timestamps
+        stat = os.stat(path)
+        os.utime(path, (stat.st_atime, stat.st_mtime + 1))
+
+    def test_reload_if_unchanged(self, rule_engine_with_temp_file):
+        assert rule_engine_with_temp_file.reload_if_changed() is None
+
+    def test_reload_detects_changes(self, rule_engine_with_temp_file, temp_rules_file, test_rules):
+        rule_engine = rule_engine_with_temp_file
+        rules = test_rules['rules']
+        rules[1]['conditions'][0]['value'] = 'Critical'
+        rules[0] = dict(rules[0], name='Test Rule 3')
+        self._write_rules(temp_rules_file, rules)
+
+        changes = rule_engine.reload_if_changed()
+
+        assert changes == {'added': ['Test Rule 3'], 'changed': ['Test Rule 2'], 'removed': ['Test Rule 1']}
+        assert [rule['name'] for rule in rule_engine.rules] == ['Test Rule 3', 'Test Rule 2']
+
+    def test_reload_keeps_rules_on_invalid_file(self, rule_engine_with_temp_file, temp_rules_file):
+        with open(temp_rules_file, 'w') as f:
+            f.write('{not json')
+
+        assert rule_engine_with_temp_file.reload() is None
+        assert len(rule_engine_with_temp_file.rules) == 2
+
+    def test_backfill_only_evaluates_given_rules(self, rule_engine_with_temp_file, temp_db, sample_email_data):
+        rule_engine = rule_engine_with_temp_file
+        email_data = dict(sample_email_data, subject='Important Test')
+        temp_db.insert_email(email_data)
+
+        actions = rule_engine.backfill(temp_db, ['Test Rule 2'])
+
+        assert [action['rule_name'] for action in actions] == ['Test Rule 2']
+        assert actions[0]['email_id'] == 'test_email_123'
+
+    def test_pending_backfill(self, rule_engine_with_temp_file, temp_db):
+        rule_engine = rule_engine_with_temp_file
+
+        assert rule_engine.pending_backfill(temp_db) == ['Test Rule 1', 'Test Rule 2']
+
+        temp_db.set_rule_versions(rule_engine.rule_versions)
+        assert rule_engine.pending_backfill(temp_db) == []
@@ -0,0 +1,64 @@
+import json
+import os
+import subprocess
+import sys
+from unittest.mock import patch
+
+from processor import authenticate
+
+HEAVY_MODULES = ['googleapiclient.discovery', 'google.auth.transport.requests', 'google_auth_oauthlib.flow']
+
+# Only needed by some modes; main imports them where they are used
+MODE_MODULES = ['processor.accounts', 'processor.action_queue', 'processor.columnar', 'processor.daemon',
+                'processor.pipeline', 'processor.planner', 'processor.profiling', 'processor.push', 'processor.threads']
+
+
+class TestStartup:
+
+    def test_import_does_not_load_client_stack(self):
+        """Importing the app must not pull in the Google client stack"""
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        code = 'import json, sys, main; print(json.dumps([m for m in %r if m in sys.modules]))' % HEAVY_MODULES
+
+        output = subprocess.run([sys.executable, '-c', code], cwd=root, capture_output=True, text=True, check=True)
+
+        assert json.loads(output.stdout.strip().splitlines()[-1]) == []
+
+    def test_import_does_not_load_mode_modules(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        code = 'import json, sys, main; print(json.dumps([m for m in %r if m in sys.modules]))' % MODE_MODULES
+
+        output = subprocess.run([sys.executable, '-c', code], cwd=root, capture_output=True, text=True, check=True)
+
+        assert json.loads(output.stdout.strip().splitlines()[-1]) == []
+
+    def test_discovery_document_is_cached(self, tmp_path):
+        cache_path = str(tmp_path / 'discovery.json')
+        document = {'name': 'gmail', 'version': 'v1', 'revision': '1'}
+
+        with patch.object(authenticate, '_retrieve_discovery_document', return_value=document) as retrieve:
+            assert authenticate.load_discovery_document(cache_path) == document
+            assert authenticate.load_discovery_document(cache_path) == document
+
+        retrieve.assert_called_once()
+
+    def test_discovery_cache_refreshed_for_other_client_version(self, tmp_path):
+        cache_path = str(tmp_path / 'discovery.json')
+        with open(cache_path, 'w') as f:
+            json.dump({'client_version': '0.0.1', 'api_version': 'v1', 'cached_at': 0,
+                       'document': {'revision': 'old'}}, f)
+
+        with patch.object(authenticate, '_retrieve_discovery_document', return_value={'revision': 'new'}):
+            assert authenticate.load_discovery_document(cache_path) == {'revision': 'new'}
+
+        with open(cache_path) as f:
+            assert json.load(f)['revision'] == 'new'
+
+    def test_service_built_from_cached_document(self, tmp_path):
+        from google.oauth2.credentials import Credentials
+        cache_path = str(tmp_path / 'discovery.json')
+
+        service = authenticate.build_service(Credentials(token='token'), cache_path)
+
+        assert hasattr(service.users(), 'messages')
+        assert os.path.exists(cache_path)
@@ -0,0 +1,124 @@
+import json
+from email.utils import parsedate_to_datetime
+
+import pytest
+
+from benchmarks.fake_gmail import make_service
+from processor.actions import EmailActions
+from processor.models import ActionItem
+from processor.rules import RuleEngine
+from processor.threads import ThreadProcessor, fetch_thread, list_thread_ids
+
+
+def write_rules(path, conditions, actions, predicate='all'):
+    path.write_text(json.dumps({'rules': [
+        {'name': 'Thread rule', 'predicate': predicate, 'conditions': conditions, 'actions': actions}
+    ]}))
+    return str(path)
+
+
+@pytest.fixture
+def service():
+    return make_service(40)
+
+
+@pytest.fixture
+def long_thread(service):
+    """ID and messages of the first thread with more than one message"""
+    thread_ids, _ = list_thread_ids(service, max_results=100)
+    for thread_id in thread_ids:
+        messages = fetch_thread(service, thread_id)
+        if len(messages) > 1:
+            return thread_id, messages
+    pytest.fail('synthetic mailbox has no multi-message thread')
+
+
+class TestThreads:
+
+    def test_list_and_fetch_threads(self, service):
+        thread_ids, next_page_token = list_thread_ids(service, max_results=100)
+
+        assert next_page_token is None
+        assert len(thread_ids) == len(set(thread_ids)) < 40
+        messages = [message for thread_id in thread_ids for message in fetch_thread(service, thread_id)]
+        assert len(messages) == 40
+        assert service.calls['users.threads.get'] == len(thread_ids)
+
+    def test_fetch_thread_oldest_first(self, long_thread):
+        thread_id, messages = long_thread
+
+        assert {message.thread_id for message in messages} == {thread_id}
+        dates = [message.date for message in messages]
+        assert dates == sorted(dates, key=parsedate_to_datetime)
+
+    @pytest.mark.parametrize('mode, matches', [('any', True), ('latest', False)])
+    def test_thread_modes(self, service, temp_db, tmp_path, long_thread, mode, matches):
+        thread_id, messages = long_thread
+        # Matches only the oldest message of the thread
+        rules_file = write_rules(tmp_path / 'rules.json',
+                                 [{'field': 'body', 'operator': 'contains', 'value': messages[0].body[:80]}],
+                                 [{'type': 'mark_as_read'}])
+        processor = ThreadProcessor(service, temp_db, RuleEngine(rules_file), EmailActions(service, db=temp_db),
+                                    mode=mode)
+
+        actions_to_apply = processor.actions_for_thread(thread_id, messages)
+
+        assert bool(actions_to_apply) is matches
+        if matches:
+            assert actions_to_apply[0].email_id == thread_id
+
+    def test_process_page_acts_once_per_thread(self, service, temp_db, tmp_path):
+        rules_file = write_rules(tmp_path / 'rules.json',
+                                 [{'field': 'to', 'operator': 'contains', 'value': 'me@gmail.com'}],
+                                 [{'type': 'move_message', 'folder': 'Conversations'}])
+        email_actions = EmailActions(service, db=temp_db)
+        processor = ThreadProcessor(service, temp_db, RuleEngine(rules_file), email_actions)
+
+        result = processor.process_page(limit=100)
+
+        assert result['emails'] == 40
+        assert result['actions'] == result['succeeded'] == result['threads']
+        assert service.calls['users.threads.modify'] == result['threads']
+        assert 'users.messages.modify' not in service.calls
+        message_id = service.mailbox.message_id(39)
+        assert temp_db.email_exists(message_id)
+        assert temp_db.action_exists(message_id, 'Thread rule', 'move_to_Conversations')
+
+        # Everything is recorded, so a second pass makes no modify calls
+        service.calls.clear()
+        processor.process_page(limit=100)
+        assert 'users.threads.modify' not in service.calls
+
+    def test_unchanged_threads_read_from_database(self, service, temp_db, tmp_path):
+        rules_file = write_rules(tmp_path / 'rules.json',
+                                 [{'field': 'subject', 'operator': 'contains', 'value': 'no such subject'}],
+                                 [{'type': 'mark_as_read'}])
+        processor = ThreadProcessor(service, temp_db, RuleEngine(rules_file), EmailActions(service, db=temp_db))
+        first = processor.process_page(limit=100)
+        thread_id = list_thread_ids(service, max_results=100)[0][0]
+
+        service.calls.clear()
+        second = processor.process_page(limit=100)
+
+        assert 'users.threads.get' not in service.calls
+        assert second['threads'] == first['threads'] and second['emails'] == 40
+
+        # A thread changed in Gmail since is fetched again, and only that one
+        service.users().threads().modify(userId='me', id=thread_id, body={'addLabelIds': ['STARRED']}).execute()
+        service.calls.clear()
+        processor.process_page(limit=100)
+
+        assert service.calls['users.threads.get'] == 1
+
+    def test_trash_thread(self, service, temp_db, tmp_path, long_thread):
+        thread_id, messages = long_thread
+        rules_file = write_rules(tmp_path / 'rules.json', [], [])
+        processor = ThreadProcessor(service, temp_db, RuleEngine(rules_file), EmailActions(service, db=temp_db))
+
+        assert processor.execute_thread_action(
+            ActionItem('Cleanup', {'type': 'move_message', 'folder': 'TRASH'}, thread_id), messages)
+        assert fetch_thread(service, thread_id) == []
+
+    def test_unknown_mode(self, service, temp_db, rule_engine_with_temp_file):
+        with pytest.raises(ValueError):
+            ThreadProcessor(service, temp_db, rule_engine_with_temp_file, None, mode='first')